@@ -0,0 +1,246 @@
+"""
+Expiry of stale shares and requests
+
+A background task (started from the app lifespan when
+config.ARCHIVE_AFTER_DAYS is set) checks every config.ARCHIVE_INTERVAL
+seconds for shares and requests whose date is more than
+config.ARCHIVE_AFTER_DAYS days ago, and moves them to the
+shares_archive and requests_archive tables, with their matches removed.
+So the shares and requests tables, which the listings, matching and
+search use, only hold current rows. With config.SHARE_EXPIRY set to
+"unavailable", stale shares are instead marked unavailable (and
+unmatched) where they are.
+
+Rows are handled config.ARCHIVE_BATCH_SIZE at a time, each batch in its
+own short transaction, so that SQLite's write lock is never held for
+long. Each batch is recorded like any other change (see
+crud.record_changes), so cached listings are refreshed and change feed
+clients see the rows go. Every worker process runs the task; batches
+that collide are rolled back and retried at the next check.
+
+The same task removes the stored photos that no share, current or
+archived, of any community has any more (see photos.remove_orphans),
+when config.PHOTO_ORPHAN_AGE is set.
+"""
+
+import asyncio
+import contextlib
+import logging
+from datetime import date, timedelta
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import config
+import crud
+import database
+import events
+import matching
+import models
+import photos
+import shards
+from database import AsyncSessionLocal
+
+logger = logging.getLogger("plantswap.archive")
+
+# The tables archived, with their archive tables and unmatch functions
+ARCHIVED = [
+    (models.Shares, models.ArchivedShares, matching.unmatch_shares),
+    (models.Requests, models.ArchivedRequests, matching.unmatch_requests),
+]
+
+
+async def archive_batch(
+    db: AsyncSession, model, archive_model, unmatch, cutoff: date, limit: int
+) -> int:
+    """
+    Move one batch of rows dated before a cutoff to their archive table
+
+    :param db: database
+    :param model: models.Shares or models.Requests
+    :param archive_model: The matching archive model
+    :param unmatch: matching.unmatch_shares or matching.unmatch_requests
+    :param cutoff: Rows dated before this are moved
+    :param limit: Most rows to move
+    :returns: The number of rows moved
+    """
+    ids = (
+        await db.scalars(
+            select(model.id).filter(model.date < cutoff).order_by(model.id).limit(limit)
+        )
+    ).all()
+    if not ids:
+        return 0
+    columns = [column.name for column in model.__table__.columns]
+    await db.execute(
+        insert(archive_model).from_select(
+            columns,
+            select(*(model.__table__.c[name] for name in columns)).filter(
+                model.id.in_(ids)
+            ),
+        )
+    )
+    await crud.delete_rows(db, model, ids, unmatch)
+    return len(ids)
+
+
+async def expire_shares_batch(db: AsyncSession, cutoff: date, limit: int) -> int:
+    """
+    Mark one batch of available shares dated before a cutoff unavailable
+
+    :param db: database
+    :param cutoff: Shares dated before this are marked
+    :param limit: Most shares to mark
+    :returns: The number of shares marked
+    """
+    ids = (
+        await db.scalars(
+            select(models.Shares.id)
+            .filter(models.Shares.is_available_now == True, models.Shares.date < cutoff)
+            .order_by(models.Shares.id)
+            .limit(limit)
+        )
+    ).all()
+    if not ids:
+        return 0
+    await db.execute(
+        update(models.Shares)
+        .filter(models.Shares.id.in_(ids))
+        .values(is_available_now=False),
+        execution_options={"synchronize_session": False},
+    )
+    # Only available shares are matched
+    await db.run_sync(matching.unmatch_shares, ids)
+    await crud.record_changes(
+        db,
+        models.Shares.__tablename__,
+        "update",
+        [(id, {"id": id, "is_available_now": False}) for id in ids],
+    )
+    await db.commit()
+    return len(ids)
+
+
+async def expire_all(today: date | None = None) -> dict:
+    """
+    Archive (or mark unavailable) all stale shares and requests, a batch
+    at a time
+
+    :param today: The current date; by default today
+    :returns: The number of rows handled, by table name
+    """
+    cutoff = (today or date.today()) - timedelta(days=config.ARCHIVE_AFTER_DAYS)
+    limit = config.ARCHIVE_BATCH_SIZE
+    counts = {}
+    for model, archive_model, unmatch in ARCHIVED:
+        counts[model.__tablename__] = 0
+        while True:
+            async with AsyncSessionLocal() as db:
+                if model is models.Shares and config.SHARE_EXPIRY == "unavailable":
+                    count = await expire_shares_batch(db, cutoff, limit)
+                else:
+                    count = await archive_batch(
+                        db, model, archive_model, unmatch, cutoff, limit
+                    )
+            counts[model.__tablename__] += count
+            if count:
+                events.broadcasters.publish()
+            if count < limit:
+                break
+            # Let other requests use the database between batches
+            await asyncio.sleep(0)
+    return counts
+
+
+async def remove_orphan_photos(communities: list[str | None]) -> int:
+    """
+    Remove the stored photos that none of the shares and archived shares
+    of the communities have, once config.PHOTO_ORPHAN_AGE seconds old
+
+    :param communities: Every community, None for the default database;
+                        photos are stored together for all of them
+    :returns: The number of files removed
+    """
+    referenced = set()
+    for community in communities:
+        with database.use_community(community):
+            async with AsyncSessionLocal() as db:
+                for model in (models.Shares, models.ArchivedShares):
+                    referenced.update(
+                        await db.scalars(
+                            select(model.photo_hash)
+                            .filter(model.photo_hash.is_not(None))
+                            .distinct()
+                        )
+                    )
+    return await asyncio.to_thread(
+        photos.remove_orphans, referenced, config.PHOTO_ORPHAN_AGE
+    )
+
+
+class Archiver:
+    """
+    Runs expire_all, if config.ARCHIVE_AFTER_DAYS is set, and
+    remove_orphan_photos, if config.PHOTO_ORPHAN_AGE is set, every
+    config.ARCHIVE_INTERVAL seconds
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """Start the task; from the app lifespan"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the task; from the app lifespan"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        """
+        Expire stale rows, and remove orphaned photos, of every community
+        until cancelled
+        """
+        while True:
+            try:
+                communities = [None, *await shards.list_communities()]
+                listed = True
+            except Exception:
+                logger.exception("Listing the communities failed")
+                communities = [None]
+                listed = False
+            if config.ARCHIVE_AFTER_DAYS:
+                await self._expire(communities)
+            # Without every community's shares, photos still in use
+            # would look orphaned
+            if config.PHOTO_ORPHAN_AGE and listed:
+                try:
+                    removed = await remove_orphan_photos(communities)
+                    if removed:
+                        logger.info("Removed %s orphaned photo files", removed)
+                except Exception:
+                    logger.exception("Removing orphaned photos failed")
+            await asyncio.sleep(config.ARCHIVE_INTERVAL)
+
+    async def _expire(self, communities: list[str | None]):
+        """Expire stale rows of each community"""
+        for community in communities:
+            with database.use_community(community):
+                try:
+                    counts = await expire_all()
+                    if any(counts.values()):
+                        logger.info(
+                            "Archived stale rows of %s: %s",
+                            community or "the default database", counts,
+                        )
+                except Exception:
+                    # e.g. another worker archiving the same rows; try
+                    # again later
+                    logger.exception("Archiving stale rows failed")
+
+
+archiver = Archiver()
@@ -0,0 +1,650 @@
+"""
+Benchmark of the plant swap backend
+
+Seeds a database with a configurable number of users, shares and
+requests, then drives the real app with concurrent clients, either
+in-process (through its ASGI interface, so no network or server is
+involved) or through uvicorn, and reports the throughput and the
+p50/p95/p99 latency of each endpoint. The results are saved as JSON,
+with the git commit they were measured at, so that runs at different
+commits can be compared.
+
+    python benchmark.py --users 100 --shares 10000 --requests 10000 \\
+        --mode both --concurrency 16 --output results.json
+
+The database is a separate file (benchmark.db) unless --database or
+--database-url says otherwise; use --reset to start it from scratch.
+Needs httpx (a dev dependency).
+
+--mode startup instead measures how long a new worker takes to serve
+its first request (importing the app, starting it, and answering),
+in fresh processes, with the modules that take longest to import. It
+fails (exit status 1) if the median exceeds --startup-target seconds,
+or if importing the app touches the database:
+
+    python benchmark.py --mode startup --startup-target 2
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta, timezone
+from pathlib import Path
+
+import httpx
+from sqlalchemy import select
+
+HERE = Path(__file__).resolve().parent
+
+# Password of every seeded user
+PASSWORD = "benchmark"
+
+# Plant names of the seeded shares and requests, so that they match
+PLANTS = [
+    "Monstera deliciosa", "Pothos", "Snake plant", "Spider plant", "Fern",
+    "Aloe vera", "Jade plant", "Peace lily", "Rubber plant", "Fiddle leaf fig",
+    "String of pearls", "ZZ plant", "Philodendron", "Calathea", "Begonia",
+    "Basil", "Mint", "Rosemary", "Tomato", "Pepper",
+]
+
+SEED_BATCH_SIZE = 1000
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--users", type=int, default=100, help="Users to seed")
+    parser.add_argument("--shares", type=int, default=1000, help="Shares to seed")
+    parser.add_argument("--requests", type=int, default=1000, help="Requests to seed")
+    parser.add_argument(
+        "--database", default="benchmark.db", help="SQLite file to seed and use"
+    )
+    parser.add_argument(
+        "--database-url", help="Database URL to use instead of --database"
+    )
+    parser.add_argument(
+        "--reset", action="store_true", help="Delete the --database file first"
+    )
+    parser.add_argument(
+        "--mode",
+        choices=["asgi", "uvicorn", "both", "serialization", "startup"],
+        default="asgi",
+        help="Drive the app in-process, through uvicorn, or both; compare "
+        "ways of serializing listings (see --rows); or time worker startup",
+    )
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000],
+        help="Listing sizes for --mode serialization",
+    )
+    parser.add_argument(
+        "--startup-runs", type=int, default=5,
+        help="Processes started for --mode startup",
+    )
+    parser.add_argument(
+        "--startup-target", type=float, default=2.0,
+        help="Most seconds to the first response for --mode startup",
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=200,
+        help="Requests per endpoint (fewer for /token, see --token-iterations)",
+    )
+    parser.add_argument(
+        "--token-iterations", type=int, default=20,
+        help="Requests to /token, which hashes a password each time",
+    )
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes")
+    parser.add_argument("--port", type=int, default=0, help="uvicorn port; default any free")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--output", help="JSON file for the results; default stdout")
+    return parser.parse_args(argv)
+
+
+def database_url(args) -> str:
+    """The database URL to benchmark"""
+    if args.database_url:
+        return args.database_url
+    return f"sqlite:///{Path(args.database).resolve()}"
+
+
+def seed(args):
+    """
+    Create the database if needed and add the users, shares and requests,
+    in batches, then match and count them
+
+    :param args: The command line arguments
+    """
+    # The app modules read the database URL from the environment when
+    # imported, so they are imported only now
+    import crud
+    import matching
+    import migrations
+    import models
+    import stats
+    from database import SessionLocal, engine
+
+    migrations.upgrade(engine)
+    rng = random.Random(args.seed)
+    hashed_password = crud.get_password_hash(PASSWORD)
+    usernames = [f"user{i}" for i in range(args.users)]
+
+    with SessionLocal() as db:
+        existing = set(db.scalars(select(models.User.username)))
+        new_users = [
+            {"username": name, "hashed_password": hashed_password, "is_active": True}
+            for name in usernames
+            if name not in existing
+        ]
+        insert_batches(db, models.User, new_users)
+
+        insert_batches(
+            db, models.Shares, (make_share(rng, usernames) for _ in range(args.shares))
+        )
+        insert_batches(
+            db,
+            models.Requests,
+            (make_request(rng, usernames) for _ in range(args.requests)),
+        )
+        matching.rematch_all(db)
+        # The rows were inserted directly, so count them all at once
+        stats.reconcile(db)
+        db.commit()
+
+
+def make_share(rng: random.Random, usernames: list[str]) -> dict:
+    """Make up a share, for seeding"""
+    from models import normalize_plant_name
+
+    plant = rng.choice(PLANTS)
+    return {
+        "plant_name": plant,
+        "plant_key": normalize_plant_name(plant),
+        "shared_by": rng.choice(usernames),
+        "amount": rng.randint(1, 5),
+        "description": f"Healthy {plant.lower()} cutting",
+        "is_available_now": rng.random() < 0.7,
+        "date": date.today() - timedelta(days=rng.randint(0, 365)),
+    }
+
+
+def make_request(rng: random.Random, usernames: list[str]) -> dict:
+    """Make up a request, for seeding"""
+    from models import normalize_plant_name
+
+    plant = rng.choice(PLANTS)
+    return {
+        "plant_name": plant,
+        "plant_key": normalize_plant_name(plant),
+        "requested_by": rng.choice(usernames),
+        "amount": rng.randint(1, 5),
+        "notes": f"Looking for a {plant.lower()}",
+        "date": date.today() - timedelta(days=rng.randint(0, 365)),
+    }
+
+
+def insert_batches(db, model, rows):
+    """Insert rows SEED_BATCH_SIZE at a time"""
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == SEED_BATCH_SIZE:
+            db.execute(model.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.execute(model.__table__.insert(), batch)
+
+
+def benchmark_serialization(args) -> dict:
+    """
+    Compare serializing shares listings through pydantic models of ORM
+    objects with serializing the selected columns directly (see
+    serialize.py), for each listing size in args.rows. The shares are
+    in a temporary database.
+
+    :param args: The command line arguments
+    :returns: Seconds taken each way (query and serialization), the
+              speedup, and whether the two outputs are the same, by size
+    """
+    import crud
+    import models
+    import schemas
+    import serialize
+    from pydantic import TypeAdapter
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import Session
+
+    # The listings' model, whose fields are crud.SHARE_COLUMNS
+    adapter = TypeAdapter(list[schemas.ShareListing])
+    rng = random.Random(args.seed)
+    usernames = [f"user{i}" for i in range(max(args.users, 1))]
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        engine = create_engine(f"sqlite:///{directory}/serialization.db")
+        models.Base.metadata.create_all(engine)
+        inserted = 0
+        with Session(engine) as db:
+            for count in sorted(args.rows):
+                insert_batches(
+                    db,
+                    models.Shares,
+                    (make_share(rng, usernames) for _ in range(count - inserted)),
+                )
+                db.commit()
+                inserted = count
+
+                start = time.perf_counter()
+                shares = db.scalars(
+                    select(models.Shares).order_by(models.Shares.id).limit(count)
+                ).all()
+                pydantic_body = adapter.dump_json(
+                    adapter.validate_python(shares, from_attributes=True)
+                )
+                pydantic_seconds = time.perf_counter() - start
+                del shares
+                db.expunge_all()
+
+                start = time.perf_counter()
+                rows = db.execute(
+                    select(*crud.SHARE_COLUMNS).order_by(models.Shares.id).limit(count)
+                ).all()
+                fast_body = serialize.dump_rows(rows)
+                fast_seconds = time.perf_counter() - start
+                del rows
+
+                results[str(count)] = {
+                    "pydantic_seconds": round(pydantic_seconds, 4),
+                    "fast_seconds": round(fast_seconds, 4),
+                    "speedup": round(pydantic_seconds / fast_seconds, 2),
+                    "same_output": pydantic_body == fast_body,
+                }
+                print(f"  {count} rows: {results[str(count)]}", file=sys.stderr)
+        engine.dispose()
+    return results
+
+
+# Run in a fresh process by benchmark_startup: times importing the app,
+# then starting it and answering one request, and checks that importing
+# it did not create the (new, empty) database
+STARTUP_SCRIPT = """
+import asyncio, json, os, sys, time
+from pathlib import Path
+start = time.perf_counter()
+import main
+imported = time.perf_counter()
+database_touched = Path(sys.argv[1]).exists()
+
+async def first_request():
+    # Straight through the ASGI interface, so no client library is imported
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1",
+        "method": "GET", "scheme": "http", "path": "/shares/",
+        "raw_path": b"/shares/", "root_path": "", "query_string": b"limit=1",
+        "headers": [], "client": ("127.0.0.1", 1), "server": ("benchmark", 80),
+    }
+    async with main.lifespan(main.app):
+        await main.app(scope, receive, send)
+    assert sent[0]["status"] == 200, sent[0]
+
+asyncio.run(first_request())
+done = time.perf_counter()
+print(json.dumps({
+    "import_seconds": imported - start,
+    "first_response_seconds": done - start,
+    "database_touched_on_import": database_touched,
+}))
+"""
+
+
+def parse_import_times(stderr: str) -> dict:
+    """
+    Sum the self times of the modules in python -X importtime output by
+    top-level package
+
+    :param stderr: The output
+    :returns: Seconds by package
+    """
+    seconds = {}
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        if not self_us.strip().isdigit():
+            continue  # the header line
+        package = name.strip().split(".")[0]
+        seconds[package] = seconds.get(package, 0) + int(self_us) / 1e6
+    return seconds
+
+
+def benchmark_startup(args) -> dict:
+    """
+    Time how long fresh processes take to import the app, start it and
+    answer a first request, each with a new database, and profile the
+    imports in one more (python -X importtime slows them down, so that
+    run is not timed)
+
+    :param args: The command line arguments
+    :returns: The median times, the slowest packages to import, and
+              whether the target was met
+    """
+    def start(*options):
+        with tempfile.TemporaryDirectory() as directory:
+            database = Path(directory) / "startup.db"
+            env = dict(os.environ, PLANTSWAP_DATABASE_URL=f"sqlite:///{database}")
+            env.pop("PLANTSWAP_ASYNC_DATABASE_URL", None)
+            return subprocess.run(
+                [sys.executable, *options, "-c", STARTUP_SCRIPT, str(database)],
+                cwd=HERE, env=env, capture_output=True, text=True, check=True,
+            )
+
+    runs = [
+        json.loads(start().stdout.splitlines()[-1]) for _ in range(args.startup_runs)
+    ]
+    import_times = parse_import_times(start("-X", "importtime").stderr)
+
+    def median(key):
+        values = sorted(run[key] for run in runs)
+        return round(values[len(values) // 2], 4)
+
+    slowest = sorted(import_times.items(), key=lambda item: -item[1])[:15]
+    first_response = median("first_response_seconds")
+    results = {
+        "import_seconds": median("import_seconds"),
+        "first_response_seconds": first_response,
+        "target_seconds": args.startup_target,
+        "database_touched_on_import": any(
+            run["database_touched_on_import"] for run in runs
+        ),
+        "slowest_imports": {name: round(value, 4) for name, value in slowest},
+    }
+    results["passed"] = (
+        first_response <= args.startup_target
+        and not results["database_touched_on_import"]
+    )
+    for key, value in results.items():
+        print(f"  {key}: {value}", file=sys.stderr)
+    return results
+
+
+def summarize(latencies: list[float], errors: int, elapsed: float) -> dict:
+    """
+    Summarize the latencies of one endpoint
+
+    :param latencies: Seconds taken by each request
+    :param errors: Number of requests that failed
+    :param elapsed: Seconds taken by all of them
+    :returns: Count, errors, requests per second, and latency percentiles
+              and mean in milliseconds
+    """
+    latencies = sorted(latencies)
+
+    def percentile(p):
+        if not latencies:
+            return None
+        index = min(len(latencies) - 1, round(p / 100 * (len(latencies) - 1)))
+        return round(latencies[index] * 1000, 3)
+
+    return {
+        "count": len(latencies),
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+        "p50_ms": percentile(50),
+        "p95_ms": percentile(95),
+        "p99_ms": percentile(99),
+        "mean_ms": (
+            round(sum(latencies) / len(latencies) * 1000, 3) if latencies else None
+        ),
+    }
+
+
+async def run_concurrently(make_request, count: int, concurrency: int) -> dict:
+    """
+    Make requests from concurrent clients and time them
+
+    :param make_request: Async function of the request number, making one
+                         request and returning its response
+    :param count: Number of requests
+    :param concurrency: Number of clients
+    :returns: The summary (see summarize)
+    """
+    latencies = []
+    errors = 0
+    numbers = iter(range(count))
+
+    async def client():
+        nonlocal errors
+        for number in numbers:
+            start = time.perf_counter()
+            try:
+                response = await make_request(number)
+                ok = response.is_success
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.perf_counter() - start)
+            errors += not ok
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+async def run_scenarios(client: httpx.AsyncClient, args) -> dict:
+    """
+    Benchmark each endpoint in turn
+
+    :param client: Client for the app
+    :param args: The command line arguments
+    :returns: Summary per endpoint
+    """
+    rng = random.Random(args.seed)
+    usernames = [f"user{i}" for i in range(max(args.users, 1))]
+    results = {}
+
+    async def bench(name, make_request, count=args.iterations):
+        results[name] = await run_concurrently(make_request, count, args.concurrency)
+        print(f"  {name}: {results[name]}", file=sys.stderr)
+
+    await bench(
+        "POST /token",
+        lambda _: client.post(
+            "/token", data={"username": rng.choice(usernames), "password": PASSWORD}
+        ),
+        args.token_iterations,
+    )
+    token = (
+        await client.post("/token", data={"username": usernames[0], "password": PASSWORD})
+    ).json().get("access_token")
+    auth = {"Authorization": f"Bearer {token}"}
+    await bench("GET /users/me/", lambda _: client.get("/users/me/", headers=auth))
+    await bench("GET /users/", lambda _: client.get("/users/"))
+    await bench("GET /shares/", lambda _: client.get("/shares/"))
+    await bench(
+        "GET /shares/?plant_name",
+        lambda _: client.get("/shares/", params={"plant_name": rng.choice(PLANTS)}),
+    )
+    await bench(
+        "GET /shares/?fields",
+        lambda _: client.get("/shares/", params={"fields": "plant_name,date"}),
+    )
+    await bench("GET /requests/", lambda _: client.get("/requests/"))
+    await bench("GET /matches/", lambda _: client.get("/matches/"))
+    await bench("GET /stats/plants", lambda _: client.get("/stats/plants"))
+    await bench("GET /stats/users", lambda _: client.get("/stats/users"))
+
+    today = date.today().isoformat()
+    created = {"shares": [], "requests": []}
+
+    async def create(table, body):
+        response = await client.post(f"/{table}/", json=body)
+        if response.is_success:
+            created[table].append(response.json()["id"])
+        return response
+
+    await bench(
+        "POST /shares/",
+        lambda _: create("shares", {
+            "plant_name": rng.choice(PLANTS),
+            "shared_by": rng.choice(usernames),
+            "amount": 1,
+            "description": "Benchmark share",
+            "is_available_now": True,
+            "date": today,
+        }),
+    )
+    await bench(
+        "POST /requests/",
+        lambda _: create("requests", {
+            "plant_name": rng.choice(PLANTS),
+            "requested_by": rng.choice(usernames),
+            "amount": 1,
+            "notes": "Benchmark request",
+            "date": today,
+        }),
+    )
+    for table in ("shares", "requests"):
+        ids = created[table]
+        await bench(
+            f"DELETE /{table}/{{id}}",
+            lambda number, ids=ids, table=table: client.delete(f"/{table}/{ids[number]}"),
+            len(ids),
+        )
+    return results
+
+
+async def run_asgi(args) -> dict:
+    """Benchmark the app in-process, through its ASGI interface"""
+    import main
+
+    transport = httpx.ASGITransport(app=main.app)
+    async with main.lifespan(main.app):
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+            return await run_scenarios(client, args)
+
+
+async def run_uvicorn(args, env: dict) -> dict:
+    """Benchmark the app served by uvicorn, in a child process"""
+    port = args.port or free_port()
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--port", str(port),
+            "--workers", str(args.workers),
+            "--log-level", "warning",
+        ],
+        cwd=HERE,
+        env=env,
+    )
+    try:
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(
+            base_url=f"http://127.0.0.1:{port}", limits=limits, timeout=60
+        ) as client:
+            await wait_for_server(client, server)
+            return await run_scenarios(client, args)
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def free_port() -> int:
+    """Get a free TCP port"""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_server(client: httpx.AsyncClient, server, timeout: float = 30):
+    """Wait until the server answers"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError("uvicorn exited")
+        try:
+            await client.get("/docs")
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError("uvicorn did not start")
+
+
+def git_commit() -> str | None:
+    """The commit of the working tree, if it is a git checkout"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=HERE, capture_output=True, text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    """Command line entry point"""
+    args = parse_args(argv)
+    if args.reset and not args.database_url:
+        for suffix in ("", "-wal", "-shm"):
+            Path(args.database + suffix).unlink(missing_ok=True)
+    os.environ["PLANTSWAP_DATABASE_URL"] = database_url(args)
+    # Measure the endpoints rather than the rate limiter, unless asked to
+    for name in (
+        "PLANTSWAP_RATE_LIMIT_TOKEN_IP",
+        "PLANTSWAP_RATE_LIMIT_TOKEN_USERNAME",
+        "PLANTSWAP_RATE_LIMIT_CREATE_USER_IP",
+    ):
+        os.environ.setdefault(name, "")
+    sys.path.insert(0, str(HERE))
+
+    results = {}
+    if args.mode == "serialization":
+        print("serialization:", file=sys.stderr)
+        results["serialization"] = benchmark_serialization(args)
+    elif args.mode == "startup":
+        print("startup:", file=sys.stderr)
+        results["startup"] = benchmark_startup(args)
+    else:
+        start = time.perf_counter()
+        seed(args)
+        print(f"Seeded in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+    if args.mode in ("asgi", "both"):
+        print("asgi:", file=sys.stderr)
+        results["asgi"] = asyncio.run(run_asgi(args))
+    if args.mode in ("uvicorn", "both"):
+        print("uvicorn:", file=sys.stderr)
+        results["uvicorn"] = asyncio.run(run_uvicorn(args, dict(os.environ)))
+
+    report = {
+        "commit": git_commit(),
+        "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "settings": {
+            key: value for key, value in vars(args).items()
+            if key not in ("output",)
+        },
+        "results": results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+    if "startup" in results and not results["startup"]["passed"]:
+        sys.exit("Startup target missed, or importing the app touched the database")
+
+
+if __name__ == "__main__":
+    main()
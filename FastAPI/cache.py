@@ -0,0 +1,68 @@
+"""
+Small in-process caches
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Least-recently-used cache of at most maxsize entries, each of which
+    also expires ttl seconds after it was set. Safe to use from several
+    threads.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, timer=time.monotonic):
+        """
+        :param maxsize: Most entries kept; the least recently used go first
+        :param ttl: Seconds an entry stays valid
+        :param timer: Clock giving the time in seconds
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get the value for a key
+
+        :param key: The key
+        :param default: Returned if the key is missing or expired
+        :returns: The value, or default
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+            value, expires = entry
+            if expires <= self.timer():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """Set the value for a key, evicting the least recently used if full"""
+        with self._lock:
+            self._entries[key] = (value, self.timer() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value (or default if missing)"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def clear(self):
+        """Remove all entries"""
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
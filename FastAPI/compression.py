@@ -0,0 +1,137 @@
+"""
+Compression of responses
+
+JSON listings shrink to a fraction of their size compressed, which is
+most of their latency on slow (e.g. mobile) connections. Responses of a
+compressible type (JSON, NDJSON, text) of at least
+config.COMPRESSION_MIN_BYTES are compressed with brotli, if the client
+accepts it and the brotli package is installed (the "fast" extra), or
+else gzip. Smaller ones are not worth the time.
+
+CompressionMiddleware compresses the other responses as they are sent.
+The listings compress their own bodies, once per table version, and
+keep them compressed in the listing cache (see listing_cache.py).
+Streamed responses (exports, the change feed, photos) are sent as they
+are, since compressing them would hold back their chunks.
+"""
+
+import gzip
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Content types worth compressing, by prefix
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "text/")
+# Streamed as events; compressing would hold them back
+STREAMED_TYPES = ("text/event-stream",)
+
+
+def supported_encodings() -> list[str]:
+    """The encodings this process can compress with, preferred first"""
+    return ["br", "gzip"] if brotli is not None else ["gzip"]
+
+
+def choose_encoding(accept_encoding: str | None) -> str | None:
+    """
+    Choose how to compress a response, from the client's Accept-Encoding
+
+    :param accept_encoding: The Accept-Encoding header, e.g. "gzip, br;q=0.9"
+    :returns: "br" or "gzip"; None to send the response as it is
+    """
+    if not config.COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    weights = {}
+    for item in accept_encoding.split(","):
+        name, _, params = item.partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[name.strip().lower()] = weight
+    best = None
+    for encoding in supported_encodings():
+        weight = weights.get(encoding, weights.get("*", 0.0))
+        if weight > 0 and (best is None or weight > best[1]):
+            best = encoding, weight
+    return best and best[0]
+
+
+def compressible(content_type: str | None) -> bool:
+    """Whether a response of a content type is worth compressing"""
+    content_type = (content_type or "").lower()
+    return content_type.startswith(COMPRESSIBLE_TYPES) and not content_type.startswith(
+        STREAMED_TYPES
+    )
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    """
+    Compress a response body
+
+    :param body: The body
+    :param encoding: "br" or "gzip", from choose_encoding
+    :returns: The compressed body
+    """
+    if encoding == "br":
+        return brotli.compress(body, quality=config.BROTLI_QUALITY)
+    # mtime=0 so that the same body always compresses to the same bytes
+    return gzip.compress(body, compresslevel=config.GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing responses sent in one piece, when they
+    are of a compressible type and large enough, and not already encoded
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        # None to send responses as they are, still with a Vary header
+        encoding = choose_encoding(Headers(scope=scope).get("accept-encoding"))
+
+        # The start of the response is held back until the body shows
+        # whether to compress it
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            headers = MutableHeaders(raw=list(start["headers"]))
+            body = message.get("body", b"")
+            if compressible(headers.get("content-type")):
+                if "accept-encoding" not in headers.get("vary", "").lower():
+                    headers.add_vary_header("Accept-Encoding")
+                if (
+                    encoding is not None
+                    and "content-encoding" not in headers
+                    and not message.get("more_body")
+                    and len(body) >= config.COMPRESSION_MIN_BYTES
+                ):
+                    body = compress(body, encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers["Content-Length"] = str(len(body))
+                    message = {**message, "body": body}
+            await send({**start, "headers": headers.raw})
+            start = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,196 @@
+"""
+Settings for the plant swap backend, read from environment variables
+so that deployments can tune them without code changes
+"""
+
+import os
+
+# bcrypt cost factor (log2 of the number of rounds) for password hashes.
+# Hashes made with a different cost are re-hashed at the next login.
+BCRYPT_ROUNDS = int(os.environ.get("PLANTSWAP_BCRYPT_ROUNDS", "12"))
+
+# Most password hashes/verifications computed at the same time; more
+# wait their turn rather than competing for the CPU
+PASSWORD_HASH_WORKERS = int(os.environ.get("PLANTSWAP_PASSWORD_HASH_WORKERS", "2"))
+
+# Database URL. Any SQLAlchemy URL works, e.g. postgresql://user:pw@host/db
+DATABASE_URL = os.environ.get("PLANTSWAP_DATABASE_URL", "sqlite:///./plants.db")
+# URL of the same database for the async endpoints; by default derived
+# from DATABASE_URL (see database.to_async_url)
+ASYNC_DATABASE_URL = os.environ.get("PLANTSWAP_ASYNC_DATABASE_URL")
+
+# Bring the database up to the latest schema (see migrations.py) when
+# the app starts. Deployments that start workers often can turn this off
+# and run "python migrations.py" once per deploy instead, so that a new
+# worker does no database work before serving.
+MIGRATE_ON_STARTUP = os.environ.get("PLANTSWAP_MIGRATE_ON_STARTUP", "1") == "1"
+
+# Per-community databases (see shards.py): the URL of each community's
+# database, with {community} standing for its id, e.g.
+# sqlite:///./communities/{community}.db or
+# postgresql://user:pw@host/plantswap_{community}; empty for a single
+# database. Requests without a community use DATABASE_URL, which also
+# holds the list of communities.
+SHARD_URL_TEMPLATE = os.environ.get("PLANTSWAP_SHARD_URL_TEMPLATE", "")
+# Most communities whose engines (and connection pools) are kept open
+SHARD_ENGINE_CACHE_SIZE = int(os.environ.get("PLANTSWAP_SHARD_ENGINE_CACHE_SIZE", "64"))
+
+# Read replicas of the default database (see replicas.py): URLs,
+# separated by commas, that GET listings read from in turn, e.g.
+# sqlite:///./plants-replica.db or postgresql://user:pw@replica/db;
+# empty to read from DATABASE_URL. SQLite replicas of an SQLite database
+# are copied from it every READ_REPLICA_COPY_INTERVAL seconds, if it
+# changed (0 to leave that to another process, e.g. "python
+# replicas.py"). Each copy reads and writes the whole database file, so
+# shorter intervals keep replicas fresher at the cost of disk I/O that
+# grows with the size of the database. For READ_YOUR_WRITES_SECONDS
+# after a client's own POST or DELETE, its reads go to DATABASE_URL, so
+# it sees its change (0 for never); keep it longer than the interval.
+READ_REPLICA_URLS = [
+    url.strip()
+    for url in os.environ.get("PLANTSWAP_READ_REPLICA_URLS", "").split(",")
+    if url.strip()
+]
+READ_REPLICA_COPY_INTERVAL = float(
+    os.environ.get("PLANTSWAP_READ_REPLICA_COPY_INTERVAL", "30")
+)
+READ_YOUR_WRITES_SECONDS = float(os.environ.get("PLANTSWAP_READ_YOUR_WRITES_SECONDS", "35"))
+
+# Connection pool of each engine: connections kept open, extra ones
+# allowed under load, and seconds to wait for one before giving up
+DB_POOL_SIZE = int(os.environ.get("PLANTSWAP_DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.environ.get("PLANTSWAP_DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.environ.get("PLANTSWAP_DB_POOL_TIMEOUT", "30"))
+# Seconds after which a pooled connection is replaced (-1 for never)
+DB_POOL_RECYCLE = int(os.environ.get("PLANTSWAP_DB_POOL_RECYCLE", "3600"))
+
+# SQLite pragmas set on every new connection. The defaults suit several
+# uvicorn workers sharing one database file: WAL lets readers and a
+# writer work at the same time, synchronous=NORMAL is safe with WAL and
+# skips an fsync per commit, and a busy timeout makes a writer wait for
+# the lock instead of failing with "database is locked". Set a pragma
+# to an empty string to leave SQLite's default.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("PLANTSWAP_SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("PLANTSWAP_SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": os.environ.get("PLANTSWAP_SQLITE_BUSY_TIMEOUT_MS", "5000"),
+    # Bytes of the database file to memory-map for reads
+    "mmap_size": os.environ.get("PLANTSWAP_SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)),
+    # Page cache per connection; negative values are in KiB
+    "cache_size": os.environ.get("PLANTSWAP_SQLITE_CACHE_SIZE", "-65536"),
+}
+
+# Authenticated users are looked up once per token subject and then
+# cached for this many seconds, up to this many users. Changes made by
+# this process take effect at once; changes made by other worker
+# processes take effect within the TTL.
+USER_CACHE_TTL = float(os.environ.get("PLANTSWAP_USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.environ.get("PLANTSWAP_USER_CACHE_SIZE", "10000"))
+
+# Most listing responses (distinct table and query string) kept
+# serialized in memory, and seconds each is kept at most
+LISTING_CACHE_SIZE = int(os.environ.get("PLANTSWAP_LISTING_CACHE_SIZE", "512"))
+LISTING_CACHE_TTL = float(os.environ.get("PLANTSWAP_LISTING_CACHE_TTL", "600"))
+
+# Change feed (GET /events): number of recent changes kept for clients
+# resuming with Last-Event-ID, seconds between checks for changes made
+# by other worker processes, seconds between keep-alive comments, and
+# most events queued for a slow client before it is disconnected
+EVENT_LOG_SIZE = int(os.environ.get("PLANTSWAP_EVENT_LOG_SIZE", "10000"))
+EVENT_POLL_INTERVAL = float(os.environ.get("PLANTSWAP_EVENT_POLL_INTERVAL", "1"))
+EVENT_KEEPALIVE_INTERVAL = float(os.environ.get("PLANTSWAP_EVENT_KEEPALIVE_INTERVAL", "15"))
+EVENT_QUEUE_SIZE = int(os.environ.get("PLANTSWAP_EVENT_QUEUE_SIZE", "1000"))
+
+# Most rows in one bulk create or delete request, and the largest body
+# of a bulk create request, in bytes
+BULK_MAX_ROWS = int(os.environ.get("PLANTSWAP_BULK_MAX_ROWS", "10000"))
+BULK_MAX_BYTES = int(os.environ.get("PLANTSWAP_BULK_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Usernames, separated by commas, of the users allowed to export and
+# import whole tables at /export and /import (see dump.py). Empty, the
+# default, leaves dumps to the command line.
+DUMP_USERNAMES = {
+    name.strip()
+    for name in os.environ.get("PLANTSWAP_DUMP_USERNAMES", "").split(",")
+    if name.strip()
+}
+
+# Request and SQL metrics at GET /metrics (see metrics.py); set to 0 to
+# turn them off
+METRICS_ENABLED = os.environ.get("PLANTSWAP_METRICS_ENABLED", "1") == "1"
+# SQL statements taking at least this many seconds are logged as
+# warnings by the "plantswap.slow_query" logger; 0 to log none
+SLOW_QUERY_SECONDS = float(os.environ.get("PLANTSWAP_SLOW_QUERY_SECONDS", "0"))
+
+# Rate limits of the endpoints that hash passwords (see ratelimit.py),
+# as "requests/seconds" per client IP and per username; empty for none
+RATE_LIMITS = {
+    "token": {
+        "ip": os.environ.get("PLANTSWAP_RATE_LIMIT_TOKEN_IP", "30/60"),
+        "username": os.environ.get("PLANTSWAP_RATE_LIMIT_TOKEN_USERNAME", "10/60"),
+    },
+    "create_user": {
+        "ip": os.environ.get("PLANTSWAP_RATE_LIMIT_CREATE_USER_IP", "10/3600"),
+    },
+}
+# Most rate limit buckets kept in memory, and "module:ClassName" of a
+# ratelimit.RateLimitBackend to keep them elsewhere instead
+RATE_LIMIT_MAX_KEYS = int(os.environ.get("PLANTSWAP_RATE_LIMIT_MAX_KEYS", "100000"))
+RATE_LIMIT_BACKEND = os.environ.get("PLANTSWAP_RATE_LIMIT_BACKEND", "")
+# Addresses, separated by commas, of the reverse proxies in front of the
+# app. Requests from them are limited by the client address they give
+# in X-Forwarded-For. Requests from other addresses are limited by
+# their own address. Behind a proxy that is not listed here, every
+# client shares the proxy's bucket.
+TRUSTED_PROXIES = {
+    address.strip()
+    for address in os.environ.get("PLANTSWAP_TRUSTED_PROXIES", "").split(",")
+    if address.strip()
+}
+
+# Most matches kept per request (see matching.py): its best available
+# shares for the same plant
+MATCHES_PER_REQUEST = int(os.environ.get("PLANTSWAP_MATCHES_PER_REQUEST", "10"))
+
+# Archiving of stale listings (see archive.py): shares and requests
+# whose date is more than this many days ago are moved to archive
+# tables (0 to keep them all). With SHARE_EXPIRY "unavailable", stale
+# shares are instead kept but marked unavailable. Checked every
+# ARCHIVE_INTERVAL seconds, ARCHIVE_BATCH_SIZE rows per transaction.
+ARCHIVE_AFTER_DAYS = int(os.environ.get("PLANTSWAP_ARCHIVE_AFTER_DAYS", "0"))
+SHARE_EXPIRY = os.environ.get("PLANTSWAP_SHARE_EXPIRY", "archive")
+ARCHIVE_INTERVAL = float(os.environ.get("PLANTSWAP_ARCHIVE_INTERVAL", "3600"))
+ARCHIVE_BATCH_SIZE = int(os.environ.get("PLANTSWAP_ARCHIVE_BATCH_SIZE", "500"))
+
+# Group commit of POST /shares/ and /requests/ (see group_commit.py):
+# when on, rows posted at about the same time are written in one
+# transaction, waiting up to WRITE_BATCH_DELAY seconds after the first
+# for up to WRITE_BATCH_MAX_ROWS rows
+WRITE_BATCHING = os.environ.get("PLANTSWAP_WRITE_BATCHING", "0") == "1"
+WRITE_BATCH_DELAY = float(os.environ.get("PLANTSWAP_WRITE_BATCH_DELAY", "0.005"))
+WRITE_BATCH_MAX_ROWS = int(os.environ.get("PLANTSWAP_WRITE_BATCH_MAX_ROWS", "500"))
+
+# Photos of shares (see photos.py): the directory they are stored in,
+# the largest photo accepted, in bytes, the longest side of their
+# thumbnails, in pixels, and the threads making thumbnails
+PHOTO_DIR = os.environ.get("PLANTSWAP_PHOTO_DIR", "./photos")
+PHOTO_MAX_BYTES = int(os.environ.get("PLANTSWAP_PHOTO_MAX_BYTES", str(10 * 1024 * 1024)))
+THUMBNAIL_SIZE = int(os.environ.get("PLANTSWAP_THUMBNAIL_SIZE", "256"))
+THUMBNAIL_WORKERS = int(os.environ.get("PLANTSWAP_THUMBNAIL_WORKERS", "2"))
+# Photos no share has are removed by the archiver every ARCHIVE_INTERVAL
+# seconds, once they are this many seconds old; 0 to keep them
+PHOTO_ORPHAN_AGE = float(os.environ.get("PLANTSWAP_PHOTO_ORPHAN_AGE", "86400"))
+
+# Seconds between recomputations of the plant and user statistics from
+# the shares and requests, correcting any drift (see stats.py); 0 for never
+STATS_RECONCILE_INTERVAL = float(
+    os.environ.get("PLANTSWAP_STATS_RECONCILE_INTERVAL", "3600")
+)
+
+# Compression of responses (see compression.py): whether it is on, the
+# smallest body compressed, in bytes, and the gzip level (1-9) and
+# brotli quality (0-11), higher being smaller but slower
+COMPRESSION_ENABLED = os.environ.get("PLANTSWAP_COMPRESSION_ENABLED", "1") == "1"
+COMPRESSION_MIN_BYTES = int(os.environ.get("PLANTSWAP_COMPRESSION_MIN_BYTES", "1024"))
+GZIP_LEVEL = int(os.environ.get("PLANTSWAP_GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.environ.get("PLANTSWAP_BROTLI_QUALITY", "5"))
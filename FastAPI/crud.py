@@ -3,15 +3,61 @@
 Utility functions
 """
 
-from passlib.context import CryptContext
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from types import SimpleNamespace
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
+import cache
+import config
+import database
+import geo
+import matching
 import models
 import schemas
+import stats
 
 # utility functions for hashing password and etc
-# iniitialization step for hashing algorithms
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@functools.cache
+def get_pwd_context():
+    """
+    Get the password hashing context, made at its first use rather than
+    at import, so that starting a worker does not load passlib and bcrypt
+
+    With deprecated="auto", hashes made with other bcrypt settings (e.g.
+    an older cost factor) are flagged for re-hashing when verified
+
+    :returns: The passlib CryptContext
+    """
+    from passlib.context import CryptContext
+
+    return CryptContext(
+        schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.BCRYPT_ROUNDS
+    )
+
+# bcrypt takes a good fraction of a second by design, so the async
+# endpoints hash and verify passwords in this pool instead of on the
+# event loop. Its size limits how many run at once.
+password_executor = ThreadPoolExecutor(
+    max_workers=config.PASSWORD_HASH_WORKERS, thread_name_prefix="password-hash"
+)
+
+
+async def run_password_hashing(func, *args):
+    """
+    Run a password hashing function in the password pool
+
+    :param func: The function, e.g. get_pwd_context().hash
+    :param args: Its arguments
+    :returns: What the function returns
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(password_executor, func, *args)
 
 
 
@@ -23,7 +69,7 @@ def verify_password(plain_password, hashed_password):
     :param hashed_password  Hashed password
     :returns: True if passwords match, else False
     """
-    return pwd_context.verify(plain_password, hashed_password)
+    return get_pwd_context().verify(plain_password, hashed_password)
 
 # From fastapi tutorial 2023/10/5
 def get_password_hash(password: str):
@@ -33,7 +79,36 @@ def get_password_hash(password: str):
     :param password: Plain text passwor
     :returns: hashed password
     """
-    return pwd_context.hash(password)
+    return get_pwd_context().hash(password)
+
+# Users looked up for authenticated requests, by community and username
+# (the token subject), as schemas.User snapshots. Functions below that
+# change a user remove them from it.
+user_cache = cache.TTLCache(maxsize=config.USER_CACHE_SIZE, ttl=config.USER_CACHE_TTL)
+
+
+def user_cache_key(username: str) -> tuple:
+    """Key of a user in user_cache: each community has its own users"""
+    return database.current_community.get(), username
+
+
+async def get_user_cached(db: AsyncSession, username: str):
+    """
+    Get user information, from the user cache if possible
+
+    :param db: database
+    :param username: The username
+    :returns: The user as a schemas.User, or None if there is no such user
+    """
+    user = user_cache.get(user_cache_key(username))
+    if user is None:
+        db_user = await db.run_sync(get_user, username)
+        if db_user is None:
+            return None
+        user = schemas.User.model_validate(db_user, from_attributes=True)
+        user_cache.set(user_cache_key(username), user)
+    return user
+
 
 # From https://fastapi.tiangolo.com/tutorial/sql-databases/ 2023/10/6
 def get_user(db: Session, username: str):
@@ -65,6 +140,16 @@ def get_user(db: Session, username: str):
 def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
+def get_user_by_id(db: Session, user_id: int):
+    """
+    Get user information from database by id
+
+    :param db: database
+    :param user_id: User id
+    :returns: The user, or None if there is no such user
+    """
+    return db.get(models.User, user_id)
+
 # From https://fastapi.tiangolo.com/tutorial/sql-databases/ 2023/10/6
 def get_users(db: Session, skip: int=0, limit: int=100):
     return db.query(models.User).offset(skip).limit(limit).all()
@@ -78,6 +163,31 @@ def create_user(db: Session, username:str, password: str): # : schemas.UserInDB)
     # the database, like the generated ID
 
     hashed_password = get_password_hash(password)
+    return add_user(db, username, hashed_password)
+
+
+async def create_user_async(db: AsyncSession, username: str, password: str):
+    """
+    Add a user, hashing the password in the password pool
+
+    :param db: database
+    :param username: The username
+    :param password: The plain text password
+    :returns: The new user
+    """
+    hashed_password = await run_password_hashing(get_pwd_context().hash, password)
+    return await db.run_sync(add_user, username, hashed_password)
+
+
+def add_user(db: Session, username: str, hashed_password: str):
+    """
+    Add a user whose password is already hashed
+
+    :param db: database
+    :param username: The username
+    :param hashed_password: The hashed password
+    :returns: The new user
+    """
     db_user = models.User(
         username=username,
         hashed_password=hashed_password,
@@ -85,8 +195,49 @@ def create_user(db: Session, username:str, password: str): # : schemas.UserInDB)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
+    # The username may have belonged to an earlier user
+    user_cache.pop(user_cache_key(username))
     return db_user
 
+
+def set_user_active(db: Session, username: str, is_active: bool):
+    """
+    Activate or deactivate a user
+
+    :param db: database
+    :param username: The username
+    :param is_active: Whether the user should be active
+    :returns: The user, or None if there is no such user
+    """
+    user = get_user(db, username)
+    if user is None:
+        return None
+    user.is_active = is_active
+    db.commit()
+    db.refresh(user)
+    user_cache.pop(user_cache_key(username))
+    return user
+
+
+def set_user_location(db: Session, username: str, location: schemas.Location):
+    """
+    Set the location used for a user's new shares and requests
+
+    :param db: database
+    :param username: The username
+    :param location: The location; None latitude and longitude to clear it
+    :returns: The user, or None if there is no such user
+    """
+    user = get_user(db, username)
+    if user is None:
+        return None
+    user.latitude = location.latitude
+    user.longitude = location.longitude
+    db.commit()
+    db.refresh(user)
+    user_cache.pop(user_cache_key(username))
+    return user
+
 def get_items(db: Session, skip: int=0, limit: int=100):
     return db.query(models.Item).offset(skip).limit(limit).all()
 
@@ -99,6 +250,463 @@ def create_user_item(db: Session, item: schemas.ItemCreate, user_id: int):
 
 
 
+async def get_table_version(db: AsyncSession, name: str) -> int:
+    """
+    Get the version of a table's contents
+
+    :param db: database
+    :param name: The table name
+    :returns: The version; it increases whenever the table changes
+    """
+    version = await db.scalar(
+        select(models.TableVersion.version).filter(models.TableVersion.name == name)
+    )
+    return version or 0
+
+
+async def bump_table_version(db: AsyncSession, name: str):
+    """
+    Increase the version of a table's contents, as part of the
+    transaction that changes them. The caller commits.
+
+    :param db: database
+    :param name: The table name
+    """
+    result = await db.execute(
+        update(models.TableVersion)
+        .filter(models.TableVersion.name == name)
+        .values(version=models.TableVersion.version + 1)
+    )
+    if result.rowcount == 0:
+        await db.execute(insert(models.TableVersion).values(name=name, version=1))
+
+
+async def record_change(
+    db: AsyncSession, name: str, op: str, row_id: int, data: dict | None = None
+):
+    """
+    Record a change to the shares or requests table, as part of the
+    transaction making it: bump the table version and log the change
+    for the change feed. The caller commits.
+
+    :param db: database
+    :param name: The table name
+    :param op: "create" or "delete"
+    :param row_id: Id of the row created or deleted
+    :param data: The created row, as JSON-compatible data
+    """
+    await record_changes(db, name, op, [(row_id, data)])
+
+
+async def record_changes(db: AsyncSession, name: str, op: str, changes: list):
+    """
+    Record changes to many rows of the shares or requests table at once,
+    with a single version bump; see record_change. The caller commits.
+
+    :param db: database
+    :param name: The table name
+    :param op: "create" or "delete"
+    :param changes: List of (row id, created row data or None)
+    """
+    if not changes:
+        return
+    await bump_table_version(db, name)
+    await db.execute(
+        insert(models.Event),
+        [
+            {"table_name": name, "op": op, "row_id": row_id, "data": data}
+            for row_id, data in changes
+        ],
+    )
+
+
+async def add_user_locations(db: AsyncSession, values: list[dict], user_key: str):
+    """
+    Give new shares or requests without a location their user's location,
+    looking up all the users at once
+
+    :param db: database
+    :param values: Column values of the new rows; changed in place
+    :param user_key: Key of the username, "shared_by" or "requested_by"
+    """
+    unlocated = [value for value in values if value["latitude"] is None]
+    if not unlocated:
+        return
+    usernames = {value[user_key] for value in unlocated}
+    locations = {
+        username: (latitude, longitude)
+        for username, latitude, longitude in await db.execute(
+            select(models.User.username, models.User.latitude, models.User.longitude)
+            .filter(models.User.username.in_(usernames))
+            .filter(models.User.latitude.is_not(None))
+        )
+    }
+    for value in unlocated:
+        if value[user_key] in locations:
+            value["latitude"], value["longitude"] = locations[value[user_key]]
+
+
+async def create_rows(
+    db: AsyncSession, model, rows: list, match, user_key: str
+) -> list[dict]:
+    """
+    Add shares or requests in one transaction, with one INSERT for all
+    of them, and match them. The new rows are not loaded back.
+
+    :param db: database
+    :param model: models.Shares or models.Requests
+    :param rows: The new rows (ShareBase or RequestBase)
+    :param match: matching.match_shares or matching.match_requests
+    :param user_key: The rows' username field, "shared_by" or "requested_by"
+    :returns: The new rows' column values (with "id"), in the same order
+    """
+    if not rows:
+        return []
+    values = [
+        {**row.model_dump(), "plant_key": models.normalize_plant_name(row.plant_name)}
+        for row in rows
+    ]
+    await add_user_locations(db, values, user_key)
+    # The order of RETURNING rows is not guaranteed, so sqlalchemy is
+    # asked for the ids in the order of the rows. It does so with
+    # multi-row INSERTs where the database can tell the rows apart
+    # (e.g. Postgres), and one INSERT per row on SQLite.
+    ids = (
+        await db.scalars(
+            insert(model).returning(model.id, sort_by_parameter_order=True), values
+        )
+    ).all()
+    # Matching only needs the attributes, not ORM objects
+    await db.run_sync(
+        match, [SimpleNamespace(id=id, **value) for id, value in zip(ids, values)]
+    )
+    await stats.record_rows(db, model.__tablename__, values, 1)
+    created = [{"id": id, **value} for id, value in zip(ids, values)]
+    for value in created:
+        del value["plant_key"]
+    await record_changes(
+        db,
+        model.__tablename__,
+        "create",
+        [
+            (value["id"], {**value, "date": value["date"].isoformat()})
+            for value in created
+        ],
+    )
+    await db.commit()
+    return created
+
+
+async def delete_rows(db: AsyncSession, model, ids: list[int], unmatch) -> list[int]:
+    """
+    Delete shares or requests and their matches, by id, in one
+    transaction. Ids that are not found are skipped.
+
+    :param db: database
+    :param model: models.Shares or models.Requests
+    :param ids: Ids of the rows to delete
+    :param unmatch: matching.unmatch_shares or matching.unmatch_requests
+    :returns: The ids of the rows that were deleted
+    """
+    if not ids:
+        return []
+    await db.run_sync(unmatch, ids)
+    rows = (
+        await db.execute(
+            delete(model)
+            .where(model.id.in_(ids))
+            .returning(model.id, *stats.counted_columns(model)),
+            execution_options={"synchronize_session": False},
+        )
+    ).mappings().all()
+    deleted = [row["id"] for row in rows]
+    await stats.record_rows(db, model.__tablename__, rows, -1)
+    await record_changes(
+        db, model.__tablename__, "delete", [(id, None) for id in deleted]
+    )
+    await db.commit()
+    return deleted
+
+
+async def create_shares(db: AsyncSession, shares: list[schemas.ShareBase]) -> list[int]:
+    """
+    Add plant shares, and match them with the requests for the same plants
+
+    :param db: database
+    :param shares: The share infos
+    :returns: The ids of the new shares, in the same order
+    """
+    return [share["id"] for share in await create_share_rows(db, shares)]
+
+
+async def create_share_rows(db: AsyncSession, shares: list[schemas.ShareBase]):
+    """Add plant shares, returning their column values; see create_shares"""
+    return await create_rows(
+        db, models.Shares, shares, matching.match_shares, "shared_by"
+    )
+
+
+async def create_share(db: AsyncSession, share: schemas.ShareBase):
+    """
+    Add a plant share, and match it with the requests for the same plant
+
+    :param db: database
+    :param share: The share info
+    :returns: The new share
+    """
+    [created] = await create_share_rows(db, [share])
+    return schemas.ShareModel(**created)
+
+
+async def delete_shares(db: AsyncSession, share_ids: list[int]) -> list[int]:
+    """
+    Delete plant shares and their matches
+
+    :param db: database
+    :param share_ids: Ids of the shares
+    :returns: The ids of the shares that were deleted
+    """
+    return await delete_rows(db, models.Shares, share_ids, matching.unmatch_shares)
+
+
+async def delete_share(db: AsyncSession, share_id: int):
+    """
+    Delete a plant share and its matches
+
+    :param db: database
+    :param share_id: Id of the share
+    :returns: True if the share was deleted, False if it was not found
+    """
+    return bool(await delete_shares(db, [share_id]))
+
+
+async def get_share_owner(db: AsyncSession, share_id: int) -> str | None:
+    """
+    Get the username of the user who shared a plant
+
+    :param db: database
+    :param share_id: Id of the share
+    :returns: The username; None if the share is not found
+    """
+    return await db.scalar(
+        select(models.Shares.shared_by).filter(models.Shares.id == share_id)
+    )
+
+
+async def set_share_photo(db: AsyncSession, share_id: int, photo_hash: str) -> bool:
+    """
+    Set the photo of a share, replacing any it had
+
+    :param db: database
+    :param share_id: Id of the share
+    :param photo_hash: The photo's SHA-256, as stored by photos.receive_photo
+    :returns: True if the share was updated, False if it was not found
+    """
+    updated = (
+        await db.scalars(
+            update(models.Shares)
+            .filter(models.Shares.id == share_id)
+            .values(photo_hash=photo_hash)
+            .returning(models.Shares.id),
+            execution_options={"synchronize_session": False},
+        )
+    ).all()
+    if not updated:
+        return False
+    await record_change(
+        db,
+        models.Shares.__tablename__,
+        "update",
+        share_id,
+        {"id": share_id, "thumbnail_url": models.thumbnail_url(photo_hash)},
+    )
+    await db.commit()
+    return True
+
+
+async def create_requests(
+    db: AsyncSession, requests: list[schemas.RequestBase]
+) -> list[int]:
+    """
+    Add plant requests, and match them with the available shares of the
+    same plants
+
+    :param db: database
+    :param requests: The request infos
+    :returns: The ids of the new requests, in the same order
+    """
+    return [request["id"] for request in await create_request_rows(db, requests)]
+
+
+async def create_request_rows(db: AsyncSession, requests: list[schemas.RequestBase]):
+    """Add plant requests, returning their column values; see create_requests"""
+    return await create_rows(
+        db, models.Requests, requests, matching.match_requests, "requested_by"
+    )
+
+
+async def create_request(db: AsyncSession, request: schemas.RequestBase):
+    """
+    Add a plant request, and match it with the available shares of the
+    same plant
+
+    :param db: database
+    :param request: The request info
+    :returns: The new request
+    """
+    [created] = await create_request_rows(db, [request])
+    return schemas.RequestModel(**created)
+
+
+async def delete_requests(db: AsyncSession, request_ids: list[int]) -> list[int]:
+    """
+    Delete plant requests and their matches
+
+    :param db: database
+    :param request_ids: Ids of the requests
+    :returns: The ids of the requests that were deleted
+    """
+    return await delete_rows(
+        db, models.Requests, request_ids, matching.unmatch_requests
+    )
+
+
+async def delete_request(db: AsyncSession, request_id: int):
+    """
+    Delete a plant request and its matches
+
+    :param db: database
+    :param request_id: Id of the request
+    :returns: True if the request was deleted, False if it was not found
+    """
+    return bool(await delete_requests(db, [request_id]))
+
+
+# Columns of the shares and requests listings, in the order of the fields
+# of their response models
+SHARE_COLUMNS = [
+    getattr(models.Shares, name) for name in schemas.ShareListing.model_fields
+]
+REQUEST_COLUMNS = [
+    getattr(models.Requests, name) for name in schemas.RequestModel.model_fields
+]
+
+
+def _listing_columns(model, columns: list, fields: list[str] | None) -> list:
+    """
+    Get the columns to select for a listing
+
+    :param model: Shares or Requests
+    :param columns: All the listing's columns, SHARE_COLUMNS or REQUEST_COLUMNS
+    :param fields: Names of the fields asked for, already checked against
+                   the response model; None for all of them
+    :returns: The columns, in the order of the response model's fields
+    """
+    if fields is None:
+        return columns
+    return [getattr(model, name) for name in fields]
+
+
+async def get_shares(
+    db: AsyncSession,
+    shared_by: str | None = None,
+    plant_name: str | None = None,
+    is_available_now: bool | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    near: tuple[float, float, float] | None = None,
+    after_id: int | None = None,
+    limit: int = 100,
+    fields: list[str] | None = None,
+):
+    """
+    Get one page of plant shares, optionally filtered
+
+    Pages are keyset (cursor) pages on id: rather than an OFFSET, which
+    makes SQLite walk past every skipped row, we start right after the
+    last id of the previous page, so every page costs the same.
+
+    :param db: database
+    :param shared_by: Only shares from this user
+    :param plant_name: Only shares whose plant name contains this text
+    :param is_available_now: Only shares with this availability
+    :param date_from: Only shares posted on or after this date
+    :param date_to: Only shares posted on or before this date
+    :param near: Only shares within radius km of a point, as (latitude,
+                 longitude, radius)
+    :param after_id: Only shares with an id greater than this (the cursor)
+    :param limit: Maximum number of shares to return
+    :param fields: Only these ShareListing fields; None for all
+    :returns: List of rows with the ShareListing fields, ordered by id
+    """
+    # Only the columns of the response, as plain rows; loading ORM
+    # objects would cost more than the query itself for large pages
+    query = select(*_listing_columns(models.Shares, SHARE_COLUMNS, fields))
+    if shared_by is not None:
+        query = query.filter(models.Shares.shared_by == shared_by)
+    if is_available_now is not None:
+        query = query.filter(models.Shares.is_available_now == is_available_now)
+    query = _filter_plant_and_date(
+        query, models.Shares, plant_name, date_from, date_to
+    )
+    if near is not None:
+        query = query.filter(geo.near_condition(db.get_bind(), models.Shares, near))
+    if after_id is not None:
+        query = query.filter(models.Shares.id > after_id)
+    query = query.order_by(models.Shares.id).limit(limit)
+    return (await db.execute(query)).all()
+
+
+async def get_requests(
+    db: AsyncSession,
+    requested_by: str | None = None,
+    plant_name: str | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    near: tuple[float, float, float] | None = None,
+    after_id: int | None = None,
+    limit: int = 100,
+    fields: list[str] | None = None,
+):
+    """
+    Get one page of plant requests, optionally filtered; see get_shares
+
+    :param db: database
+    :param requested_by: Only requests from this user
+    :param plant_name: Only requests whose plant name contains this text
+    :param date_from: Only requests posted on or after this date
+    :param date_to: Only requests posted on or before this date
+    :param near: Only requests within radius km of (latitude, longitude)
+    :param after_id: Only requests with an id greater than this (the cursor)
+    :param limit: Maximum number of requests to return
+    :param fields: Only these RequestModel fields; None for all
+    :returns: List of rows with the RequestModel fields, ordered by id
+    """
+    query = select(*_listing_columns(models.Requests, REQUEST_COLUMNS, fields))
+    if requested_by is not None:
+        query = query.filter(models.Requests.requested_by == requested_by)
+    query = _filter_plant_and_date(
+        query, models.Requests, plant_name, date_from, date_to
+    )
+    if near is not None:
+        query = query.filter(geo.near_condition(db.get_bind(), models.Requests, near))
+    if after_id is not None:
+        query = query.filter(models.Requests.id > after_id)
+    query = query.order_by(models.Requests.id).limit(limit)
+    return (await db.execute(query)).all()
+
+
+def _filter_plant_and_date(query, model, plant_name, date_from, date_to):
+    """Apply the plant name and date range filters shared by shares and requests"""
+    if plant_name:
+        query = query.filter(model.plant_name.icontains(plant_name, autoescape=True))
+    if date_from is not None:
+        query = query.filter(model.date >= date_from)
+    if date_to is not None:
+        query = query.filter(model.date <= date_to)
+    return query
+
+
 def authenticate_user(db:Session, username: str, password: str):
     """
     Authenticate and return a user
@@ -111,10 +719,56 @@ def authenticate_user(db:Session, username: str, password: str):
     user = get_user(db, username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    valid, new_hash = get_pwd_context().verify_and_update(
+        password, user.hashed_password
+    )
+    if not valid:
+        return False
+    if new_hash:
+        update_password_hash(db, user, new_hash)
+    return user
+
+
+async def authenticate_user_async(db: AsyncSession, username: str, password: str):
+    """
+    Authenticate and return a user, verifying the password in the
+    password pool; see authenticate_user
+
+    :param db: database
+    :param username: The username
+    :param password: The password, to be verified
+    :returns: The user, or False if authentication fails
+    """
+    user = await db.run_sync(get_user, username)
+    if not user:
+        # Take as long as a real check, so that the response time does
+        # not tell whether the username exists
+        await run_password_hashing(get_pwd_context().dummy_verify)
+        return False
+    valid, new_hash = await run_password_hashing(
+        get_pwd_context().verify_and_update, password, user.hashed_password
+    )
+    if not valid:
         return False
+    if new_hash:
+        await db.run_sync(update_password_hash, user, new_hash)
     return user
 
+
+def update_password_hash(db: Session, user: models.User, hashed_password: str):
+    """
+    Replace a user's password hash, e.g. with one using the current
+    bcrypt settings after a successful login
+
+    :param db: database
+    :param user: The user
+    :param hashed_password: The new hash of the same password
+    """
+    user.hashed_password = hashed_password
+    db.commit()
+    db.refresh(user)
+    user_cache.pop(user_cache_key(user.username))
+
 # def authenticate_user(fake_db, username: str, password: str):
 #     """
 #     Authenticate and return a user
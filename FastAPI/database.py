@@ -1,12 +1,389 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
 from sqlalchemy.orm import declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import config
+import geo
+
+URL_DATABASE = config.DATABASE_URL
+
+# Async drivers to use for the async engine, by database backend
+ASYNC_DRIVERS = {
+    "sqlite": "aiosqlite",
+    "postgresql": "asyncpg",
+}
+
+
+def to_async_url(url: str) -> str:
+    """
+    Get the URL of the same database through an asyncio driver
+
+    :param url: Database URL, e.g. sqlite:///./plants.db
+    :returns: The URL with an async driver, e.g. sqlite+aiosqlite:///./plants.db
+    """
+    url = make_url(url)
+    backend = url.get_backend_name()
+    url = url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}")
+    return url.render_as_string(hide_password=False)
+
+
+ASYNC_URL_DATABASE = config.ASYNC_DATABASE_URL or to_async_url(URL_DATABASE)
+
+
+def engine_options(url: str, is_async: bool = False) -> dict:
+    """
+    Get the create_engine arguments for a database: the engine profile
+
+    :param url: Database URL
+    :param is_async: Whether the engine is the async one
+    :returns: Keyword arguments for create_engine / create_async_engine
+    """
+    url = make_url(url)
+    options = {}
+    if url.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        if url.database in (None, "", ":memory:"):
+            # An in-memory database exists only within its one connection,
+            # so keep SQLAlchemy's default pool for it
+            return options
+        if is_async:
+            # aiosqlite engines do not pool connections by default
+            options["poolclass"] = AsyncAdaptedQueuePool
+    else:
+        # Check that a server connection is still alive before using it
+        options["pool_pre_ping"] = True
+    options.update(
+        pool_size=config.DB_POOL_SIZE,
+        max_overflow=config.DB_MAX_OVERFLOW,
+        pool_timeout=config.DB_POOL_TIMEOUT,
+        pool_recycle=config.DB_POOL_RECYCLE,
+    )
+    return options
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Set the configured pragmas (config.SQLITE_PRAGMAS) on a new SQLite
+    connection; used as a "connect" event listener
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in config.SQLITE_PRAGMAS.items():
+        if value:
+            cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
+
+
+def add_connect_listeners(sync_engine):
+    """Set up new SQLite connections of an engine: pragmas and functions"""
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+        event.listen(sync_engine, "connect", geo.register_functions)
+
+
+# Functions called with every engine made for a community's database
+# (see ShardEngines), e.g. to instrument it like the default engines
+new_engine_hooks = []
+
+
+# The community (see shards.py) whose database the current request
+# uses, or None for the default database. Sessions use the database of
+# the community current when they are made.
+current_community: ContextVar[str | None] = ContextVar(
+    "current_community", default=None
+)
+
+
+@contextlib.contextmanager
+def use_community(community: str | None):
+    """
+    Use a community's database for the sessions made within the block,
+    e.g. in background tasks that work through every community
+
+    :param community: The community id, or None for the default database
+    """
+    token = current_community.set(community)
+    try:
+        yield
+    finally:
+        current_community.reset(token)
+
+
+# Whether reads of the current request must see its client's recent
+# writes, so go to the default database rather than a read replica (see
+# replicas.py)
+read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+
+
+def create_community_task(coro, community: str | None) -> asyncio.Task:
+    """
+    Start a task using a community's database. The task does not get the
+    context variables of the caller (e.g. a request's metrics).
+
+    :param coro: The coroutine to run
+    :param community: The community id, or None for the default database
+    :returns: The task
+    """
+
+    def start():
+        current_community.set(community)
+        return asyncio.create_task(coro)
+
+    return contextvars.Context().run(start)
+
+
+class ShardEngines:
+    """
+    The engines of the communities' databases, made when first needed.
+    Only the most recently used config.SHARD_ENGINE_CACHE_SIZE are kept
+    open; the others are disposed of, closing their pooled connections.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._engines = OrderedDict()
+        self._lock = threading.Lock()
+        # Disposals of async engines in progress
+        self._disposals = set()
+
+    def url(self, community: str) -> str:
+        """Get the URL of a community's database"""
+        return config.SHARD_URL_TEMPLATE.format(community=community)
+
+    def get(self, community: str) -> tuple:
+        """
+        Get the engines of a community's database
+
+        :param community: The community id
+        :returns: (blocking engine, async engine)
+        """
+        with self._lock:
+            engines = self._engines.get(community)
+            if engines is None:
+                engines = self._engines[community] = make_engines(self.url(community))
+                for sync_engine in (engines[0], engines[1].sync_engine):
+                    for hook in new_engine_hooks:
+                        hook(sync_engine)
+            self._engines.move_to_end(community)
+            evicted = []
+            while len(self._engines) > self.maxsize:
+                evicted.append(self._engines.popitem(last=False)[1])
+        for engines in evicted:
+            self._dispose(engines)
+        return engines
+
+    def _dispose(self, engines: tuple):
+        """Close the pooled connections of evicted engines"""
+        sync_engine, async_engine = engines
+        sync_engine.dispose()
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return  # there is no loop to close the async connections in
+        task = loop.create_task(async_engine.dispose())
+        self._disposals.add(task)
+        task.add_done_callback(self._disposals.discard)
+
+    async def dispose_all(self):
+        """Close all the engines; from the app lifespan"""
+        with self._lock:
+            engines = list(self._engines.values())
+            self._engines.clear()
+        for sync_engine, async_engine in engines:
+            sync_engine.dispose()
+            await async_engine.dispose()
+        if self._disposals:
+            await asyncio.gather(*self._disposals, return_exceptions=True)
+
 
-URL_DATABASE = "sqlite:///./plants.db"
+def make_engines(url: str) -> tuple:
+    """
+    Make the blocking and async engines of a database
 
-engine = create_engine(URL_DATABASE, connect_args={"check_same_thread": False})
+    :param url: Database URL of the blocking engine
+    :returns: (blocking engine, async engine)
+    """
+    async_url = to_async_url(url)
+    sync_engine = create_engine(url, **engine_options(url))
+    async_engine = create_async_engine(
+        async_url, **engine_options(async_url, is_async=True)
+    )
+    add_connect_listeners(sync_engine)
+    add_connect_listeners(async_engine.sync_engine)
+    return sync_engine, async_engine
+
+
+shard_engines = ShardEngines(config.SHARD_ENGINE_CACHE_SIZE)
+
+
+def set_query_only(dbapi_connection, connection_record):
+    """
+    Refuse writes on a new connection to an SQLite read replica; used as
+    a "connect" event listener
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def set_read_only_transactions(dbapi_connection, connection_record):
+    """
+    Refuse writes on a new connection to a server read replica; used as
+    a "connect" event listener
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute("SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY")
+    cursor.close()
+    # Or the setting would be rolled back with the connection's transaction
+    dbapi_connection.commit()
+
+
+class ReadEngines:
+    """
+    The engines of the read replicas of the default database
+    (config.READ_REPLICA_URLS), used in turn
+    """
+
+    def __init__(self, urls: list[str]):
+        self.urls = urls
+        self.engines = [make_engines(url) for url in urls]
+        for sync_engine, async_engine in self.engines:
+            for replica_engine in (sync_engine, async_engine.sync_engine):
+                if replica_engine.dialect.name == "sqlite":
+                    event.listen(replica_engine, "connect", set_query_only)
+                else:
+                    event.listen(replica_engine, "connect", set_read_only_transactions)
+        self._turn = itertools.count()
+
+    def choose(self) -> tuple | None:
+        """
+        Get the engines of the next replica
+
+        :returns: (blocking engine, async engine); None if there are no replicas
+        """
+        if not self.engines:
+            return None
+        return self.engines[next(self._turn) % len(self.engines)]
+
+    async def dispose_all(self):
+        """Close the replicas' pooled connections; from the app lifespan"""
+        for sync_engine, async_engine in self.engines:
+            sync_engine.dispose()
+            await async_engine.dispose()
+
+
+read_engines = ReadEngines(config.READ_REPLICA_URLS)
+
+
+class ShardSession(Session):
+    """
+    Session on the database of the community that was current when it
+    was made: the default database (its bind) or the community's own
+    """
+
+    # Whether the session is the sync part of an AsyncSession
+    is_async = False
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.community = current_community.get()
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.community is None:
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        sync_engine, async_engine = shard_engines.get(self.community)
+        return async_engine.sync_engine if self.is_async else sync_engine
+
+
+class AsyncShardSession(ShardSession):
+    """ShardSession for AsyncSession, on the async engines"""
+
+    is_async = True
+
+
+class ReadSession(ShardSession):
+    """
+    Session for reads that may be a moment behind the latest writes: on
+    a read replica of the default database, if there are any and the
+    request need not see its own writes. The communities' databases
+    have no replicas.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica = None
+        if self.community is None and not read_from_primary.get():
+            self.replica = read_engines.choose()
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.replica is None:
+            return super().get_bind(mapper, clause=clause, **kwargs)
+        sync_engine, async_engine = self.replica
+        return async_engine.sync_engine if self.is_async else sync_engine
+
+
+class AsyncReadSession(ReadSession):
+    """ReadSession for AsyncSession, on the async engines"""
+
+    is_async = True
+
+
+def get_engine():
+    """Get the blocking engine of the current community's database"""
+    community = current_community.get()
+    if community is None:
+        return engine
+    return shard_engines.get(community)[0]
+
+
+def get_async_engine():
+    """Get the async engine of the current community's database"""
+    community = current_community.get()
+    if community is None:
+        return async_engine
+    return shard_engines.get(community)[1]
+
+
+# Blocking engine and sessions, for scripts, migrations and the plain
+# def endpoints (which FastAPI runs in a thread pool)
+engine = create_engine(URL_DATABASE, **engine_options(URL_DATABASE))
 
 # SessionLocal = sessionmaker(autocomit=False, autoflush=False, bind=engine)
-SessionLocal = sessionmaker(autoflush=False, bind=engine)
+SessionLocal = sessionmaker(autoflush=False, bind=engine, class_=ShardSession)
+# Sessions for reads only, possibly from a replica (see ReadSession)
+ReadSessionLocal = sessionmaker(autoflush=False, bind=engine, class_=ReadSession)
+
+# Async engine and sessions, for the async def endpoints, so that their
+# queries do not block the event loop. Objects stay loaded after a
+# commit (expire_on_commit=False), since reloading expired attributes
+# would need an await.
+async_engine = create_async_engine(
+    ASYNC_URL_DATABASE, **engine_options(ASYNC_URL_DATABASE, is_async=True)
+)
+
+AsyncSessionLocal = async_sessionmaker(
+    async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+    sync_session_class=AsyncShardSession,
+)
+AsyncReadSessionLocal = async_sessionmaker(
+    async_engine,
+    autoflush=False,
+    expire_on_commit=False,
+    sync_session_class=AsyncReadSession,
+)
+
+for sync_engine in (engine, async_engine.sync_engine):
+    add_connect_listeners(sync_engine)
 
 Base = declarative_base()
@@ -0,0 +1,366 @@
+"""
+Streaming export and import of the shares, requests and users tables,
+as NDJSON (one JSON object per line) or CSV
+
+Rows are read with a server-side cursor, BATCH_SIZE at a time, and
+written out as they are read; imports are read a line at a time and
+inserted BATCH_SIZE rows per INSERT. So memory use does not grow with
+the size of the table. An import is one transaction: if any row is not
+valid, nothing is imported.
+
+Exported rows keep their ids, so a dump can be restored into an empty
+database. Imported shares and requests are matched as they are
+inserted (restore shares and requests in either order).
+
+The same functions back the /export and /import endpoints, open only
+to the users in config.DUMP_USERNAMES, and the command line:
+
+    python dump.py export shares --format csv > shares.csv
+    python dump.py import shares shares.csv
+"""
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import sys
+from collections.abc import Callable
+from dataclasses import dataclass
+from datetime import date
+from types import SimpleNamespace
+
+from pydantic import ValidationError
+from sqlalchemy import insert, select, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+import matching
+import migrations
+import models
+import schemas
+import serialize
+import stats
+import database
+from database import AsyncSessionLocal, get_async_engine, get_engine
+
+# Rows read from the cursor, or inserted, at a time
+BATCH_SIZE = 1000
+
+# Bytes read from a file at a time
+CHUNK_SIZE = 64 * 1024
+
+FORMATS = ("ndjson", "csv")
+MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+@dataclass
+class DumpTable:
+    """How a table is exported and imported"""
+    model: type
+    # Pydantic model validating imported rows
+    schema: type
+    columns: list[str]
+    # matching.match_shares or match_requests for imported rows, if any
+    match: Callable | None = None
+
+
+TABLES = {
+    "shares": DumpTable(
+        model=models.Shares,
+        schema=schemas.ShareDump,
+        columns=list(schemas.ShareDump.model_fields),
+        match=matching.match_shares,
+    ),
+    "requests": DumpTable(
+        model=models.Requests,
+        schema=schemas.RequestModel,
+        columns=list(schemas.RequestModel.model_fields),
+        match=matching.match_requests,
+    ),
+    "users": DumpTable(
+        model=models.User,
+        schema=schemas.User,
+        columns=list(schemas.User.model_fields),
+    ),
+}
+
+
+def to_csv_value(value):
+    """Convert a column value to CSV text: None as empty, bools as true/false"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return serialize.to_json_default(value) if isinstance(value, date) else value
+
+
+def format_ndjson(columns: list[str], rows) -> str:
+    """
+    Format rows as NDJSON
+
+    :param columns: The column names
+    :param rows: The rows, as tuples in column order
+    :returns: One JSON object per row, each ending with a newline
+    """
+    return "".join(
+        serialize.dumps(dict(zip(columns, row))).decode() + "\n" for row in rows
+    )
+
+
+def format_csv(rows) -> str:
+    """
+    Format rows as CSV
+
+    :param rows: The rows, as tuples
+    :returns: The CSV lines
+    """
+    out = io.StringIO()
+    writer = csv.writer(out, lineterminator="\n")
+    writer.writerows([to_csv_value(value) for value in row] for row in rows)
+    return out.getvalue()
+
+
+async def export_rows(name: str, fmt: str = "ndjson", columns: list[str] | None = None):
+    """
+    Export a table, streaming it from a server-side cursor
+
+    :param name: "shares", "requests" or "users"
+    :param fmt: "ndjson" or "csv"
+    :param columns: The columns to export; by default all of them
+    :returns: Async generator of text chunks, about BATCH_SIZE rows each
+    """
+    table = TABLES[name]
+    columns = columns or table.columns
+    query = (
+        select(*(getattr(table.model, column) for column in columns))
+        .order_by(table.model.id)
+        .execution_options(yield_per=BATCH_SIZE)
+    )
+    if fmt == "csv":
+        yield format_csv([columns])
+    async with get_async_engine().connect() as conn:
+        result = await conn.stream(query)
+        async for rows in result.partitions():
+            if fmt == "csv":
+                yield format_csv(rows)
+            else:
+                yield format_ndjson(columns, rows)
+
+
+async def read_lines(chunks):
+    """
+    Split a stream of bytes into lines
+
+    :param chunks: Async iterable of bytes
+    :returns: Async generator of the lines, decoded, with their newlines
+    """
+    pending = b""
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            yield line.decode() + "\n"
+    if pending:
+        yield pending.decode()
+
+
+async def parse_records(lines, fmt: str):
+    """
+    Parse the records of an NDJSON or CSV import
+
+    :param lines: Async iterable of lines
+    :param fmt: "ndjson" or "csv"; CSV needs a header line of column names
+    :returns: Async generator of (line number, record dict)
+    :raises ValueError if a line is not valid JSON
+    """
+    header = None
+    record = ""
+    start = 0
+    number = 0
+    async for line in lines:
+        number += 1
+        if fmt == "ndjson":
+            if line.strip():
+                try:
+                    yield number, json.loads(line)
+                except ValueError as exc:
+                    raise ValueError(f"line {number}: {exc}") from exc
+            continue
+        # A quoted CSV field may span lines; the record is complete when
+        # its quotes are balanced
+        if not record:
+            start = number
+        record += line
+        if record.count('"') % 2:
+            continue
+        if record.strip():
+            values = next(csv.reader([record]))
+            if header is None:
+                header = values
+            else:
+                yield start, dict(zip(header, values))
+        record = ""
+
+
+async def import_rows(db: AsyncSession, name: str, records) -> int:
+    """
+    Import rows into a table, BATCH_SIZE per INSERT, in one transaction.
+    Imported shares and requests are matched, counted in the
+    statistics (see stats.py) and recorded in the change log a batch at
+    a time, so that change feed subscribers see them and cached listings
+    are not served (see crud.record_changes). For users, the table
+    version is bumped once at the end.
+
+    :param db: database
+    :param name: "shares", "requests" or "users"
+    :param records: Async iterable of (line number, record dict), from
+                    parse_records
+    :returns: The number of rows imported
+    :raises ValueError if a record is not valid, naming its line; nothing
+            is imported then
+    """
+    table = TABLES[name]
+    count = 0
+    batch = []
+    async for number, record in records:
+        try:
+            row = table.schema.model_validate(record)
+        except ValidationError as exc:
+            await db.rollback()
+            raise ValueError(f"line {number}: {exc}") from exc
+        batch.append(row.model_dump())
+        if len(batch) == BATCH_SIZE:
+            count += await insert_batch(db, table, batch)
+            batch = []
+    count += await insert_batch(db, table, batch)
+    if not count:
+        return 0
+    if table.match is None:
+        await crud.bump_table_version(db, name)
+    if db.get_bind().dialect.name == "postgresql":
+        # Rows were inserted with their ids; move the id sequence past them
+        await db.execute(
+            text(
+                f"SELECT setval(pg_get_serial_sequence('{name}', 'id'), "
+                f"(SELECT max(id) FROM {name}))"
+            )
+        )
+    await db.commit()
+    return count
+
+
+async def insert_batch(db: AsyncSession, table: DumpTable, rows: list[dict]) -> int:
+    """Insert, match and record one batch of imported rows; returns how many"""
+    if not rows:
+        return 0
+    if table.match is not None:
+        for row in rows:
+            row["plant_key"] = models.normalize_plant_name(row["plant_name"])
+    await db.execute(insert(table.model), rows)
+    if table.match is not None:
+        await db.run_sync(table.match, [SimpleNamespace(**row) for row in rows])
+        await stats.record_rows(db, table.model.__tablename__, rows, 1)
+        await crud.record_changes(
+            db,
+            table.model.__tablename__,
+            "create",
+            [(row["id"], change_data(row)) for row in rows],
+        )
+    return len(rows)
+
+
+def change_data(row: dict) -> dict:
+    """
+    The data of an imported row in the change log: as in the listings,
+    with the URL of a share's photo's thumbnail rather than its hash
+    """
+    data = {
+        key: value
+        for key, value in row.items()
+        if key not in ("plant_key", "photo_hash")
+    }
+    data["date"] = row["date"].isoformat()
+    if "photo_hash" in row:
+        data["thumbnail_url"] = (
+            models.thumbnail_url(row["photo_hash"]) if row["photo_hash"] else None
+        )
+    return data
+
+
+async def spool(chunks, file):
+    """
+    Write a stream of bytes to a file, to its end, and rewind the file
+
+    :param chunks: Async iterable of bytes, e.g. an uploaded body
+    :param file: File open for writing and reading bytes
+    """
+    async for chunk in chunks:
+        await asyncio.to_thread(file.write, chunk)
+    await asyncio.to_thread(file.seek, 0)
+
+
+async def read_chunks(file):
+    """Read an open file as an async stream of bytes"""
+    while chunk := await asyncio.to_thread(file.read, CHUNK_SIZE):
+        yield chunk
+
+
+async def file_chunks(path: str):
+    """Read a file (or standard input, for "-") as an async stream of bytes"""
+    with open(sys.stdin.fileno() if path == "-" else path, "rb", closefd=path != "-") as f:
+        async for chunk in read_chunks(f):
+            yield chunk
+
+
+async def run_export(name: str, fmt: str):
+    """Export a table to standard output"""
+    async for chunk in export_rows(name, fmt):
+        sys.stdout.write(chunk)
+    await get_async_engine().dispose()
+
+
+async def run_import(name: str, path: str, fmt: str) -> int:
+    """Import a table from a file, creating the database if needed"""
+    migrations.upgrade(get_engine())
+    async with AsyncSessionLocal() as db:
+        count = await import_rows(db, name, parse_records(read_lines(file_chunks(path)), fmt))
+    await get_async_engine().dispose()
+    return count
+
+
+def main():
+    """Command line entry point"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    export_parser = commands.add_parser("export", help="Write a table to standard output")
+    export_parser.add_argument("table", choices=TABLES)
+    export_parser.add_argument("--format", choices=FORMATS, default="ndjson")
+    export_parser.add_argument("--community", help="The community's database (see shards.py)")
+    import_parser = commands.add_parser("import", help="Read a table from a file")
+    import_parser.add_argument("table", choices=TABLES)
+    import_parser.add_argument("file", help="File to read, or - for standard input")
+    import_parser.add_argument(
+        "--format", choices=FORMATS, help="Default: from the file extension, else ndjson"
+    )
+    import_parser.add_argument("--community", help="The community's database (see shards.py)")
+    args = parser.parse_args()
+    if args.community:
+        database.current_community.set(args.community)
+
+    if args.command == "export":
+        asyncio.run(run_export(args.table, args.format))
+        return
+    fmt = args.format or ("csv" if args.file.endswith(".csv") else "ndjson")
+    try:
+        count = asyncio.run(run_import(args.table, args.file, fmt))
+    except ValueError as exc:
+        sys.exit(f"Nothing imported: {exc}")
+    except IntegrityError as exc:
+        sys.exit(f"Nothing imported: {exc.orig}")
+    print(f"Imported {count} {args.table}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
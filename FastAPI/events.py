@@ -0,0 +1,356 @@
+"""
+Change feed of shares and requests, as Server-Sent Events
+
+Every change to a share or request is logged in the events
+table, in the same transaction as the change (see crud.record_change).
+A single broadcaster task per process reads new events from the log and
+hands them to every connected client's queue, so the cost of a change
+does not grow with the number of clients. The endpoints that make
+changes wake the broadcaster right away; changes made by other worker
+processes are picked up by polling the log every
+config.EVENT_POLL_INTERVAL seconds. Each community's database (see
+shards.py) has its own log, and its own broadcaster, which only runs
+while it has clients: it starts when the first one connects and stops
+when the last one leaves, so a database nobody follows is not polled.
+While no broadcaster runs, the log is trimmed after every
+TRIM_EVERY_CHANGES changes made by the process instead.
+
+Each event's id is its id in the log, so a client that reconnects with
+Last-Event-ID gets the events it missed, as long as they are still in
+the log (the most recent config.EVENT_LOG_SIZE events). If they are
+not, it gets a "reset" event, meaning it should re-read the listings.
+"""
+
+import asyncio
+import contextlib
+import json
+import logging
+
+from sqlalchemy import delete, func, select
+
+import config
+import database
+import models
+from database import AsyncSessionLocal
+
+logger = logging.getLogger("plantswap.events")
+
+# Events read from the log per query
+BATCH_SIZE = 500
+
+# Changes after which the log is trimmed, while no broadcaster runs
+TRIM_EVERY_CHANGES = 100
+
+# Wait, in seconds, before a broadcaster reads the log again after
+# reading it failed; it doubles with each failure in a row, up to the max
+RETRY_DELAY = 1
+MAX_RETRY_DELAY = 30
+
+
+def format_event(event: models.Event) -> str:
+    """
+    Format a logged change as a Server-Sent Event
+
+    :param event: The logged change
+    :returns: The event in text/event-stream format
+    """
+    payload = {
+        "table": event.table_name,
+        "op": event.op,
+        "id": event.row_id,
+        "data": event.data,
+    }
+    return (
+        f"id: {event.id}\n"
+        f"event: {event.table_name}.{event.op}\n"
+        f"data: {json.dumps(payload, separators=(',', ':'))}\n\n"
+    )
+
+
+async def read_events(after_id: int, limit: int = BATCH_SIZE) -> list[models.Event]:
+    """
+    Read logged changes
+
+    :param after_id: Only changes with an id greater than this
+    :param limit: Most changes to read
+    :returns: The changes, oldest first
+    """
+    async with AsyncSessionLocal() as db:
+        query = (
+            select(models.Event)
+            .filter(models.Event.id > after_id)
+            .order_by(models.Event.id)
+            .limit(limit)
+        )
+        return (await db.scalars(query)).all()
+
+
+async def get_event_id_range() -> tuple[int, int]:
+    """
+    Get the ids of the oldest and newest logged changes
+
+    :returns: (oldest id, newest id); (0, 0) if there are none
+    """
+    async with AsyncSessionLocal() as db:
+        oldest, newest = (
+            await db.execute(select(func.min(models.Event.id), func.max(models.Event.id)))
+        ).one()
+    return oldest or 0, newest or 0
+
+
+class Subscription:
+    """A connected client's queue of changes to send it"""
+
+    def __init__(self):
+        self.queue = asyncio.Queue(maxsize=config.EVENT_QUEUE_SIZE)
+        # Set when the queue overflowed and the client no longer gets changes
+        self.dropped = False
+
+
+class Broadcaster:
+    """
+    Reads new changes from the log of a database and passes them on to
+    the queues of its connected clients, while it has any
+    """
+
+    def __init__(self, community: str | None = None):
+        self.community = community
+        self._subscriptions: set[Subscription] = set()
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self._lock: asyncio.Lock | None = None
+        self._last_id = 0
+        self._trimmed_at = 0
+
+    @property
+    def running(self) -> bool:
+        """Whether the broadcaster task is running"""
+        return self._task is not None
+
+    async def _start(self):
+        """Start the broadcaster task, from the newest change in the log"""
+        self._wakeup = asyncio.Event()
+        _, self._last_id = await get_event_id_range()
+        self._trimmed_at = self._last_id
+        self._task = database.create_community_task(self._run(), self.community)
+
+    async def stop(self):
+        """Stop the broadcaster task; from Broadcasters.stop"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    def publish(self):
+        """Tell the broadcaster that changes were just logged"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    async def subscribe(self) -> Subscription:
+        """
+        Start passing changes on to a new client, starting the
+        broadcaster task if it is not running. The task has read the
+        newest id in the log by the time this returns, so it passes on
+        every change the client does not read from the log itself.
+        """
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._task is None:
+                await self._start()
+            subscription = Subscription()
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        """Stop passing changes on to a client"""
+        self._subscriptions.discard(subscription)
+        if not self._subscriptions:
+            # Wake the task so that it stops
+            self.publish()
+
+    async def _run(self):
+        """
+        Pass new changes on until the last client leaves, or cancelled.
+        If reading or trimming the log fails, wait a while (longer after
+        each failure in a row) and carry on.
+        """
+        retry_delay = RETRY_DELAY
+        try:
+            while True:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(
+                        self._wakeup.wait(), timeout=config.EVENT_POLL_INTERVAL
+                    )
+                self._wakeup.clear()
+                if not self._subscriptions:
+                    # Nothing is awaited between the check and this, so a
+                    # client subscribing from now on starts a new task
+                    self._task = None
+                    return
+                try:
+                    await self._pass_on()
+                    retry_delay = RETRY_DELAY
+                except Exception:
+                    # e.g. the database was locked for too long
+                    logger.exception(
+                        "Reading the change log of %s failed",
+                        self.community or "the default database",
+                    )
+                    await asyncio.sleep(retry_delay)
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+        finally:
+            # However the task ends, a new client starts a new one
+            if self._task is asyncio.current_task():
+                self._task = None
+
+    async def _pass_on(self):
+        """Pass the changes logged since the last one passed on"""
+        while events := await read_events(self._last_id):
+            self._last_id = events[-1].id
+            for event in events:
+                self._send(event)
+            if len(events) < BATCH_SIZE:
+                break
+        # Trim the log now and then, rather than after every change
+        if self._last_id - self._trimmed_at >= max(config.EVENT_LOG_SIZE // 10, 1):
+            await trim_log(self._last_id)
+            self._trimmed_at = self._last_id
+
+    def _send(self, event: models.Event):
+        """Put a change on every queue, dropping clients that cannot keep up"""
+        for subscription in list(self._subscriptions):
+            try:
+                subscription.queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # The client can reconnect with Last-Event-ID to catch up
+                subscription.dropped = True
+                self._subscriptions.discard(subscription)
+
+
+async def trim_log(newest_id: int):
+    """
+    Delete all but the most recent config.EVENT_LOG_SIZE logged changes
+
+    :param newest_id: Id of the newest change
+    """
+    cutoff = newest_id - config.EVENT_LOG_SIZE
+    if cutoff <= 0:
+        return
+    async with AsyncSessionLocal() as db:
+        await db.execute(delete(models.Event).filter(models.Event.id <= cutoff))
+        await db.commit()
+
+
+async def trim_to_size():
+    """Trim the log of the current community's database; see trim_log"""
+    _, newest_id = await get_event_id_range()
+    await trim_log(newest_id)
+
+
+class Broadcasters:
+    """The broadcaster of each database, by community"""
+
+    def __init__(self):
+        self._broadcasters: dict[str | None, Broadcaster] = {}
+        # Changes published while no broadcaster ran, by community
+        self._untrimmed: dict[str | None, int] = {}
+        self._trim_tasks: set[asyncio.Task] = set()
+
+    def get(self) -> Broadcaster:
+        """
+        Get the broadcaster of the current community's database; it
+        runs once a client subscribes
+
+        :returns: The broadcaster
+        """
+        community = database.current_community.get()
+        broadcaster = self._broadcasters.get(community)
+        if broadcaster is None:
+            broadcaster = self._broadcasters[community] = Broadcaster(community)
+        return broadcaster
+
+    def publish(self):
+        """
+        Tell the broadcaster of the current community's database that
+        changes were just logged. If it is not running, no client needs
+        them, but the log is trimmed now and then.
+        """
+        community = database.current_community.get()
+        broadcaster = self._broadcasters.get(community)
+        if broadcaster is not None and broadcaster.running:
+            broadcaster.publish()
+            return
+        untrimmed = self._untrimmed.get(community, 0) + 1
+        if untrimmed < TRIM_EVERY_CHANGES:
+            self._untrimmed[community] = untrimmed
+            return
+        self._untrimmed[community] = 0
+        task = database.create_community_task(trim_to_size(), community)
+        self._trim_tasks.add(task)
+        task.add_done_callback(self._trim_tasks.discard)
+
+    async def stop(self):
+        """Stop all the broadcasters, and wait for trimming; from the app lifespan"""
+        broadcasters = list(self._broadcasters.values())
+        self._broadcasters.clear()
+        for broadcaster in broadcasters:
+            await broadcaster.stop()
+        await asyncio.gather(*self._trim_tasks, return_exceptions=True)
+
+
+broadcasters = Broadcasters()
+
+
+async def stream(request, last_event_id: int | None, tables: set[str] | None = None):
+    """
+    Generate the change feed for one client
+
+    :param request: The client's request, to notice when it disconnects
+    :param last_event_id: Id of the last event the client saw, to resume
+                          after it; None to start from now
+    :param tables: Only changes to these tables; None for all
+    :returns: Async generator of text/event-stream chunks
+    """
+    # Subscribe before reading the log, so nothing falls in between.
+    # Reads are shielded so that a client disconnecting mid-query does
+    # not cancel the query and break its pooled connection.
+    broadcaster = broadcasters.get()
+    subscription = await broadcaster.subscribe()
+    try:
+        oldest, newest = await asyncio.shield(get_event_id_range())
+        if last_event_id is None:
+            last_id = newest
+        else:
+            last_id = last_event_id
+            if last_id < oldest - 1 or last_id > newest:
+                # The missed changes are no longer in the log (or the id
+                # is not from this log)
+                yield f"id: {newest}\nevent: reset\ndata: {{}}\n\n"
+                last_id = newest
+            while events := await asyncio.shield(read_events(last_id)):
+                for event in events:
+                    if tables is None or event.table_name in tables:
+                        yield format_event(event)
+                last_id = events[-1].id
+
+        yield ": connected\n\n"
+        while not await request.is_disconnected():
+            if subscription.dropped and subscription.queue.empty():
+                # Fell behind; the client reconnects and resumes from the log
+                break
+            try:
+                event = await asyncio.wait_for(
+                    subscription.queue.get(), timeout=config.EVENT_KEEPALIVE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event.id <= last_id:
+                continue
+            last_id = event.id
+            if tables is None or event.table_name in tables:
+                yield format_event(event)
+    finally:
+        broadcaster.unsubscribe(subscription)
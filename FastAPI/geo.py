@@ -0,0 +1,221 @@
+"""
+Proximity search of shares and requests
+
+Shares, requests and users may have a location (latitude and longitude,
+in degrees). Located shares and requests are indexed in SQLite R*Tree
+tables (shares_geo and requests_geo), kept in sync with them by
+triggers, like the search index (see search.py).
+
+A "near" filter (a point and a radius in km) is answered in two steps:
+the R*Tree finds the rows inside the bounding box of the circle, which
+only touches the index pages around the point however many rows there
+are, and then the exact great-circle distance of just those rows is
+checked, with the distance_km SQL function registered on every SQLite
+connection.
+
+On databases without R*Tree support (e.g. Postgres) the bounding box is
+checked on the latitude and longitude columns instead, and the distance
+with SQL math functions.
+"""
+
+import functools
+import math
+import sqlite3
+
+from sqlalchemy import Connection, and_, column, func, or_, select, table
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = 2 * math.pi * EARTH_RADIUS_KM / 360
+
+# The located tables, and their index tables
+INDEXED = {
+    "shares": "shares_geo",
+    "requests": "requests_geo",
+}
+
+
+@functools.cache
+def rtree_compiled() -> bool:
+    """Whether the SQLite library was built with R*Tree support"""
+    with sqlite3.connect(":memory:") as conn:
+        options = {row[0] for row in conn.execute("PRAGMA compile_options")}
+    return "ENABLE_RTREE" in options
+
+
+def rtree_supported(bind) -> bool:
+    """
+    Whether the database supports R*Tree indexes
+
+    :param bind: Connection, engine or session
+    :returns: True if it does
+    """
+    return bind.dialect.name == "sqlite" and rtree_compiled()
+
+
+def distance_km(lat1, lon1, lat2, lon2):
+    """
+    Great-circle distance between two points (haversine formula)
+
+    :param lat1: Latitude of the first point, in degrees
+    :param lon1: Longitude of the first point, in degrees
+    :param lat2: Latitude of the second point, in degrees
+    :param lon2: Longitude of the second point, in degrees
+    :returns: The distance in km; None if a coordinate is missing
+    """
+    if None in (lat1, lon1, lat2, lon2):
+        return None
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def register_functions(dbapi_connection, connection_record):
+    """
+    Register distance_km on a new SQLite connection; used as a "connect"
+    event listener
+    """
+    dbapi_connection.create_function("distance_km", 4, distance_km, deterministic=True)
+
+
+def bounding_boxes(lat: float, lon: float, radius_km: float) -> list[tuple]:
+    """
+    Get the bounding box of a circle, split in two where it crosses the
+    180th meridian
+
+    :param lat: Latitude of the center, in degrees
+    :param lon: Longitude of the center, in degrees
+    :param radius_km: Radius in km
+    :returns: List of (min_lat, max_lat, min_lon, max_lon)
+    """
+    dlat = radius_km / KM_PER_DEGREE
+    min_lat, max_lat = lat - dlat, lat + dlat
+    if min_lat <= -90 or max_lat >= 90:
+        # The circle covers a pole, so every longitude
+        return [(max(min_lat, -90), min(max_lat, 90), -180, 180)]
+    # Longitude degrees are shortest at the latitude farthest from the equator
+    dlon = dlat / math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if dlon >= 180:
+        return [(min_lat, max_lat, -180, 180)]
+    min_lon, max_lon = lon - dlon, lon + dlon
+    if min_lon < -180:
+        return [(min_lat, max_lat, min_lon + 360, 180), (min_lat, max_lat, -180, max_lon)]
+    if max_lon > 180:
+        return [(min_lat, max_lat, min_lon, 180), (min_lat, max_lat, -180, max_lon - 360)]
+    return [(min_lat, max_lat, min_lon, max_lon)]
+
+
+def create_index(conn: Connection):
+    """
+    Create the location indexes and the triggers that keep them in sync,
+    if they do not exist yet; existing rows are indexed by rebuild_index
+
+    :param conn: Connection, in a transaction
+    """
+    if not rtree_supported(conn):
+        return
+    for name, index in INDEXED.items():
+        conn.exec_driver_sql(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {index} "
+            "USING rtree(id, min_lat, max_lat, min_lon, max_lon)"
+        )
+        new_row = "new.id, new.latitude, new.latitude, new.longitude, new.longitude"
+        located = "new.latitude IS NOT NULL AND new.longitude IS NOT NULL"
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {name}_geo_insert "
+            f"AFTER INSERT ON {name} WHEN {located} BEGIN "
+            f"INSERT INTO {index} VALUES ({new_row}); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {name}_geo_delete "
+            f"AFTER DELETE ON {name} BEGIN "
+            f"DELETE FROM {index} WHERE id = old.id; "
+            "END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {name}_geo_update "
+            f"AFTER UPDATE OF latitude, longitude ON {name} BEGIN "
+            f"DELETE FROM {index} WHERE id = old.id; "
+            f"INSERT INTO {index} SELECT {new_row} WHERE {located}; "
+            "END"
+        )
+
+
+def rebuild_index(conn: Connection):
+    """
+    Re-index the locations of all shares and requests
+
+    :param conn: Connection, in a transaction
+    """
+    if not rtree_supported(conn):
+        return
+    for name, index in INDEXED.items():
+        conn.exec_driver_sql(f"DELETE FROM {index}")
+        conn.exec_driver_sql(
+            f"INSERT INTO {index} "
+            f"SELECT id, latitude, latitude, longitude, longitude FROM {name} "
+            "WHERE latitude IS NOT NULL AND longitude IS NOT NULL"
+        )
+
+
+def near_condition(bind, model, near: tuple[float, float, float]):
+    """
+    Get the condition for rows of shares or requests being near a point
+
+    :param bind: Connection, engine or session, for its database type
+    :param model: models.Shares or models.Requests
+    :param near: (latitude, longitude, radius in km)
+    :returns: SQL condition, true for the rows within the radius
+    """
+    lat, lon, radius_km = near
+    boxes = bounding_boxes(lat, lon, radius_km)
+    if rtree_supported(bind):
+        index = table(
+            INDEXED[model.__tablename__],
+            column("id"),
+            column("min_lat"),
+            column("max_lat"),
+            column("min_lon"),
+            column("max_lon"),
+        )
+        in_boxes = model.id.in_(
+            select(index.c.id).where(
+                or_(
+                    *(
+                        and_(
+                            index.c.max_lat >= min_lat,
+                            index.c.min_lat <= max_lat,
+                            index.c.max_lon >= min_lon,
+                            index.c.min_lon <= max_lon,
+                        )
+                        for min_lat, max_lat, min_lon, max_lon in boxes
+                    )
+                )
+            )
+        )
+        distance = func.distance_km(model.latitude, model.longitude, lat, lon)
+    else:
+        in_boxes = or_(
+            *(
+                and_(
+                    model.latitude.between(min_lat, max_lat),
+                    model.longitude.between(min_lon, max_lon),
+                )
+                for min_lat, max_lat, min_lon, max_lon in boxes
+            )
+        )
+        distance = _sql_distance_km(model.latitude, model.longitude, lat, lon)
+    return and_(in_boxes, distance <= radius_km)
+
+
+def _sql_distance_km(lat1, lon1, lat2: float, lon2: float):
+    """distance_km as an SQL expression, for databases with math functions"""
+    lat1, lon1 = func.radians(lat1), func.radians(lon1)
+    lat2, lon2 = math.radians(lat2), math.radians(lon2)
+    a = func.power(func.sin((lat1 - lat2) / 2), 2) + math.cos(lat2) * func.cos(
+        lat1
+    ) * func.power(func.sin((lon1 - lon2) / 2), 2)
+    return 2 * EARTH_RADIUS_KM * func.asin(func.least(1.0, func.sqrt(a)))
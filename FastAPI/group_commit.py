@@ -0,0 +1,172 @@
+"""
+Group commit of new shares and requests
+
+Normally each POST /shares/ or /requests/ commits its own transaction.
+On SQLite that is a write lock and a sync to disk per row, so under a
+burst of posts the writes queue behind each other. With
+config.WRITE_BATCHING on, the endpoints instead hand their rows to a
+single writer task per process, which writes everything queued in one
+transaction (see crud.create_rows): it waits up to
+config.WRITE_BATCH_DELAY seconds after the first row for more, up to
+config.WRITE_BATCH_MAX_ROWS rows, and rows that arrive while a batch is
+being written go in the next one. Each caller awaits its own row, which
+is only returned once its batch is committed, so a response still means
+the row is stored.
+
+If a batch fails, its rows are written one at a time, so that only the
+callers of the rows that fail get the error. Rows of different
+communities (see shards.py) go to their own databases, so they are
+written in separate transactions.
+"""
+
+import asyncio
+import contextlib
+import logging
+
+import config
+import crud
+import database
+import schemas
+from database import AsyncSessionLocal
+
+logger = logging.getLogger("plantswap.group_commit")
+
+# How a batch of rows of each table is written
+CREATORS = {
+    "shares": crud.create_share_rows,
+    "requests": crud.create_request_rows,
+}
+
+
+class GroupCommitWriter:
+    """Writes the queued new shares and requests, a batch per transaction"""
+
+    def __init__(self):
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """Start the writer task; from the app lifespan"""
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Write the rows still queued, then stop; from the app lifespan"""
+        if self._task is not None:
+            self._queue.put_nowait(None)
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    @property
+    def running(self) -> bool:
+        """Whether rows can be queued"""
+        return self._task is not None
+
+    async def create(self, name: str, row) -> dict:
+        """
+        Queue a new row and wait for it to be committed
+
+        :param name: "shares" or "requests"
+        :param row: The new row (ShareBase or RequestBase)
+        :returns: The row's column values, with its new id
+        :raises RuntimeError if the writer is not running, or whatever
+                writing the row raised
+        """
+        if not self.running:
+            raise RuntimeError("The group commit writer is not running")
+        future = asyncio.get_running_loop().create_future()
+        community = database.current_community.get()
+        self._queue.put_nowait((community, name, row, future))
+        # If the caller goes away the row is still written
+        return await asyncio.shield(future)
+
+    async def create_share(self, share: schemas.ShareBase) -> schemas.ShareModel:
+        """Add a plant share in the next batch; see crud.create_share"""
+        return schemas.ShareModel(**await self.create("shares", share))
+
+    async def create_request(
+        self, request: schemas.RequestBase
+    ) -> schemas.RequestModel:
+        """Add a plant request in the next batch; see crud.create_request"""
+        return schemas.RequestModel(**await self.create("requests", request))
+
+    async def _run(self):
+        """Write batches until stopped"""
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            batch = []
+            item = await self._queue.get()
+            deadline = loop.time() + config.WRITE_BATCH_DELAY
+            while True:
+                if item is None:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= config.WRITE_BATCH_MAX_ROWS:
+                    break
+                try:
+                    # Take what is already queued without waiting
+                    item = self._queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self._queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+            if batch:
+                await self.write(batch)
+
+    async def write(self, batch: list):
+        """
+        Write a batch, a transaction per community and table, and give
+        each caller its row or its error
+
+        :param batch: List of (community, table name, row, future)
+        """
+        communities = list(dict.fromkeys(community for community, *_ in batch))
+        for community in communities:
+            with database.use_community(community):
+                await self.write_community(
+                    [item[1:] for item in batch if item[0] == community]
+                )
+
+    async def write_community(self, batch: list):
+        """
+        Write a batch of the current community, a transaction per table
+
+        :param batch: List of (table name, row, future)
+        """
+        for name, create in CREATORS.items():
+            items = [(row, future) for table, row, future in batch if table == name]
+            if not items:
+                continue
+            try:
+                async with AsyncSessionLocal() as db:
+                    created = await create(db, [row for row, _ in items])
+            except Exception as exc:
+                if len(items) == 1:
+                    set_exception(items[0][1], exc)
+                    continue
+                logger.warning(
+                    "Writing %d %s failed; writing them one at a time",
+                    len(items), name, exc_info=True,
+                )
+                for row, future in items:
+                    await self.write_community([(name, row, future)])
+                continue
+            for (row, future), value in zip(items, created):
+                if not future.done():
+                    future.set_result(value)
+
+
+def set_exception(future: asyncio.Future, exc: Exception):
+    """Fail a caller's row, unless the caller is gone"""
+    if not future.done():
+        future.set_exception(exc)
+
+
+writer = GroupCommitWriter()
@@ -0,0 +1,161 @@
+"""
+HTTP caching of the shares and requests listings
+
+Every change to the shares or requests table increases that table's
+version number, in the same transaction (see crud.bump_table_version).
+A listing is fully determined by the table version and the query
+string, so:
+
+- its ETag is made from the two, and a client that sends it back in
+  If-None-Match gets a 304 Not Modified without the listing being
+  queried or serialized, and
+- the serialized body is kept in memory and served again for the same
+  query string until the version changes, and so is its compressed
+  form for each encoding asked for (see compression.py), so an
+  unchanged listing is compressed only once. A compressed listing has
+  its own ETag, the encoding appended to the listing's.
+
+The version is read before the rows, so a cached body is never older
+than the version it is stored under. The version lives in the database,
+so this stays correct with several worker processes. Each community
+(see shards.py) has its own tables and versions, so its listings are
+cached and tagged separately.
+"""
+
+import hashlib
+from dataclasses import dataclass, field
+
+from fastapi import Request, Response
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import cache
+import compression
+import config
+import crud
+import database
+import serialize
+
+JSON_MEDIA_TYPE = "application/json"
+
+# Listings must be revalidated with the ETag before each reuse
+CACHE_CONTROL = "no-cache"
+
+
+@dataclass
+class CachedListing:
+    """A serialized listing, with the table version it was made from"""
+    version: int
+    body: bytes
+    headers: dict
+    # The body compressed, by encoding, as it is asked for
+    encoded: dict = field(default_factory=dict)
+
+    def encode(self, encoding: str) -> bytes:
+        """
+        Get the body compressed, compressing it the first time
+
+        :param encoding: "br" or "gzip"
+        :returns: The compressed body
+        """
+        if encoding not in self.encoded:
+            self.encoded[encoding] = compression.compress(self.body, encoding)
+        return self.encoded[encoding]
+
+
+listing_cache = cache.TTLCache(
+    maxsize=config.LISTING_CACHE_SIZE, ttl=config.LISTING_CACHE_TTL
+)
+
+
+def query_key(request: Request) -> str:
+    """
+    Get the query string of a request in a canonical form, so that the
+    same parameters in another order are the same listing
+
+    :param request: The listing request
+    :returns: The sorted query parameters
+    """
+    return "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+
+
+def make_etag(table: str, version: int, key: str, community: str | None = None) -> str:
+    """
+    Make the (strong) ETag of a listing
+
+    :param table: The table listed
+    :param version: The version of the table
+    :param key: The canonical query string
+    :param community: The community whose table it is; None for the default
+    :returns: The quoted ETag
+    """
+    if community is not None:
+        key = f"{community}/{key}"
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return f'"{table}-{version}-{digest}"'
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    """
+    Make the ETag of a compressed listing, which differs from the
+    listing's as its bytes do
+
+    :param etag: The listing's quoted ETag, from make_etag
+    :param encoding: "br" or "gzip"
+    :returns: The quoted ETag
+    """
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Whether the request's If-None-Match header includes the ETag"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+async def cached_listing(
+    request: Request,
+    db: AsyncSession,
+    table: str,
+    fetch,
+) -> Response:
+    """
+    Respond to a listing request from the cache when possible
+
+    :param request: The listing request
+    :param db: database
+    :param table: Name of the table listed
+    :param fetch: Async function returning (rows, extra response headers),
+                  the rows being those of a select() of the response
+                  model's columns, which are serialized as they are
+    :returns: The response: 304, a cached body, or a freshly made body
+    """
+    key = query_key(request)
+    community = database.current_community.get()
+    version = await crud.get_table_version(db, table)
+    etag = make_etag(table, version, key, community)
+    encoding = compression.choose_encoding(request.headers.get("accept-encoding"))
+    headers = {"Cache-Control": CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    # Whichever form of the listing the client has, it is still current
+    for tag in [etag] if encoding is None else [encoded_etag(etag, encoding), etag]:
+        if etag_matches(request, tag):
+            return Response(status_code=304, headers={**headers, "ETag": tag})
+
+    cached = listing_cache.get((community, table, key))
+    if cached is None or cached.version != version:
+        rows, extra_headers = await fetch()
+        body = serialize.dump_rows(rows)
+        cached = CachedListing(version=version, body=body, headers=extra_headers)
+        listing_cache.set((community, table, key), cached)
+    body = cached.body
+    if encoding is not None and len(body) >= config.COMPRESSION_MIN_BYTES:
+        body = cached.encode(encoding)
+        etag = encoded_etag(etag, encoding)
+        headers["Content-Encoding"] = encoding
+    return Response(
+        content=body,
+        media_type=JSON_MEDIA_TYPE,
+        headers={**cached.headers, **headers, "ETag": etag},
+    )
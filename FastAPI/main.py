@@ -13,22 +13,63 @@ Daniel Neshyba-Rowe
 
 Start with
 $ poetry run uvicorn main:app --reload
+
+Importing this module does no database work, so workers start fast; the
+schema is brought up to date when the app starts (see lifespan), or by
+"python migrations.py" with PLANTSWAP_MIGRATE_ON_STARTUP=0.
 """
 
-from datetime import datetime, timedelta
-from typing import Annotated, List
-from fastapi import Depends, FastAPI, HTTPException, status
+import asyncio
+import base64
+import binascii
+import json
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from datetime import date, datetime, timedelta
+from typing import Annotated, List, Literal
+from fastapi import Depends, FastAPI, Header, HTTPException, Query, Request, Response, status
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
+from pydantic import TypeAdapter, ValidationError
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import SessionLocal, engine
+from database import (
+    AsyncReadSessionLocal,
+    AsyncSessionLocal,
+    ReadSessionLocal,
+    SessionLocal,
+    async_engine,
+    engine,
+)
 
 # from schemas import User, UserInDB, ShareBase, ShareModel, RequestBase
 # from schemas import RequestModel, Token, TokenData, UserCreate, ItemCreate
+import archive
+import compression
+import config
+import database
 import models
 import schemas
 import crud
+import dump
+import events
+import group_commit
+import listing_cache
+import matching
+import metrics
+import migrations
+import photos
+import ratelimit
+import replicas
+import search
+import serialize
+import shards
+import stats
 
 # # From fastapi tutorial 2023/09/18
 # fake_users_db = {
@@ -50,11 +91,58 @@ SECRET_KEY = "00972ba440d93ae95db349c7ccd03d61f3a7138a4a14fae93402edd73db9a05b"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
+# Page sizes for the shares and requests listings
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# Page size for search results
+DEFAULT_SEARCH_PAGE_SIZE = 20
+
+# Number of plants or users in the statistics listings
+DEFAULT_STATS_SIZE = 20
 
-models.Base.metadata.create_all(bind=engine)
+# Radius of the "near" filter of the listings, in km
+DEFAULT_RADIUS_KM = 10
+MAX_RADIUS_KM = 1000
 
+# Response header carrying the cursor for the next page of a listing
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
 
-app = FastAPI()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Set up on startup and clean up on shutdown. Upgrades the database
+    schema if config.MIGRATE_ON_STARTUP (the communities' databases are
+    migrated with shards.py), copies the database to its SQLite read
+    replicas if configured, and runs, if enabled, the group commit
+    writer, the archiving of stale listings and orphaned photos and the
+    reconciling of the statistics. On shutdown, also stops the change feed's broadcasters
+    and closes the pooled async database connections, whose driver
+    threads would otherwise keep the process running.
+    """
+    if config.MIGRATE_ON_STARTUP:
+        await asyncio.to_thread(migrations.upgrade, engine)
+    if config.READ_REPLICA_COPY_INTERVAL:
+        await replicas.copier.start()
+    if config.WRITE_BATCHING:
+        group_commit.writer.start()
+    if config.ARCHIVE_AFTER_DAYS or config.PHOTO_ORPHAN_AGE:
+        archive.archiver.start()
+    if config.STATS_RECONCILE_INTERVAL:
+        stats.reconciler.start()
+    yield
+    await stats.reconciler.stop()
+    await archive.archiver.stop()
+    await group_commit.writer.stop()
+    await events.broadcasters.stop()
+    await replicas.copier.stop()
+    await database.shard_engines.dispose_all()
+    await database.read_engines.dispose_all()
+    await async_engine.dispose()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 
@@ -72,8 +160,34 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER, "ETag", "Content-Range"],
 )
 
+# Compress large responses for clients that accept it (see compression.py)
+if config.COMPRESSION_ENABLED:
+    app.add_middleware(compression.CompressionMiddleware)
+
+# Send the reads of clients that just made a change to the database
+# rather than a replica (see replicas.py)
+if config.READ_REPLICA_URLS and config.READ_YOUR_WRITES_SECONDS:
+    app.add_middleware(replicas.ReadYourWritesMiddleware)
+
+# Route requests for a community to its own database (see shards.py)
+if config.SHARD_URL_TEMPLATE:
+    app.add_middleware(shards.CommunityMiddleware)
+
+# Time requests and SQL statements (see metrics.py). Added last, so it
+# wraps the other middleware and times them too.
+if config.METRICS_ENABLED:
+    app.add_middleware(metrics.MetricsMiddleware)
+if config.METRICS_ENABLED or config.SLOW_QUERY_SECONDS:
+    metrics.instrument_engine(engine)
+    metrics.instrument_engine(async_engine.sync_engine)
+    for sync_engine, replica_async_engine in database.read_engines.engines:
+        metrics.instrument_engine(sync_engine)
+        metrics.instrument_engine(replica_async_engine.sync_engine)
+    database.new_engine_hooks.append(metrics.instrument_engine)
+
 
 # Use OAuth2, with the Password flow, using a Bearer token, using the
 # OAuth2PasswordBearer class. tokenUrl="token" refers to a relative
@@ -100,6 +214,35 @@ def get_db():
         db.close()
 
 
+async def get_async_db():
+    """
+    Dependency injection of an async session of our plant shares
+    database, for the async endpoints, so that waiting on the database
+    does not block the event loop. Like get_db, one session per request.
+    """
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+def get_read_db():
+    """
+    Dependency injection of a session for reads only, from a read
+    replica if there are any (see replicas.py), so that listings do not
+    load the database that takes the writes. Like get_db otherwise.
+    """
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+async def get_async_read_db():
+    """Async session for reads only, for the async endpoints; see get_read_db"""
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
     """
     Utility function for generating a new access token
@@ -123,6 +266,10 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 # that this type is something that a function may need but not
 # something it will get from a user submitting to an endpoint
 db_dependency = Annotated[Session, Depends(get_db)]
+async_db_dependency = Annotated[AsyncSession, Depends(get_async_db)]
+# Sessions that may read from a replica, a moment behind the writes
+read_db_dependency = Annotated[Session, Depends(get_read_db)]
+async_read_db_dependency = Annotated[AsyncSession, Depends(get_async_read_db)]
 # token_dependency = Annotated[str, Depends(oauth2_scheme)]
 
 
@@ -139,27 +286,44 @@ db_dependency = Annotated[Session, Depends(get_db)]
 # crud.create_user returns user info of type models.User, with fields:
 # id (int), username (str), hashed_password (str) and is_active (bool)
 # This corresponds to schemas.User.
-@app.post("/users/", response_model=schemas.User)
-def create_user(
+def limit_sign_ups(request: Request):
+    """Dependency rate limiting sign ups by client IP (see ratelimit.py)"""
+    ratelimit.check("create_user", request)
+
+
+def limit_logins(
+    request: Request, form_data: Annotated[OAuth2PasswordRequestForm, Depends()]
+):
+    """
+    Dependency rate limiting logins by client IP and by username (see
+    ratelimit.py); runs before the password is checked
+    """
+    ratelimit.check("token", request, form_data.username)
+
+
+@app.post(
+    "/users/", response_model=schemas.UserPublic, dependencies=[Depends(limit_sign_ups)]
+)
+async def create_user(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session=Depends(get_db),
+    db: async_db_dependency,
 ):
-    db_user = crud.get_user_by_username(db, username=form_data.username)
+    db_user = await db.run_sync(crud.get_user_by_username, form_data.username)
     if db_user:
         raise HTTPException(status_code=400, detail="User already registered")
-    return crud.create_user(db, form_data.username, form_data.password)
+    return await crud.create_user_async(db, form_data.username, form_data.password)
 
 
 
-@app.get("/users/", response_model=list[schemas.User])
-def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+@app.get("/users/", response_model=list[schemas.UserPublic])
+def read_users(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
     users = crud.get_users(db, skip=skip, limit=limit)
     return users
 
 
-@app.get("/users/{user_id}", response_model=schemas.User)
-def read_user(user_id: int, db: Session = Depends(get_db)):
-    db_user = crud.get_user(db, user_id=user_id)
+@app.get("/users/{user_id}", response_model=schemas.UserPublic)
+def read_user(user_id: int, db: Session = Depends(get_read_db)):
+    db_user = crud.get_user_by_id(db, user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     return db_user
@@ -167,12 +331,19 @@ def read_user(user_id: int, db: Session = Depends(get_db)):
 # From fastapi tutorial; updated 2023/10/05
 # The dependency below will provide a str that is assigned to the parameter
 # token of the path operation function.
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session=Depends(get_db)):
+async def get_current_user(
+    token: Annotated[str, Depends(oauth2_scheme)], db: async_db_dependency
+):
     """
-    Get the user corresponding to the input token
+    Get the user corresponding to the input token. Users are cached by
+    username for a short time (see crud.get_user_cached), so most
+    authenticated requests do not need a database query for this. A
+    token is only good for the community it was issued in (see shards.py).
+
     :param token: The token
     :returns: User info corresponding to the username from the input token
-    :raises credentials_exception if username missing from token or user not in database
+    :raises credentials_exception if username missing from token, token
+            from another community, or user not in database
     """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -184,6 +355,8 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
+        if payload.get(shards.TOKEN_CLAIM) != database.current_community.get():
+            raise credentials_exception
         token_data = schemas.TokenData(username=username)
     except JWTError:
         raise credentials_exception
@@ -193,10 +366,10 @@ async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Se
     #     raise credentials_exception
     # return user
 
-    db_user = crud.get_user(db, user_id=0) #username=token_data.username)
-    if db_user is None:
+    user = await crud.get_user_cached(db, token_data.username)
+    if user is None:
         raise credentials_exception
-    return db_user
+    return user
 
 
 
@@ -214,7 +387,7 @@ async def get_current_active_user(
     :returns:  The user info
     :raises  HTTPException if the current user is disabled (not active)
     """
-    if current_user.disabled:
+    if not current_user.is_active:
         raise HTTPException(status_code=400, detail="Inactive user")
     return current_user
 
@@ -231,10 +404,12 @@ async def get_current_active_user(
 # that declares a form body with the username and password.
 # An optional scope field as a big string, composed of strings separated by spaces.
 # An optional grant_type.
-@app.post("/token", response_model=schemas.Token)
+@app.post(
+    "/token", response_model=schemas.Token, dependencies=[Depends(limit_logins)]
+)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    db: Session=Depends(get_db),
+    db: async_db_dependency,
 ):
     """
     Return access token for username and password given in form data if authenticated
@@ -243,7 +418,7 @@ async def login_for_access_token(
     :returns: Access token
     :raises  HTTPException if authentication fails
     """
-    user = crud.authenticate_user(db, form_data.username, form_data.password)
+    user = await crud.authenticate_user_async(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -253,9 +428,13 @@ async def login_for_access_token(
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     # The JWT specification includes key sub, with the subject of the token.
     # sub (which is optional) is where to put user's identification
-    access_token = create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
-    )
+    data = {"sub": user.username}
+    community = database.current_community.get()
+    if community is not None:
+        # Users belong to a community; the claim also routes the
+        # requests made with the token (see shards.py)
+        data[shards.TOKEN_CLAIM] = community
+    access_token = create_access_token(data=data, expires_delta=access_token_expires)
     return {"access_token": access_token, "token_type": "bearer"}
 
 # @app.post("/token")
@@ -293,25 +472,59 @@ def create_item_for_user(
 
 
 @app.get("/items/", response_model=list[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
     items = crud.get_items(db, skip=skip, limit=limit)
     return items
 
 
-# # From fastapi tutorial; updated 2023/09/18
-# # Below, current_user is not coming in as a get parameter, but rather
-# # from the dependency get_current_active_user
-# @app.get("/users/me/", response_model=schemas.User)
-# async def read_users_me(
-#     current_user: Annotated[schemas.User, Depends(get_current_active_user)]
-# ):
-#     """
-#     Return the user info for the current user
+# From fastapi tutorial; updated 2023/09/18
+# Below, current_user is not coming in as a get parameter, but rather
+# from the dependency get_current_active_user
+@app.get("/users/me/", response_model=schemas.UserPublic)
+async def read_users_me(
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)]
+):
+    """
+    Return the user info for the current user
+
+    :param current_user:  User info; from dependency
+    :returns:  User info
+    """
+    return current_user
 
-#     :param current_user:  User info; from dependency
-#     :returns:  User info
-#     """
-#     return current_user
+
+@app.delete("/users/me/")
+async def deactivate_users_me(
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)],
+    db: async_db_dependency,
+):
+    """
+    Deactivate the current user's account; its tokens stop working
+
+    :param current_user:  User info; from dependency
+    :param db: The user database
+    :returns:  Successful response
+    """
+    await db.run_sync(crud.set_user_active, current_user.username, False)
+    return successful_response(200)
+
+
+@app.put("/users/me/location", response_model=schemas.UserPublic)
+async def set_users_me_location(
+    location: schemas.Location,
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)],
+    db: async_db_dependency,
+):
+    """
+    Set the current user's location, which their new shares and requests
+    get unless they give their own; null latitude and longitude clear it
+
+    :param location: The location, in degrees
+    :param current_user:  User info; from dependency
+    :param db: The user database
+    :returns:  The updated user info
+    """
+    return await db.run_sync(crud.set_user_location, current_user.username, location)
 
 
 # # TODO: Probably will not use this
@@ -334,7 +547,7 @@ def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
 # Because db is type that has Depends in it, the user will not need
 # to specifiy it
 @app.post("/shares/", response_model=schemas.ShareModel)
-async def create_share(share: schemas.ShareBase, db: db_dependency):
+async def create_share(share: schemas.ShareBase, db: async_db_dependency):
     """
     Shares endpoint: Map variables from ShareBase to share table to save 
     into sqlite database
@@ -344,36 +557,194 @@ async def create_share(share: schemas.ShareBase, db: db_dependency):
     :returns: db_share
     """
     # , token: token_dependency)
-    # model_dump() generates a dictionary representation of the model
-    # ** performs a dictionary decomposition
-    db_share = models.Shares(**share.dict())
-    # .dict() is deprecated; try the following instead:
-    # db_share = models.Shares(**share.model_dump())
-    db.add(db_share)
-    db.commit()
-    db.refresh(db_share)
+    if group_commit.writer.running:
+        # Written together with other posts (see group_commit.py)
+        db_share = await group_commit.writer.create_share(share)
+    else:
+        db_share = await crud.create_share(db, share)
+    events.broadcasters.publish()
     return db_share
 
 
+def encode_cursor(**key) -> str:
+    """
+    Make an opaque cursor token pointing just past the given sort key
+
+    :param key: Sort key values of the last row on the current page
+    :returns: The cursor token
+    """
+    payload = json.dumps(key).encode()
+    return base64.urlsafe_b64encode(payload).decode()
+
+
+def decode_cursor(cursor: str | None, **types) -> dict | None:
+    """
+    Get the sort key from a cursor token made by encode_cursor
+
+    :param cursor: The cursor token, or None for the first page
+    :param types: Type of each value of the sort key, by name
+    :returns: The sort key values by name, or None for the first page
+    :raises HTTPException if the cursor is not a valid token
+    """
+    if cursor is None:
+        return None
+    try:
+        key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        key = {name: key[name] for name in types}
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    for name, value in key.items():
+        # JSON does not distinguish a float with no fractional part from an int
+        allowed = (int, float) if types[name] is float else types[name]
+        if isinstance(value, bool) or not isinstance(value, allowed):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def decode_id_cursor(cursor: str | None) -> int | None:
+    """
+    Get the row id from the cursor of a listing ordered by id
+
+    :param cursor: The cursor token, or None for the first page
+    :returns: The row id, or None for the first page
+    """
+    key = decode_cursor(cursor, id=int)
+    return None if key is None else key["id"]
+
+
+def parse_near(near: str | None, radius_km: float) -> tuple | None:
+    """
+    Get the "near" filter of a listing
+
+    :param near: "latitude,longitude" in degrees, or None for no filter
+    :param radius_km: Radius around the point, in km
+    :returns: (latitude, longitude, radius_km), or None for no filter
+    :raises HTTPException if near is not a valid point
+    """
+    if near is None:
+        return None
+    try:
+        latitude, longitude = map(float, near.split(","))
+        location = schemas.Location(latitude=latitude, longitude=longitude)
+    except (ValueError, ValidationError):
+        raise HTTPException(
+            status_code=400, detail="near must be latitude,longitude in degrees"
+        )
+    return location.latitude, location.longitude, radius_km
+
+
+def parse_fields(fields: str | None, model) -> list[str] | None:
+    """
+    Get the fields asked for in a listing's sparse fieldset
+
+    :param fields: Comma-separated field names, e.g. "plant_name,date";
+                   None for all fields
+    :param model: The pydantic model of the listing's rows
+    :returns: The field names, always with id (the cursor needs it), in
+              the order of the model's fields; None for all fields
+    :raises HTTPException if a name is not a field of the model
+    """
+    if fields is None:
+        return None
+    names = {name.strip() for name in fields.split(",") if name.strip()}
+    unknown = names - model.model_fields.keys()
+    if unknown:
+        raise HTTPException(
+            status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown))}"
+        )
+    names.add("id")
+    return [name for name in model.model_fields if name in names]
+
+
+def next_cursor_headers(rows: list, limit: int, key=None) -> dict:
+    """
+    Get the response header with the cursor for the next page, if there
+    may be one (i.e. this page is full)
+
+    :param rows: The rows on this page, in listing order
+    :param limit: The page size
+    :param key: Function giving the sort key of a row as a dict; by
+                default the listing is ordered by id
+    :returns: The header as a dict; empty on the last page
+    """
+    if rows and len(rows) == limit:
+        last_key = key(rows[-1]) if key else {"id": rows[-1].id}
+        return {NEXT_CURSOR_HEADER: encode_cursor(**last_key)}
+    return {}
+
+
 @app.get(
     "/shares/",
-    response_model=List[schemas.ShareModel],
+    response_model=List[schemas.ShareListing] | List[schemas.SparseShareListing],
 )
-async def read_shares(db: db_dependency):
+async def read_shares(
+    db: async_read_db_dependency,
+    request: Request,
+    shared_by: str | None = None,
+    plant_name: str | None = None,
+    is_available_now: bool | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    near: str | None = None,
+    radius_km: Annotated[float, Query(gt=0, le=MAX_RADIUS_KM)] = DEFAULT_RADIUS_KM,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    fields: str | None = None,
+):
     """
-    Get the shared plants
+    Get one page of the shared plants, optionally filtered. If there may
+    be more, the X-Next-Cursor response header holds the cursor to pass
+    to get the next page. Responses have an ETag, and are cached until
+    the shares change, compressed if the client accepts it (see
+    listing_cache.py). Read from a replica of the database if there are
+    any (see replicas.py).
     
     :param db: The database that has the shares to get
-    :returns: The shares info from the database
+    :param request: The request, for its query string and headers
+    :param shared_by: Only shares from this user
+    :param plant_name: Only shares whose plant name contains this text
+    :param is_available_now: Only shares with this availability
+    :param date_from: Only shares posted on or after this date
+    :param date_to: Only shares posted on or before this date
+    :param near: Only shares near this "latitude,longitude"
+    :param radius_km: How near, in km
+    :param cursor: Cursor from the previous page; omit for the first page
+    :param limit: Maximum number of shares to return
+    :param fields: Only these fields of each share, comma-separated (id
+                   is always included); only they are read from the
+                   database. Omit for all fields
+    :returns: The shares info from the database, with the URL of the
+              thumbnail of each share's photo; with fields, only those
+              fields (schemas.SparseShareListing)
     """
     # token: token_dependency,
-    shares = db.query(models.Shares).all()
-    return shares
+    after_id = decode_id_cursor(cursor)
+    near_filter = parse_near(near, radius_km)
+    field_names = parse_fields(fields, schemas.ShareListing)
+
+    async def fetch():
+        shares = await crud.get_shares(
+            db,
+            shared_by=shared_by,
+            plant_name=plant_name,
+            is_available_now=is_available_now,
+            date_from=date_from,
+            date_to=date_to,
+            near=near_filter,
+            after_id=after_id,
+            limit=limit,
+            fields=field_names,
+        )
+        return shares, next_cursor_headers(shares, limit)
+
+    return await listing_cache.cached_listing(
+        request, db, models.Shares.__tablename__, fetch
+    )
 
 
 
 @app.delete("/shares/{shares_id}")
-async def delete_share(shares_id: int, db: Session = Depends(get_db)):
+async def delete_share(shares_id: int, db: async_db_dependency):
     """
     Delete a shared plant from the database
     
@@ -382,15 +753,102 @@ async def delete_share(shares_id: int, db: Session = Depends(get_db)):
     :returns:  Successful response if successful
     :raises  HTTPException if unsuccessful
     """
-    query_result = db.query(models.Shares).filter(models.Shares.id == shares_id).first()
+    if not await crud.delete_share(db, shares_id):
+        raise HTTPException(status_code=404, detail="Plant not found in shares")
+    events.broadcasters.publish()
+
+    return successful_response(200)
 
-    if query_result is None:
+
+@app.post("/shares/{share_id}/photo", response_model=schemas.PhotoUploaded)
+async def upload_share_photo(
+    share_id: int,
+    request: Request,
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)],
+    db: async_db_dependency,
+):
+    """
+    Set the photo of one of the current user's shares, replacing any it
+    had. The photo is the "photo" field of a multipart/form-data body,
+    and is streamed to disk as it is received (see photos.py); its
+    thumbnail is made after.
+
+    :param share_id: Id of the share
+    :param request: The request, with the photo in its body
+    :param current_user:  User info; from dependency
+    :param db: The database
+    :returns: The URLs of the photo and its thumbnail
+    :raises HTTPException 400 if there is no valid photo, 413 if it is
+            too large, 404 if the share is not found, 403 if it is
+            another user's
+    """
+    # Checked before the body is read, so no photo is stored for it
+    shared_by = await crud.get_share_owner(db, share_id)
+    if shared_by is None:
+        raise HTTPException(status_code=404, detail="Plant not found in shares")
+    if shared_by != current_user.username:
+        raise HTTPException(status_code=403, detail="Not your share")
+    try:
+        photo_hash = await photos.receive_photo(request)
+    except photos.PhotoTooLarge as exc:
+        raise HTTPException(status_code=413, detail=str(exc))
+    except ValueError as exc:
+        raise HTTPException(status_code=400, detail=str(exc))
+    if not await crud.set_share_photo(db, share_id, photo_hash):
         raise HTTPException(status_code=404, detail="Plant not found in shares")
+    events.broadcasters.publish()
+    photos.schedule_thumbnail(photo_hash)
+    return {
+        "photo_url": models.photo_url(photo_hash),
+        "thumbnail_url": models.thumbnail_url(photo_hash),
+    }
 
-    db.query(models.Shares).filter(models.Shares.id == shares_id).delete()
-    db.commit()
 
-    return successful_response(200)
+def stored_photo_path(photo_hash: str) -> str:
+    """
+    Get the file of a stored photo
+
+    :param photo_hash: The photo's SHA-256, from the URL
+    :returns: The file
+    :raises HTTPException 404 if there is no such photo
+    """
+    if not photos.HASH_PATTERN.fullmatch(photo_hash):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    path = photos.photo_path(photo_hash)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="Photo not found")
+    return path
+
+
+@app.get("/photos/{photo_hash}")
+async def read_photo(photo_hash: str, request: Request):
+    """
+    Get a photo of a share. Photos never change, so clients can cache
+    them for good; Range requests get part of the photo.
+
+    :param photo_hash: The photo's SHA-256
+    :param request: The request, for its Range and conditional headers
+    :returns: The photo (or the range of it asked for)
+    """
+    path = stored_photo_path(photo_hash)
+    return await photos.file_response(request, path, f'"{photo_hash}"')
+
+
+@app.get("/photos/{photo_hash}/thumbnail")
+async def read_thumbnail(photo_hash: str, request: Request):
+    """
+    Get the thumbnail of a photo of a share, waiting for it to be made if
+    it is not yet; the photo itself if thumbnails cannot be made
+
+    :param photo_hash: The photo's SHA-256
+    :param request: The request, for its Range and conditional headers
+    :returns: The thumbnail
+    """
+    path = stored_photo_path(photo_hash)
+    thumbnail = await photos.ensure_thumbnail(photo_hash)
+    if thumbnail is None:
+        return await photos.file_response(request, path, f'"{photo_hash}"')
+    return await photos.file_response(request, thumbnail, f'"{photo_hash}-thumbnail"')
 
 
 def successful_response(status_code: int):
@@ -405,39 +863,451 @@ def successful_response(status_code: int):
 
 # Create endpoint for plant requests
 @app.post("/requests/", response_model=schemas.RequestModel)
-async def create_request(request: schemas.RequestBase, db: db_dependency):
+async def create_request(request: schemas.RequestBase, db: async_db_dependency):
     """
     Map the variables from our RequestBase to our requests table to
     save into our sqlite database
     """
-    db_request = models.Requests(**request.dict())
-    db.add(db_request)
-    db.commit()
-    db.refresh(db_request)
+    if group_commit.writer.running:
+        db_request = await group_commit.writer.create_request(request)
+    else:
+        db_request = await crud.create_request(db, request)
+    events.broadcasters.publish()
     return db_request
 
 
 @app.get(
     "/requests/",
-    response_model=List[schemas.RequestModel],
+    response_model=List[schemas.RequestModel] | List[schemas.SparseRequestListing],
 )
-async def read_requests(db: db_dependency):
-    """Get the requested plant"""
-    requests = db.query(models.Requests).all()
-    return requests
+async def read_requests(
+    db: async_read_db_dependency,
+    request: Request,
+    requested_by: str | None = None,
+    plant_name: str | None = None,
+    date_from: date | None = None,
+    date_to: date | None = None,
+    near: str | None = None,
+    radius_km: Annotated[float, Query(gt=0, le=MAX_RADIUS_KM)] = DEFAULT_RADIUS_KM,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+    fields: str | None = None,
+):
+    """Get one page of the requested plants; see read_shares"""
+    after_id = decode_id_cursor(cursor)
+    near_filter = parse_near(near, radius_km)
+    field_names = parse_fields(fields, schemas.RequestModel)
+
+    async def fetch():
+        requests = await crud.get_requests(
+            db,
+            requested_by=requested_by,
+            plant_name=plant_name,
+            date_from=date_from,
+            date_to=date_to,
+            near=near_filter,
+            after_id=after_id,
+            limit=limit,
+            fields=field_names,
+        )
+        return requests, next_cursor_headers(requests, limit)
+
+    return await listing_cache.cached_listing(
+        request, db, models.Requests.__tablename__, fetch
+    )
 
 
 
 @app.delete("/requests/{requests_id}")
-async def delete_request(requests_id: int, db: Session = Depends(get_db)):
+async def delete_request(requests_id: int, db: async_db_dependency):
     """Delete a shared plant from the database"""
-    request_model = db.query(models.Requests).filter(models.Requests.id == requests_id).first()
-
-    if request_model is None:
+    if not await crud.delete_request(db, requests_id):
         raise HTTPException(status_code=404, detail="Plant not found in requests")
-
-    db.query(models.Requests).filter(models.Requests.id == requests_id).delete()
-    db.commit()
+    events.broadcasters.publish()
 
     return successful_response(200)
 
+
+
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+async def read_bulk_body(request: Request, model) -> list:
+    """
+    Read and validate the rows posted to a bulk create endpoint: a JSON
+    array, or one JSON object per line with Content-Type
+    application/x-ndjson. The size of the body and the number of rows
+    are checked before any row is validated.
+
+    :param request: The request
+    :param model: The pydantic model of a row
+    :returns: The validated rows
+    :raises RequestValidationError if the body is not a JSON array or a
+            row is not valid, with the row's index in the error location
+    :raises HTTPException 413 if the body is larger than
+            config.BULK_MAX_BYTES, or there are more than
+            config.BULK_MAX_ROWS rows
+    """
+    body = await read_bulk_bytes(request)
+    content_type = request.headers.get("content-type", "")
+    try:
+        if content_type.split(";")[0].strip() == NDJSON_MEDIA_TYPE:
+            lines = [line for line in body.splitlines() if line.strip()]
+            check_bulk_size(len(lines))
+            rows = []
+            for i, line in enumerate(lines):
+                try:
+                    rows.append(model.model_validate_json(line))
+                except ValidationError as exc:
+                    raise RequestValidationError(
+                        [
+                            {**error, "loc": ("body", i, *error["loc"])}
+                            for error in exc.errors(include_url=False)
+                        ]
+                    )
+        else:
+            # Parse the array, and count its items, before validating them
+            items = TypeAdapter(list).validate_json(body)
+            check_bulk_size(len(items))
+            rows = TypeAdapter(List[model]).validate_python(items)
+    except ValidationError as exc:
+        raise RequestValidationError(
+            [
+                {**error, "loc": ("body", *error["loc"])}
+                for error in exc.errors(include_url=False)
+            ]
+        )
+    return rows
+
+
+async def read_bulk_bytes(request: Request) -> bytes:
+    """
+    Read the body of a bulk create request, refusing it as soon as it is
+    known to be too large
+
+    :param request: The request
+    :returns: The body
+    :raises HTTPException 413 if the body is larger than config.BULK_MAX_BYTES
+    """
+    too_large = HTTPException(
+        status_code=413,
+        detail=f"At most {config.BULK_MAX_BYTES} bytes per request",
+    )
+    if int(request.headers.get("content-length") or 0) > config.BULK_MAX_BYTES:
+        raise too_large
+    # Without a Content-Length (a chunked body), count as it comes
+    chunks = []
+    size = 0
+    async for chunk in request.stream():
+        size += len(chunk)
+        if size > config.BULK_MAX_BYTES:
+            raise too_large
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+
+def check_bulk_size(count: int):
+    """
+    Check the number of rows in a bulk request
+
+    :param count: Number of rows
+    :raises HTTPException 413 if there are more than config.BULK_MAX_ROWS
+    """
+    if count > config.BULK_MAX_ROWS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {config.BULK_MAX_ROWS} rows per request",
+        )
+
+
+@app.post("/shares/bulk", response_model=schemas.BulkCreated)
+async def create_shares(request: Request, db: async_db_dependency):
+    """
+    Add many plant shares in one transaction
+
+    The body is a JSON array of shares, or one share per line with
+    Content-Type application/x-ndjson. If any share is not valid, none
+    are added.
+
+    :param request: The request, with the shares in its body
+    :param db: The database
+    :returns: The ids of the new shares, in the order posted
+    """
+    shares = await read_bulk_body(request, schemas.ShareBase)
+    ids = await crud.create_shares(db, shares)
+    events.broadcasters.publish()
+    return {"ids": ids}
+
+
+@app.post("/shares/bulk-delete", response_model=schemas.BulkDeleted)
+async def delete_shares(share_ids: schemas.IdList, db: async_db_dependency):
+    """
+    Delete many plant shares in one transaction
+
+    :param share_ids: Ids of the shares; ids not found are skipped
+    :param db: The database
+    :returns: The ids of the shares that were deleted
+    """
+    check_bulk_size(len(share_ids.ids))
+    deleted = await crud.delete_shares(db, share_ids.ids)
+    events.broadcasters.publish()
+    return {"deleted": deleted}
+
+
+@app.post("/requests/bulk", response_model=schemas.BulkCreated)
+async def create_requests(request: Request, db: async_db_dependency):
+    """Add many plant requests in one transaction; see create_shares"""
+    requests = await read_bulk_body(request, schemas.RequestBase)
+    ids = await crud.create_requests(db, requests)
+    events.broadcasters.publish()
+    return {"ids": ids}
+
+
+@app.post("/requests/bulk-delete", response_model=schemas.BulkDeleted)
+async def delete_requests(request_ids: schemas.IdList, db: async_db_dependency):
+    """Delete many plant requests in one transaction; see delete_shares"""
+    check_bulk_size(len(request_ids.ids))
+    deleted = await crud.delete_requests(db, request_ids.ids)
+    events.broadcasters.publish()
+    return {"deleted": deleted}
+
+
+@app.get(
+    "/matches/",
+    response_model=List[schemas.MatchModel],
+)
+async def read_matches(
+    db: async_read_db_dependency,
+    response: Response,
+    plant_name: str | None = None,
+    shared_by: str | None = None,
+    requested_by: str | None = None,
+    near: str | None = None,
+    radius_km: Annotated[float, Query(gt=0, le=MAX_RADIUS_KM)] = DEFAULT_RADIUS_KM,
+    cursor: str | None = None,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_PAGE_SIZE,
+):
+    """
+    Get one page of available shares paired with requests for the same
+    plant, best matches first (see matching.score). Each request is
+    paired with its config.MATCHES_PER_REQUEST best shares. Paged like
+    read_shares.
+
+    :param db: The database
+    :param response: The response, for setting the next cursor header
+    :param plant_name: Only matches for this plant
+    :param shared_by: Only matches for shares from this user
+    :param requested_by: Only matches for requests from this user
+    :param near: Only matches for shares near this "latitude,longitude"
+    :param radius_km: How near, in km
+    :param cursor: Cursor from the previous page; omit for the first page
+    :param limit: Maximum number of matches to return
+    :returns: The matches, each with its share and request
+    """
+    after = decode_cursor(cursor, score=float, id=int)
+    near_filter = parse_near(near, radius_km)
+    matches = await db.run_sync(
+        matching.get_matches,
+        plant_name=plant_name,
+        shared_by=shared_by,
+        requested_by=requested_by,
+        near=near_filter,
+        after=None if after is None else (after["score"], after["id"]),
+        limit=limit,
+    )
+    response.headers.update(
+        next_cursor_headers(
+            matches, limit, key=lambda match: {"score": match.score, "id": match.id}
+        )
+    )
+    return matches
+
+
+@app.get(
+    "/search",
+    response_model=List[schemas.SearchResult],
+)
+async def search_plants(
+    db: async_read_db_dependency,
+    q: Annotated[str, Query(min_length=1)],
+    kind: Literal["share", "request"] | None = None,
+    skip: Annotated[int, Query(ge=0)] = 0,
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_SEARCH_PAGE_SIZE,
+):
+    """
+    Search the plant names and descriptions of shares and the plant names
+    and notes of requests. Partial words and typos still match.
+
+    :param db: The database
+    :param q: The search text
+    :param kind: "share" or "request" to search only shares or requests
+    :param skip: Number of results to skip
+    :param limit: Maximum number of results to return
+    :returns: The matching shares and requests, best first
+    """
+    results = await db.run_sync(search.search, q, kind=kind, skip=skip, limit=limit)
+    return [
+        {"kind": row_kind, "score": score, row_kind: row}
+        for row_kind, score, row in results
+    ]
+
+
+@app.get("/stats/plants", response_model=List[schemas.PlantStats])
+async def read_plant_stats(
+    db: async_read_db_dependency,
+    order: Literal["supply", "demand", "shortage"] = "demand",
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_STATS_SIZE,
+):
+    """
+    Get the plants most shared, most requested, or most short of shares,
+    with their numbers and total amounts of shares and requests. Read
+    from the statistics kept as shares and requests change (see stats.py).
+
+    :param db: The database
+    :param order: "supply" (by amount shared), "demand" (by amount
+                  requested) or "shortage" (by amount requested less shared)
+    :param limit: Maximum number of plants to return
+    :returns: The plants' statistics, greatest first
+    """
+    return serialize.rows_to_dicts(await stats.top_plants(db, order, limit))
+
+
+@app.get("/stats/users", response_model=List[schemas.UserStats])
+async def read_user_stats(
+    db: async_read_db_dependency,
+    order: Literal["shares", "requests"] = "shares",
+    limit: Annotated[int, Query(ge=1, le=MAX_PAGE_SIZE)] = DEFAULT_STATS_SIZE,
+):
+    """
+    Get the users with the most shares or requests; see read_plant_stats
+
+    :param db: The database
+    :param order: "shares" or "requests"
+    :param limit: Maximum number of users to return
+    :returns: The users' statistics, greatest first
+    """
+    return serialize.rows_to_dicts(await stats.top_users(db, order, limit))
+
+
+@app.get("/events")
+async def stream_events(
+    request: Request,
+    table: Annotated[
+        List[Literal["shares", "requests"]] | None, Query()
+    ] = None,
+    last_event_id: Annotated[int | None, Header()] = None,
+):
+    """
+    Stream changes to shares and requests as Server-Sent Events, so
+    clients can keep their listings up to date without re-reading them
+    (see events.py). Each event's data is JSON with the table, op
+    ("create", "update" or "delete"), row id, and for creates the row
+    (for updates, the changed columns).
+
+    :param request: The request, to notice when the client disconnects
+    :param table: Only changes to these tables; default both
+    :param last_event_id: Id of the last event received, to resume after
+                          it (sent by EventSource when reconnecting)
+    :returns: The text/event-stream response
+    """
+    return StreamingResponse(
+        events.stream(request, last_event_id, set(table) if table else None),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def get_dump_user(
+    current_user: Annotated[schemas.User, Depends(get_current_active_user)]
+):
+    """
+    Get the current user if they may export and import whole tables,
+    i.e. are in config.DUMP_USERNAMES
+
+    :param current_user: The current user; from dependency
+    :returns: The user info
+    :raises HTTPException 403 if the user may not dump tables
+    """
+    if current_user.username not in config.DUMP_USERNAMES:
+        raise HTTPException(status_code=403, detail="Not allowed to dump tables")
+    return current_user
+
+
+@app.get("/export/{table}")
+async def export_table(
+    table: Literal["shares", "requests", "users"],
+    current_user: Annotated[schemas.User, Depends(get_dump_user)],
+    format: Literal["ndjson", "csv"] = "ndjson",
+):
+    """
+    Download a whole table as NDJSON or CSV, streamed as it is read
+    (see dump.py). Only for the users in config.DUMP_USERNAMES. Users
+    are exported without their password hashes; full user dumps are
+    made with the command line.
+
+    :param table: "shares", "requests" or "users"
+    :param current_user: The current user; from dependency
+    :param format: "ndjson" (default) or "csv"
+    :returns: The streamed table
+    :raises HTTPException 401 if not logged in, 403 if not allowed
+    """
+    columns = None
+    if table == "users":
+        columns = [c for c in dump.TABLES["users"].columns if c != "hashed_password"]
+    return StreamingResponse(
+        dump.export_rows(table, format, columns),
+        media_type=dump.MEDIA_TYPES[format],
+        headers={"Content-Disposition": f'attachment; filename="{table}.{format}"'},
+    )
+
+
+@app.post("/import/{table}")
+async def import_table(
+    table: Literal["shares", "requests"],
+    request: Request,
+    current_user: Annotated[schemas.User, Depends(get_dump_user)],
+    db: async_db_dependency,
+):
+    """
+    Upload rows exported by export_table. Only for the users in
+    config.DUMP_USERNAMES. The body is CSV if the Content-Type is
+    text/csv, else NDJSON. It is received into a temporary file first,
+    so that the import's transaction does not keep the database locked
+    while a slow upload comes in; then its rows are read and inserted in
+    batches. If any row is not valid, or its id is taken, nothing is
+    imported. The imported rows are sent to change feed subscribers.
+
+    :param table: "shares" or "requests"
+    :param request: The request, with the rows in its body
+    :param current_user: The current user; from dependency
+    :param db: The database
+    :returns: The number of rows imported
+    :raises HTTPException 400 if a row is not valid, 401 if not logged
+            in, 403 if not allowed, 409 if an id is taken
+    """
+    content_type = request.headers.get("content-type", "")
+    fmt = "csv" if content_type.split(";")[0].strip() == "text/csv" else "ndjson"
+    with tempfile.TemporaryFile() as body:
+        await dump.spool(request.stream(), body)
+        records = dump.parse_records(dump.read_lines(dump.read_chunks(body)), fmt)
+        try:
+            count = await dump.import_rows(db, table, records)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        except IntegrityError:
+            raise HTTPException(status_code=409, detail=f"Some of the {table} already exist")
+    events.broadcasters.publish()
+    return {"imported": count}
+
+
+@app.get("/metrics", include_in_schema=False)
+def read_metrics():
+    """
+    Request and SQL metrics of this process, for Prometheus to scrape
+
+    :returns: The metrics in the Prometheus text format
+    :raises HTTPException 404 if metrics are turned off
+    """
+    if not config.METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are turned off")
+    return PlainTextResponse(metrics.render(), media_type=metrics.CONTENT_TYPE)
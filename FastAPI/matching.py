@@ -0,0 +1,340 @@
+"""
+Matching of plant shares with plant requests
+
+A share and a request match when the share is available now and both
+are for the same plant, compared by normalized plant name (plant_key).
+Pairing every share with every request for the same plant would store
+a number of matches that grows with the product of the two, so only the
+config.MATCHES_PER_REQUEST best shares for each request are stored, in
+the matches table. They are kept up to date incrementally: adding or
+removing a share or request only touches the matches for that one
+plant, found through the plant_key indexes.
+
+Matches are ranked by score, made of how well the share covers the
+amount requested and how recently the two were posted (see score). The
+recency part depends on today's date, so it is computed when matches
+are read rather than stored.
+"""
+
+import datetime
+import heapq
+from types import SimpleNamespace
+
+from sqlalchemy import and_, case, delete, insert, literal, or_, select
+from sqlalchemy.orm import Session, joinedload
+
+import config
+import geo
+import models
+
+# Age, in days, of the older of the two posts at which the recency part
+# of a match's score is half that of a match posted today (see score)
+RECENCY_DAYS = 30
+
+
+def amount_fit(share_amount: float | None, request_amount: float | None) -> float:
+    """
+    How well the amount shared covers the amount requested
+
+    :param share_amount: Amount shared
+    :param request_amount: Amount requested
+    :returns: Fraction of the request covered, from 0 to 1
+    """
+    if request_amount and request_amount > 0:
+        return max(min((share_amount or 0) / request_amount, 1.0), 0.0)
+    return 1.0
+
+
+def posted_day(share_date: datetime.date | None, request_date: datetime.date | None) -> int:
+    """
+    Get the day the older of a share and a request was posted
+
+    :param share_date: Date of the share
+    :param request_date: Date of the request
+    :returns: The day as a number (date.toordinal()); 1, the first day
+              there is, if neither has a date
+    """
+    if share_date is None or (request_date is not None and request_date < share_date):
+        share_date = request_date
+    return share_date.toordinal() if share_date is not None else 1
+
+
+def score(fit: float, posted: int, today: int) -> float:
+    """
+    Rank a share for a request, by how well the amount shared covers the
+    amount requested and by how recently the two were posted
+
+    Both parts are between 0 and 1, so neither swamps the other: a match
+    posted RECENCY_DAYS days ago that covers the whole request ranks the
+    same as one posted today that covers half of it.
+
+    :param fit: The amount fit, from amount_fit
+    :param posted: The day the older of the two was posted, from posted_day
+    :param today: Today, as a day number
+    :returns: Score; higher is a better match
+    """
+    return fit + RECENCY_DAYS / (RECENCY_DAYS + max(today - posted, 0))
+
+
+def score_column(today: int):
+    """
+    The score of the stored matches, as an SQL expression; see score
+
+    :param today: Today, as a day number
+    :returns: The expression
+    """
+    age = case(
+        (models.Matches.posted_day > today, 0),
+        else_=today - models.Matches.posted_day,
+    )
+    return models.Matches.amount_fit + literal(float(RECENCY_DAYS)) / (RECENCY_DAYS + age)
+
+
+def _match_row(share, request) -> dict:
+    """The matches row pairing a share with a request"""
+    return {
+        "share_id": share.id,
+        "request_id": request.id,
+        "plant_key": request.plant_key,
+        "amount_fit": amount_fit(share.amount, request.amount),
+        "posted_day": posted_day(share.date, request.date),
+    }
+
+
+def _share_score(share, request, today: int) -> float:
+    """The score of a share for a request; see score"""
+    return score(
+        amount_fit(share.amount, request.amount),
+        posted_day(share.date, request.date),
+        today,
+    )
+
+
+def match_shares(db: Session, shares: list):
+    """
+    Add the new shares to the matches of the requests they are among the
+    best for. The caller commits.
+
+    :param db: database
+    :param shares: The new shares (objects with the Shares attributes),
+                   already inserted so that they have ids
+    """
+    by_plant = {}
+    for share in shares:
+        if share.is_available_now:
+            by_plant.setdefault(share.plant_key, []).append(share)
+    if not by_plant:
+        return
+    requests = db.execute(
+        select(
+            models.Requests.id,
+            models.Requests.plant_key,
+            models.Requests.amount,
+            models.Requests.date,
+        ).filter(models.Requests.plant_key.in_(list(by_plant)))
+    ).all()
+    stored = {}
+    for match in db.execute(
+        select(
+            models.Matches.id,
+            models.Matches.request_id,
+            models.Matches.amount_fit,
+            models.Matches.posted_day,
+        ).filter(models.Matches.plant_key.in_(list(by_plant)))
+    ):
+        stored.setdefault(match.request_id, []).append(match)
+
+    today = datetime.date.today().toordinal()
+    new_rows, dropped = [], []
+    for request in requests:
+        # Candidates are (score, stored match, new row)
+        candidates = [
+            (score(match.amount_fit, match.posted_day, today), match, None)
+            for match in stored.get(request.id, [])
+        ]
+        for share in by_plant[request.plant_key]:
+            candidates.append(
+                (_share_score(share, request, today), None, _match_row(share, request))
+            )
+        best = heapq.nlargest(
+            config.MATCHES_PER_REQUEST, candidates, key=lambda candidate: candidate[0]
+        )
+        new_rows.extend(row for _, _, row in best if row is not None)
+        kept = {match.id for _, match, _ in best if match is not None}
+        dropped.extend(
+            match.id
+            for _, match, _ in candidates
+            if match is not None and match.id not in kept
+        )
+    if dropped:
+        db.execute(delete(models.Matches).filter(models.Matches.id.in_(dropped)))
+    if new_rows:
+        db.execute(insert(models.Matches), new_rows)
+
+
+def match_requests(db: Session, requests: list, exclude_share_ids=()):
+    """
+    Add the matches for new requests: the best available shares for each.
+    The caller commits.
+
+    :param db: database
+    :param requests: The new requests (objects with the Requests
+                     attributes), already inserted so that they have ids
+    :param exclude_share_ids: Shares not to match, e.g. being deleted
+    """
+    by_plant = {}
+    for request in requests:
+        by_plant.setdefault(request.plant_key, []).append(request)
+    if not by_plant:
+        return
+    query = select(
+        models.Shares.id,
+        models.Shares.plant_key,
+        models.Shares.amount,
+        models.Shares.date,
+    ).filter(
+        models.Shares.plant_key.in_(list(by_plant)),
+        models.Shares.is_available_now == True,
+    )
+    if exclude_share_ids:
+        query = query.filter(models.Shares.id.not_in(list(exclude_share_ids)))
+    # Plain objects, whose attributes are much quicker to read than those
+    # of result rows, as every share is scored for every request
+    shares = {}
+    for share in db.execute(query).mappings():
+        shares.setdefault(share["plant_key"], []).append(SimpleNamespace(**share))
+
+    today = datetime.date.today().toordinal()
+    rows = []
+    for request in requests:
+        request = SimpleNamespace(
+            id=request.id,
+            plant_key=request.plant_key,
+            amount=request.amount,
+            date=request.date,
+        )
+        best = heapq.nlargest(
+            config.MATCHES_PER_REQUEST,
+            shares.get(request.plant_key, []),
+            key=lambda share: _share_score(share, request, today),
+        )
+        rows.extend(_match_row(share, request) for share in best)
+    if rows:
+        db.execute(insert(models.Matches), rows)
+
+
+def unmatch_shares(db: Session, share_ids: list[int]):
+    """
+    Remove the matches for shares that are being deleted (or are no
+    longer available), and find other shares for the requests they were
+    matched with. The caller commits.
+    """
+    request_ids = db.scalars(
+        select(models.Matches.request_id)
+        .filter(models.Matches.share_id.in_(share_ids))
+        .distinct()
+    ).all()
+    if not request_ids:
+        return
+    # Rematching the requests from scratch finds the shares that now
+    # make their best few
+    db.execute(
+        delete(models.Matches).filter(models.Matches.request_id.in_(request_ids))
+    )
+    requests = db.execute(
+        select(
+            models.Requests.id,
+            models.Requests.plant_key,
+            models.Requests.amount,
+            models.Requests.date,
+        ).filter(models.Requests.id.in_(request_ids))
+    ).all()
+    match_requests(db, requests, exclude_share_ids=share_ids)
+
+
+def unmatch_requests(db: Session, request_ids: list[int]):
+    """Remove the matches for requests that are being deleted"""
+    db.execute(
+        delete(models.Matches).filter(models.Matches.request_id.in_(request_ids))
+    )
+
+
+def rematch_all(db: Session):
+    """
+    Recompute the matches for every plant, e.g. after a migration. The
+    caller commits.
+
+    :param db: database
+    """
+    db.execute(delete(models.Matches))
+    query = select(
+        models.Requests.id,
+        models.Requests.plant_key,
+        models.Requests.amount,
+        models.Requests.date,
+    ).execution_options(yield_per=1000)
+    for requests in db.execute(query).partitions():
+        match_requests(db, requests)
+
+
+def get_matches(
+    db: Session,
+    plant_name: str | None = None,
+    shared_by: str | None = None,
+    requested_by: str | None = None,
+    near: tuple[float, float, float] | None = None,
+    after: tuple[float, int] | None = None,
+    limit: int = 100,
+):
+    """
+    Get one page of matches, best first
+
+    :param db: database
+    :param plant_name: Only matches for this plant
+    :param shared_by: Only matches for shares from this user
+    :param requested_by: Only matches for requests from this user
+    :param near: Only matches for shares within radius km of a point, as
+                 (latitude, longitude, radius)
+    :param after: (score, id) of the last match of the previous page
+    :param limit: Maximum number of matches to return
+    :returns: List of matches, with their shares and requests loaded and
+              their score set
+    """
+    match_score = score_column(datetime.date.today().toordinal())
+    query = db.query(models.Matches, match_score.label("score")).options(
+        joinedload(models.Matches.share), joinedload(models.Matches.request)
+    )
+    if plant_name:
+        query = query.filter(
+            models.Matches.plant_key == models.normalize_plant_name(plant_name)
+        )
+    if shared_by is not None:
+        query = query.filter(
+            models.Matches.share.has(models.Shares.shared_by == shared_by)
+        )
+    if requested_by is not None:
+        query = query.filter(
+            models.Matches.request.has(models.Requests.requested_by == requested_by)
+        )
+    if near is not None:
+        query = query.filter(
+            models.Matches.share_id.in_(
+                select(models.Shares.id).filter(
+                    geo.near_condition(db.get_bind(), models.Shares, near)
+                )
+            )
+        )
+    if after is not None:
+        last_score, last_id = after
+        query = query.filter(
+            or_(
+                match_score < last_score,
+                and_(match_score == last_score, models.Matches.id > last_id),
+            )
+        )
+    query = query.order_by(match_score.desc(), models.Matches.id)
+    matches = []
+    for match, match_score in query.limit(limit):
+        match.score = match_score
+        matches.append(match)
+    return matches
@@ -0,0 +1,297 @@
+"""
+Request and SQL metrics, in the Prometheus text format
+
+MetricsMiddleware times every request and counts it by route (the path
+template, e.g. /shares/{shares_id}, so ids do not make new series) and
+status code, and tracks how many requests are in progress. SQLAlchemy
+engine events (see instrument_engine) time every SQL statement and add
+it to the statistics of the request that made it, so each request's
+number of statements and time spent in the database are recorded too.
+Statements slower than config.SLOW_QUERY_SECONDS are logged.
+
+Recording a request or a statement takes a couple of clock reads and
+counter updates, so the metrics can stay on in production. They are
+per process; Prometheus scrapes each worker.
+"""
+
+import bisect
+import contextvars
+import logging
+import threading
+import time
+from dataclasses import dataclass
+
+from sqlalchemy import event
+
+import config
+
+slow_query_logger = logging.getLogger("plantswap.slow_query")
+
+# Histogram buckets: seconds per request or statement, and statements
+# per request
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def escape_label_value(value) -> str:
+    """Escape a label value: backslashes, double quotes and newlines"""
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    """Format label names and values as {name="value",...}"""
+    pairs = [
+        f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)
+    ]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Metric:
+    """A named metric with a value per combination of label values"""
+
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        """
+        :param name: Metric name
+        :param help: Description shown by Prometheus
+        :param labels: Names of the labels
+        """
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def render(self) -> list[str]:
+        """Get the metric's lines in the Prometheus text format"""
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            values = list(self._values.items())
+        for label_values, value in sorted(values):
+            lines += self._render_value(label_values, value)
+        return lines
+
+    def _render_value(self, label_values: tuple, value) -> list[str]:
+        return [f"{self.name}{format_labels(self.labels, label_values)} {value}"]
+
+
+class Counter(Metric):
+    """A count that only goes up"""
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        """Add to the count for the label values"""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """A value that goes up and down"""
+
+    kind = "gauge"
+
+    def inc(self, *label_values, amount: float = 1):
+        """Add to the value for the label values"""
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def dec(self, *label_values, amount: float = 1):
+        """Subtract from the value for the label values"""
+        self.inc(*label_values, amount=-amount)
+
+
+class Histogram(Metric):
+    """Counts of observed values by bucket, with their sum"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets=LATENCY_BUCKETS):
+        """
+        :param buckets: Upper bounds of the buckets, in increasing order
+        """
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *label_values):
+        """Count a value for the label values"""
+        # Counts per bucket (not cumulative; see _render_value), then the sum
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+    def _render_value(self, label_values: tuple, counts: list) -> list[str]:
+        lines = []
+        cumulative = 0
+        bounds = [*map(str, self.buckets), "+Inf"]
+        for bound, count in zip(bounds, counts):
+            cumulative += count
+            labels = format_labels(self.labels, label_values, f'le="{bound}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{labels} {counts[-1]}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+REQUESTS = Counter(
+    "plantswap_http_requests_total",
+    "HTTP requests by route and status code",
+    ("method", "route", "status"),
+)
+REQUEST_SECONDS = Histogram(
+    "plantswap_http_request_duration_seconds",
+    "Time to answer HTTP requests, until the whole body is sent",
+    ("method", "route"),
+)
+IN_PROGRESS = Gauge(
+    "plantswap_http_requests_in_progress", "HTTP requests being answered"
+)
+REQUEST_SQL_STATEMENTS = Histogram(
+    "plantswap_http_request_sql_statements",
+    "SQL statements run per HTTP request",
+    ("method", "route"),
+    buckets=COUNT_BUCKETS,
+)
+REQUEST_SQL_SECONDS = Histogram(
+    "plantswap_http_request_sql_seconds",
+    "Time spent running SQL statements per HTTP request",
+    ("method", "route"),
+)
+SQL_STATEMENTS = Counter(
+    "plantswap_sql_statements_total", "SQL statements run, in or out of requests"
+)
+SQL_SECONDS = Counter(
+    "plantswap_sql_seconds_total", "Time spent running SQL statements"
+)
+
+METRICS = [
+    REQUESTS,
+    REQUEST_SECONDS,
+    IN_PROGRESS,
+    REQUEST_SQL_STATEMENTS,
+    REQUEST_SQL_SECONDS,
+    SQL_STATEMENTS,
+    SQL_SECONDS,
+]
+
+
+def render() -> str:
+    """Get all metrics in the Prometheus text format"""
+    lines = []
+    for metric in METRICS:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+@dataclass
+class SQLStats:
+    """SQL statements run while answering one request"""
+    statements: int = 0
+    seconds: float = 0.0
+
+
+# The statistics of the request being answered. Sync endpoints run in a
+# copy of the request's context, which refers to the same SQLStats.
+current_sql_stats: contextvars.ContextVar[SQLStats | None] = contextvars.ContextVar(
+    "current_sql_stats", default=None
+)
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Engine event: note when a statement starts"""
+    context._plantswap_started = time.perf_counter()
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """Engine event: time a statement and add it to the request's statistics"""
+    seconds = time.perf_counter() - context._plantswap_started
+    SQL_STATEMENTS.inc()
+    SQL_SECONDS.inc(amount=seconds)
+    stats = current_sql_stats.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.seconds += seconds
+    if config.SLOW_QUERY_SECONDS and seconds >= config.SLOW_QUERY_SECONDS:
+        slow_query_logger.warning(
+            "%.1f ms: %s", seconds * 1000, " ".join(statement.split())
+        )
+
+
+def instrument_engine(engine):
+    """
+    Time the SQL statements run through an engine
+
+    :param engine: A sync engine (for an async engine, its .sync_engine)
+    """
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", after_cursor_execute)
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording the metrics of each HTTP request"""
+
+    def __init__(self, app):
+        self.app = app
+        # Route path templates by endpoint, filled in as routes are seen
+        self._route_paths = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = SQLStats()
+        token = current_sql_stats.set(stats)
+        IN_PROGRESS.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            seconds = time.perf_counter() - start
+            IN_PROGRESS.dec()
+            current_sql_stats.reset(token)
+            method = scope["method"]
+            # The router adds the matched endpoint to the scope
+            route = self.route_path(scope)
+            REQUESTS.inc(method, route, str(status))
+            REQUEST_SECONDS.observe(seconds, method, route)
+            REQUEST_SQL_STATEMENTS.observe(stats.statements, method, route)
+            REQUEST_SQL_SECONDS.observe(stats.seconds, method, route)
+
+    def route_path(self, scope) -> str:
+        """Get the path template of the route that answered a request"""
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        path = self._route_paths.get(endpoint)
+        if path is None:
+            path = next(
+                (
+                    route.path
+                    for route in scope["app"].routes
+                    if getattr(route, "endpoint", None) is endpoint
+                ),
+                "unmatched",
+            )
+            self._route_paths[endpoint] = path
+        return path
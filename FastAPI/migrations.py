@@ -0,0 +1,317 @@
+"""
+Schema migrations for plant swap databases
+
+models.Base.metadata.create_all only creates tables that are missing; it
+never changes a table that already exists. So that existing plants.db
+files keep working as the models change, each migration below brings a
+database from one schema version to the next, in place. The version
+reached is stored in the schema_version table, so upgrade is safe to
+run every time the app starts.
+
+To add a migration, append a function taking a connection to MIGRATIONS.
+A new database is created directly at the latest version by create_all,
+plus the parts of the schema that are not sqlalchemy models (such as
+the search and location indexes; see search.py and geo.py).
+
+Run with
+$ poetry run python migrations.py
+"""
+
+import datetime
+import logging
+
+from sqlalchemy import Connection, Engine, MetaData, inspect, select, insert, update
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateTable
+
+import geo
+import matching
+import models
+import schemas
+import search
+import stats
+from database import engine
+
+logger = logging.getLogger("plantswap.migrations")
+
+# Rows copied per INSERT when a migration rebuilds a table
+BATCH_SIZE = 1000
+
+# The format of the dates the React client used to send, from
+# toLocaleDateString in the default (US) locale, e.g. 10/8/2023
+LEGACY_DATE_FORMAT = "%m/%d/%Y"
+
+
+def rebuild_table(conn: Connection, table, convert=None):
+    """
+    Rebuild an existing table to match its current model, copying its rows
+
+    SQLite cannot change the type of a column, so a table is changed by
+    creating the new table alongside it, copying the rows across and
+    swapping the new table in.
+
+    :param conn: Connection, in a transaction
+    :param table: The (new) sqlalchemy Table of the model
+    :param convert: Optional function applied to each row dict as it is copied
+    """
+    new_name = f"_{table.name}_new"
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {new_name}")
+    # Copy the other tables too, so foreign keys to them resolve
+    new_metadata = MetaData()
+    for other in models.Base.metadata.sorted_tables:
+        if other is not table:
+            other.to_metadata(new_metadata)
+    new_table = table.to_metadata(new_metadata, name=new_name)
+    conn.execute(CreateTable(new_table))
+
+    old_metadata = MetaData()
+    old_metadata.reflect(conn, only=[table.name])
+    old_table = old_metadata.tables[table.name]
+    rows = conn.execute(
+        select(*[col for col in old_table.columns if col.name in table.columns])
+    ).mappings()
+    while batch := rows.fetchmany(BATCH_SIZE):
+        batch = [dict(row) for row in batch]
+        if convert is not None:
+            batch = [convert(row) for row in batch]
+        conn.execute(insert(new_table), batch)
+
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {new_name} RENAME TO {table.name}")
+    for index in table.indexes:
+        index.create(conn)
+
+
+def add_column(conn: Connection, column):
+    """
+    Add a column of a model to its existing table, if it is not there yet
+
+    :param conn: Connection, in a transaction
+    :param column: The sqlalchemy Column of the model
+    """
+    existing = {col["name"] for col in inspect(conn).get_columns(column.table.name)}
+    if column.name not in existing:
+        column_type = column.type.compile(dialect=conn.dialect)
+        conn.exec_driver_sql(
+            f"ALTER TABLE {column.table.name} ADD COLUMN {column.name} {column_type}"
+        )
+
+
+def parse_legacy_date(text) -> datetime.date | None:
+    """
+    Parse a date as the React client used to send them (M/D/YYYY)
+
+    :param text: The date's text
+    :returns: The date, or None if it is not in that format
+    """
+    try:
+        return datetime.datetime.strptime(text.strip(), LEGACY_DATE_FORMAT).date()
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+
+def convert_date(row: dict, legacy: list) -> dict:
+    """
+    Convert the date of a row from the old free-form string to a date
+
+    ISO dates are kept as they are. Any other date is read as M/D/YYYY,
+    which may be wrong (clients in other locales sent e.g. D/M/YYYY), or
+    set to None if it is not in that format either; either way its text
+    is appended to legacy, to be kept in the legacy_dates table.
+
+    :param row: Row as a dict with id and date keys
+    :param legacy: List of the texts of dates that were not ISO dates,
+                   as dicts with row_id and date_text keys
+    :returns: The row, with its date converted
+    """
+    text = row["date"]
+    if text is None:
+        return row
+    try:
+        row["date"] = schemas.parse_date(text)
+    except (ValueError, TypeError, AttributeError):
+        legacy.append({"row_id": row["id"], "date_text": text})
+        row["date"] = parse_legacy_date(text)
+    return row
+
+
+def typed_dates_and_indexes(conn: Connection):
+    """
+    Version 1: store share and request dates as dates, index the columns
+    the listings filter and sort on, and reference users by username.
+    The text of dates that were not ISO dates is kept in legacy_dates.
+    """
+    models.LegacyDates.__table__.create(conn, checkfirst=True)
+    for model in (models.Shares, models.Requests):
+        legacy = []
+        rebuild_table(conn, model.__table__, lambda row: convert_date(row, legacy))
+        if not legacy:
+            continue
+        conn.execute(
+            insert(models.LegacyDates),
+            [{"table_name": model.__tablename__, **entry} for entry in legacy],
+        )
+        unread = sum(
+            1 for entry in legacy if parse_legacy_date(entry["date_text"]) is None
+        )
+        logger.warning(
+            "%s %s dates were read as M/D/YYYY and %s could not be read (set "
+            "to NULL); their original text is in the legacy_dates table",
+            len(legacy) - unread,
+            model.__tablename__,
+            unread,
+        )
+
+
+def plant_matching(conn: Connection):
+    """
+    Version 2: add normalized plant names to shares and requests, and
+    match up the existing shares and requests
+    """
+    for model in (models.Shares, models.Requests):
+        add_column(conn, model.__table__.c.plant_key)
+        names = conn.execute(select(model.plant_name).distinct()).scalars().all()
+        for name in names:
+            conn.execute(
+                update(model)
+                .where(model.plant_name == name)
+                .values(plant_key=models.normalize_plant_name(name))
+            )
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+    models.Matches.__table__.create(conn, checkfirst=True)
+    with Session(bind=conn) as db:
+        matching.rematch_all(db)
+        db.flush()
+
+
+def search_index(conn: Connection):
+    """Version 3: index the existing shares and requests for search"""
+    search.create_index(conn)
+    search.rebuild_index(conn)
+
+
+def archive_indexes(conn: Connection):
+    """
+    Version 4: index share and request dates, for finding the ones to
+    archive (the archive tables themselves are new, so create_all makes them)
+    """
+    for model in (models.Shares, models.Requests):
+        for index in model.__table__.indexes:
+            index.create(conn, checkfirst=True)
+
+
+def locations(conn: Connection):
+    """
+    Version 5: add optional locations to users, shares and requests, and
+    index them (see geo.py)
+    """
+    located = [
+        models.User,
+        models.Shares,
+        models.Requests,
+        models.ArchivedShares,
+        models.ArchivedRequests,
+    ]
+    for model in located:
+        # The archive tables are new if the database was before version 4
+        if inspect(conn).has_table(model.__tablename__):
+            add_column(conn, model.__table__.c.latitude)
+            add_column(conn, model.__table__.c.longitude)
+    geo.create_index(conn)
+    geo.rebuild_index(conn)
+
+
+def summary_statistics(conn: Connection):
+    """
+    Version 6: add the plant and user statistics, counting the existing
+    shares and requests (see stats.py)
+    """
+    for model in (models.PlantStats, models.UserStats):
+        model.__table__.create(conn, checkfirst=True)
+    with Session(bind=conn) as db:
+        stats.reconcile(db)
+        db.flush()
+
+
+def share_photos(conn: Connection):
+    """Version 7: add optional photos to shares (see photos.py)"""
+    for model in (models.Shares, models.ArchivedShares):
+        if inspect(conn).has_table(model.__tablename__):
+            add_column(conn, model.__table__.c.photo_hash)
+
+
+def bounded_matches(conn: Connection):
+    """
+    Version 8: keep only the best few matches of each request, scored
+    when they are read (see matching.py), instead of every pair
+    """
+    columns = {col["name"] for col in inspect(conn).get_columns("matches")}
+    if "posted_day" in columns:
+        # Made by version 2 from the current model
+        return
+    models.Matches.__table__.drop(conn)
+    models.Matches.__table__.create(conn)
+    with Session(bind=conn) as db:
+        matching.rematch_all(db)
+        db.flush()
+
+
+# Migration i brings the schema from version i to version i + 1
+MIGRATIONS = [
+    typed_dates_and_indexes,
+    plant_matching,
+    search_index,
+    archive_indexes,
+    locations,
+    summary_statistics,
+    share_photos,
+    bounded_matches,
+]
+LATEST_VERSION = len(MIGRATIONS)
+
+
+def get_version(conn: Connection) -> int | None:
+    """
+    Get the schema version of the database
+
+    :param conn: Connection to the database
+    :returns: The version, 0 for a database from before versioning, or
+              None for an empty database
+    """
+    inspector = inspect(conn)
+    if inspector.has_table(models.SchemaVersion.__tablename__):
+        return conn.execute(select(models.SchemaVersion.version)).scalar() or 0
+    if inspector.has_table(models.Shares.__tablename__):
+        return 0
+    return None
+
+
+def set_version(conn: Connection, version: int):
+    """Record the schema version of the database"""
+    conn.execute(models.SchemaVersion.__table__.delete())
+    conn.execute(insert(models.SchemaVersion), {"version": version})
+
+
+def upgrade(bind: Engine = engine):
+    """
+    Bring the database up to the latest schema version, creating it if needed
+
+    :param bind: Engine for the database
+    :returns: The version the database was at before upgrading (None if new)
+    """
+    with bind.begin() as conn:
+        version = get_version(conn)
+        if version is not None:
+            for migration in MIGRATIONS[version:]:
+                migration(conn)
+        models.Base.metadata.create_all(bind=conn)
+        search.create_index(conn)
+        geo.create_index(conn)
+        set_version(conn, LATEST_VERSION)
+    return version
+
+
+if __name__ == "__main__":
+    old_version = upgrade()
+    print(f"Upgraded database from version {old_version} to {LATEST_VERSION}")
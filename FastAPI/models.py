@@ -1,8 +1,43 @@
+import re
+
 from database import Base
-from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey
+from sqlalchemy import Column, Integer, String, Boolean, Float, ForeignKey, Date, DateTime, Index, JSON, case, func, null
+from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import relationship
 
 
+def normalize_plant_name(plant_name: str | None) -> str:
+    """
+    Normalize a plant name for matching, so that e.g. "Inside-out  Flower"
+    and "inside out flower" are the same plant
+
+    :param plant_name: The plant name as posted
+    :returns: Lowercase words of the name separated by single spaces
+    """
+    return " ".join(re.findall(r"[a-z0-9]+", (plant_name or "").lower()))
+
+
+# URLs of the photos of shares, by their SHA-256 (see photos.py), and of
+# their thumbnails
+PHOTO_URL_PREFIX = "/photos/"
+THUMBNAIL_URL_SUFFIX = "/thumbnail"
+
+
+def photo_url(photo_hash: str) -> str:
+    """URL of a photo of a share"""
+    return PHOTO_URL_PREFIX + photo_hash
+
+
+def thumbnail_url(photo_hash: str) -> str:
+    """URL of the thumbnail of a photo of a share"""
+    return PHOTO_URL_PREFIX + photo_hash + THUMBNAIL_URL_SUFFIX
+
+
+def plant_key_default(context):
+    """Column default that fills in plant_key from the row's plant_name"""
+    return normalize_plant_name(context.get_current_parameters().get("plant_name"))
+
+
 class User(Base):
     __tablename__ = "users"
 
@@ -10,6 +45,9 @@ class User(Base):
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
+    # Default location of the user's shares and requests, in degrees
+    latitude = Column(Float)
+    longitude = Column(Float)
     # email = Column(String, unique=True, index=True)
     
     # When accessing my_user.items, SQLAlchemy will fetch the items 
@@ -32,24 +70,218 @@ class Item(Base):
 class Shares(Base):
     """Plant shares"""
     __tablename__ = "shares"
+    # Per-user listings and availability filters are ordered by date,
+    # so index those columns together with the date
+    __table_args__ = (
+        Index("ix_shares_shared_by_date", "shared_by", "date"),
+        Index("ix_shares_is_available_now_date", "is_available_now", "date"),
+        Index("ix_shares_plant_key_is_available_now", "plant_key", "is_available_now"),
+        # For finding stale shares to archive
+        Index("ix_shares_date", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    plant_name = Column(String)
-    shared_by = Column(String)
+    plant_name = Column(String, index=True)
+    # Normalized plant_name, for matching with requests
+    plant_key = Column(String, default=plant_key_default)
+    shared_by = Column(String, ForeignKey("users.username"))
     amount = Column(Float)
     description = Column(String)
     is_available_now = Column(Boolean)
-    date = Column(String)
+    date = Column(Date)
+    # Where the plant is, in degrees; both or neither (see geo.py)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    # SHA-256 of the share's photo, which is stored by it; see photos.py
+    photo_hash = Column(String)
+
+    @hybrid_property
+    def thumbnail_url(self):
+        """URL of the thumbnail of the share's photo; None if it has none"""
+        if self.photo_hash is None:
+            return None
+        return thumbnail_url(self.photo_hash)
+
+    @thumbnail_url.expression
+    def thumbnail_url(cls):
+        # The same URL, made in SQL, for the listings' plain rows
+        return case(
+            (
+                cls.photo_hash.is_not(None),
+                PHOTO_URL_PREFIX + cls.photo_hash + THUMBNAIL_URL_SUFFIX,
+            ),
+            else_=null(),
+        )
 
 
 class Requests(Base):
     """Plant requests"""
     __tablename__ = "requests"
+    __table_args__ = (
+        Index("ix_requests_requested_by_date", "requested_by", "date"),
+        Index("ix_requests_date", "date"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
+    plant_name = Column(String, index=True)
+    plant_key = Column(String, index=True, default=plant_key_default)
+    requested_by = Column(String, ForeignKey("users.username"))
+    amount = Column(Float)
+    notes = Column(String)
+    date = Column(Date)
+    # Where the requester is, in degrees; both or neither
+    latitude = Column(Float)
+    longitude = Column(Float)
+
+
+class ArchivedShares(Base):
+    """
+    Shares moved out of the shares table once they were old enough; see
+    archive.py. They keep their ids.
+    """
+    __tablename__ = "shares_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    plant_name = Column(String)
+    plant_key = Column(String)
+    shared_by = Column(String)
+    amount = Column(Float)
+    description = Column(String)
+    is_available_now = Column(Boolean)
+    date = Column(Date)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    photo_hash = Column(String)
+    archived_at = Column(DateTime, server_default=func.now())
+
+
+class ArchivedRequests(Base):
+    """Requests moved out of the requests table; see ArchivedShares"""
+    __tablename__ = "requests_archive"
+
+    id = Column(Integer, primary_key=True, autoincrement=False)
     plant_name = Column(String)
+    plant_key = Column(String)
     requested_by = Column(String)
     amount = Column(Float)
     notes = Column(String)
-    date = Column(String)
+    date = Column(Date)
+    latitude = Column(Float)
+    longitude = Column(Float)
+    archived_at = Column(DateTime, server_default=func.now())
+
+
+class Matches(Base):
+    """
+    The best available shares for each request, of the same plant; kept
+    up to date by matching.py as shares and requests come and go
+    """
+    __tablename__ = "matches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    share_id = Column(Integer, ForeignKey("shares.id"), index=True)
+    request_id = Column(Integer, ForeignKey("requests.id"), index=True)
+    plant_key = Column(String, index=True)
+    # How well the share covers the request (see matching.amount_fit),
+    # and the day the older of the two was posted, as date.toordinal();
+    # the score is computed from them when matches are read
+    amount_fit = Column(Float)
+    posted_day = Column(Integer)
+
+    share = relationship("Shares")
+    request = relationship("Requests")
+
+
+class TableVersion(Base):
+    """
+    Version number of a table's contents, increased by every change to
+    the table, in the same transaction; see listing_cache.py
+    """
+    __tablename__ = "table_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class Event(Base):
+    """
+    Log of recent changes to shares and requests, for the change feed;
+    see events.py
+    """
+    __tablename__ = "events"
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String)
+    # "create", "update" or "delete"
+    op = Column(String)
+    row_id = Column(Integer)
+    # The created row, as in the listings, or the updated columns (with
+    # the id); None for deletes
+    data = Column(JSON)
+    created_at = Column(DateTime, server_default=func.now())
+
+
+class PlantStats(Base):
+    """
+    Supply and demand of each plant: the number and total amount of its
+    current shares and requests. Kept up to date by stats.py as shares
+    and requests come and go, and reconciled with them periodically.
+    """
+    __tablename__ = "plant_stats"
+    __table_args__ = (
+        Index("ix_plant_stats_shares_amount", "shares_amount"),
+        Index("ix_plant_stats_requests_amount", "requests_amount"),
+    )
+
+    plant_key = Column(String, primary_key=True)
+    # The plant name as first posted
+    plant_name = Column(String)
+    shares_count = Column(Integer, nullable=False, default=0)
+    shares_amount = Column(Float, nullable=False, default=0)
+    requests_count = Column(Integer, nullable=False, default=0)
+    requests_amount = Column(Float, nullable=False, default=0)
+
+
+class UserStats(Base):
+    """Number of current shares and requests of each user; see PlantStats"""
+    __tablename__ = "user_stats"
+    __table_args__ = (
+        Index("ix_user_stats_shares_count", "shares_count"),
+        Index("ix_user_stats_requests_count", "requests_count"),
+    )
+
+    username = Column(String, primary_key=True)
+    shares_count = Column(Integer, nullable=False, default=0)
+    requests_count = Column(Integer, nullable=False, default=0)
+
+
+class Community(Base):
+    """
+    A community with its own database (see shards.py); listed in the
+    default database only
+    """
+    __tablename__ = "communities"
+
+    id = Column(String, primary_key=True)
+    created_at = Column(DateTime, server_default=func.now())
+
+
+class LegacyDates(Base):
+    """
+    The original text of share and request dates that were not ISO dates
+    before dates were typed (schema version 1; see migrations.py), so
+    that dates misread or unreadable then can still be put right
+    """
+    __tablename__ = "legacy_dates"
+
+    table_name = Column(String, primary_key=True)
+    row_id = Column(Integer, primary_key=True)
+    date_text = Column(String)
+
+
+class SchemaVersion(Base):
+    """The schema version of the database; see migrations.py"""
+    __tablename__ = "schema_version"
+
+    version = Column(Integer, primary_key=True)
 
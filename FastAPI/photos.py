@@ -0,0 +1,427 @@
+"""
+Photos of shares
+
+A share can have a photo, uploaded as multipart/form-data (field
+"photo") to POST /shares/{id}/photo. The body is parsed as it streams
+in and the photo written to disk a chunk at a time, so an upload never
+sits in memory whole. Photos are stored by the SHA-256 of their
+contents (content-addressed): the same photo posted twice, or for
+several shares, is stored once, and a stored photo never changes, so it
+can be cached by clients for good.
+
+Thumbnails (JPEG, at most config.THUMBNAIL_SIZE pixels on a side) are
+made in a pool of config.THUMBNAIL_WORKERS threads after the upload is
+answered, or when first asked for. They need Pillow (the "photos"
+extra); without it the thumbnail URL serves the photo itself. Listings
+carry only the thumbnail URL of each share (see models.Shares), never
+the photo.
+
+Photos and thumbnails are served with support for Range requests (e.g.
+resuming a download) and for conditional requests on their ETag.
+
+A photo no share has any more (the share was deleted, or given another
+photo) is removed by the archiver (see archive.py) once it is
+config.PHOTO_ORPHAN_AGE seconds old, with its thumbnail.
+"""
+
+import asyncio
+import contextlib
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+from multipart.multipart import MultipartParser, parse_options_header
+
+import config
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger("plantswap.photos")
+
+# Bytes read from disk at a time when serving
+CHUNK_SIZE = 64 * 1024
+
+# The form field of the photo in uploads
+PHOTO_FIELD = b"photo"
+
+# Photo and thumbnail ids: SHA-256 in hex
+HASH_PATTERN = re.compile(r"[0-9a-f]{64}")
+
+# Photos never change, so clients may keep them
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+class PhotoTooLarge(ValueError):
+    """An upload is larger than config.PHOTO_MAX_BYTES"""
+
+
+def image_type(head: bytes) -> str | None:
+    """
+    Tell the type of an image from its first bytes, rather than trusting
+    the Content-Type sent with it
+
+    :param head: The first 12 bytes (or more) of the file
+    :returns: The media type; None if it is not a JPEG, PNG, GIF or WebP image
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def photo_path(photo_hash: str) -> str:
+    """Get the file of a stored photo; photos are spread over 256 directories"""
+    return os.path.join(config.PHOTO_DIR, photo_hash[:2], photo_hash)
+
+
+def thumbnail_path(photo_hash: str) -> str:
+    """Get the file of the thumbnail of a stored photo"""
+    return photo_path(photo_hash) + ".thumb.jpg"
+
+
+def store(temp_path: str, photo_hash: str):
+    """
+    Move an uploaded file into the store, unless the same photo is
+    already there
+
+    :param temp_path: The uploaded file, in config.PHOTO_DIR
+    :param photo_hash: Its SHA-256
+    """
+    path = photo_path(photo_hash)
+    if os.path.exists(path):
+        os.remove(temp_path)
+        # Counts as new, so it is not removed as an orphan before the
+        # share is given it (see remove_orphans)
+        os.utime(path)
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    os.replace(temp_path, path)
+
+
+async def receive_photo(request: Request) -> str:
+    """
+    Store the photo uploaded in a multipart/form-data request, reading
+    and writing it a chunk at a time
+
+    :param request: The request, with the photo in its "photo" field
+    :returns: The photo's SHA-256, by which it is stored
+    :raises PhotoTooLarge if the photo is larger than config.PHOTO_MAX_BYTES
+    :raises ValueError if the body is not a form with a photo in it, or
+            the photo is not a JPEG, PNG, GIF or WebP image
+    """
+    content_type, options = parse_options_header(request.headers.get("content-type", ""))
+    boundary = options.get(b"boundary")
+    if content_type != b"multipart/form-data" or not boundary:
+        raise ValueError("The photo must be sent as multipart/form-data")
+    if int(request.headers.get("content-length") or 0) > 2 * config.PHOTO_MAX_BYTES:
+        raise PhotoTooLarge(f"Photos can be at most {config.PHOTO_MAX_BYTES} bytes")
+
+    # The parser calls these back as it goes; the photo's data is
+    # collected per chunk of the body and written out after each
+    part = {}
+    pieces = []
+    # Only the first photo field is taken
+    found = []
+
+    def on_part_begin():
+        part.clear()
+        part["headers"] = {}
+
+    def on_header_field(data, start, end):
+        part["field"] = part.get("field", b"") + data[start:end]
+
+    def on_header_value(data, start, end):
+        part["value"] = part.get("value", b"") + data[start:end]
+
+    def on_header_end():
+        part["headers"][part.pop("field", b"").lower()] = part.pop("value", b"")
+
+    def on_headers_finished():
+        _, disposition = parse_options_header(part["headers"].get(b"content-disposition"))
+        part["is_photo"] = disposition.get(b"name") == PHOTO_FIELD and not found
+        if part["is_photo"]:
+            found.append(True)
+
+    def on_part_data(data, start, end):
+        if part.get("is_photo"):
+            pieces.append(data[start:end])
+
+    parser = MultipartParser(
+        boundary,
+        {
+            "on_part_begin": on_part_begin,
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": on_part_data,
+        },
+    )
+    os.makedirs(config.PHOTO_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    head = b""
+    file = tempfile.NamedTemporaryFile(dir=config.PHOTO_DIR, suffix=".upload", delete=False)
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            if not pieces:
+                continue
+            data = b"".join(pieces)
+            pieces.clear()
+            size += len(data)
+            if size > config.PHOTO_MAX_BYTES:
+                raise PhotoTooLarge(f"Photos can be at most {config.PHOTO_MAX_BYTES} bytes")
+            if len(head) < 12:
+                head = (head + data)[:12]
+            digest.update(data)
+            await asyncio.to_thread(file.write, data)
+        parser.finalize()
+        file.close()
+        if not found:
+            raise ValueError('No "photo" field in the form')
+        if image_type(head) is None:
+            raise ValueError("The photo must be a JPEG, PNG, GIF or WebP image")
+        photo_hash = digest.hexdigest()
+        await asyncio.to_thread(store, file.name, photo_hash)
+    except BaseException:
+        file.close()
+        if os.path.exists(file.name):
+            os.remove(file.name)
+        raise
+    return photo_hash
+
+
+def make_thumbnail(photo_hash: str):
+    """
+    Make the thumbnail of a stored photo, if it is not made yet; runs in
+    the thumbnail pool
+
+    :param photo_hash: The photo's SHA-256
+    """
+    path = thumbnail_path(photo_hash)
+    if os.path.exists(path):
+        return
+    with Image.open(photo_path(photo_hash)) as image:
+        image.thumbnail((config.THUMBNAIL_SIZE, config.THUMBNAIL_SIZE))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        # Written aside and moved into place, so it is never seen half made
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        image.save(temp_path, "JPEG", quality=85, optimize=True)
+    os.replace(temp_path, path)
+
+
+# Thumbnails are made in this pool, so that they do not hold up the
+# event loop; its size limits how many are made at once
+thumbnail_executor = ThreadPoolExecutor(
+    max_workers=config.THUMBNAIL_WORKERS, thread_name_prefix="thumbnail"
+)
+
+# Thumbnails being made, by photo, so that each is made once
+pending_thumbnails: dict[str, asyncio.Future] = {}
+
+
+async def ensure_thumbnail(photo_hash: str) -> str | None:
+    """
+    Get the thumbnail of a stored photo, waiting for it to be made if
+    it is not yet
+
+    :param photo_hash: The photo's SHA-256
+    :returns: The thumbnail's file; None if thumbnails cannot be made
+              (Pillow is not installed, or the photo is not readable)
+    """
+    path = thumbnail_path(photo_hash)
+    if os.path.exists(path):
+        return path
+    if Image is None:
+        return None
+    future = pending_thumbnails.get(photo_hash)
+    if future is None:
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(thumbnail_executor, make_thumbnail, photo_hash)
+        pending_thumbnails[photo_hash] = future
+        future.add_done_callback(lambda _: pending_thumbnails.pop(photo_hash, None))
+    try:
+        # Shielded, so a client going away does not lose the thumbnail
+        await asyncio.shield(future)
+    except Exception:
+        logger.warning("Making the thumbnail of %s failed", photo_hash, exc_info=True)
+        return None
+    return path
+
+
+# Thumbnails being made in the background, kept until done, since the
+# event loop only keeps weak references to tasks
+thumbnail_tasks: set[asyncio.Task] = set()
+
+
+def schedule_thumbnail(photo_hash: str):
+    """Start making the thumbnail of a newly stored photo, in the background"""
+    if Image is not None and not os.path.exists(thumbnail_path(photo_hash)):
+        task = asyncio.create_task(ensure_thumbnail(photo_hash))
+        thumbnail_tasks.add(task)
+        task.add_done_callback(thumbnail_tasks.discard)
+
+
+def remove_orphans(referenced: set[str], min_age: float) -> int:
+    """
+    Remove the stored photos that no share has, with their thumbnails,
+    and uploads left behind by a crash; runs in a thread. Only files at
+    least min_age seconds old are removed, so that a photo just uploaded
+    is kept until its share is given it.
+
+    :param referenced: The photos the shares (and archived shares) have
+    :param min_age: Seconds since a file was last modified before it
+                    can be removed
+    :returns: The number of files removed
+    """
+    cutoff = time.time() - min_age
+    removed = 0
+    for directory, _, names in os.walk(config.PHOTO_DIR):
+        for name in names:
+            photo_hash = name[:64]
+            if HASH_PATTERN.fullmatch(photo_hash):
+                if photo_hash in referenced:
+                    continue
+            elif not name.endswith(".upload"):
+                # Not one of ours
+                continue
+            path = os.path.join(directory, name)
+            # Another worker may be removing it too
+            with contextlib.suppress(FileNotFoundError):
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+                    removed += 1
+    return removed
+
+
+def parse_range(header: str | None, size: int) -> tuple[int, int] | None:
+    """
+    Get the byte range asked for by a Range header
+
+    Only single ranges are served; for anything else (several ranges,
+    other units, bad syntax) the whole file is, as HTTP allows.
+
+    :param header: The Range header, e.g. "bytes=0-1023", "bytes=1024-"
+                   or "bytes=-500" (the last 500 bytes)
+    :param size: Size of the file
+    :returns: (first byte, last byte), inclusive; None for the whole file
+    :raises ValueError if the range is outside the file
+    """
+    match = re.fullmatch(r"\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*", header or "")
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # A suffix: the last so many bytes
+        length = int(last)
+        if length == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+    first = int(first)
+    if last != "" and int(last) < first:
+        # e.g. bytes=10-5 is not a range at all, so it is ignored
+        return None
+    if first >= size:
+        raise ValueError("Range not satisfiable")
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    return first, last
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Whether an If-None-Match header includes the ETag (weakly compared)"""
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def file_info(path: str) -> tuple[int, str]:
+    """
+    Get the size and media type of a stored photo or thumbnail; runs in
+    a thread
+
+    :param path: The file
+    :returns: (size in bytes, media type)
+    """
+    with open(path, "rb") as file:
+        size = os.fstat(file.fileno()).st_size
+        media_type = image_type(file.read(12)) or "application/octet-stream"
+    return size, media_type
+
+
+async def read_file(path: str, first: int, length: int):
+    """
+    Read part of a file a chunk at a time, off the event loop
+
+    :param path: The file
+    :param first: Offset of the first byte
+    :param length: Number of bytes
+    :returns: Async generator of the chunks
+    """
+    file = await asyncio.to_thread(open, path, "rb")
+    try:
+        await asyncio.to_thread(file.seek, first)
+        while length > 0:
+            chunk = await asyncio.to_thread(file.read, min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        file.close()
+
+
+async def file_response(request: Request, path: str, etag: str) -> Response:
+    """
+    Serve a stored photo or thumbnail, honouring If-None-Match, Range
+    and If-Range
+
+    :param request: The request
+    :param path: The file
+    :param etag: The file's (strong) ETag
+    :returns: 200 with the file, 206 with the range asked for, 304 if
+              the client has it, or 416 if the range is outside the file
+    """
+    headers = {"ETag": etag, "Cache-Control": CACHE_CONTROL, "Accept-Ranges": "bytes"}
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+    size, media_type = await asyncio.to_thread(file_info, path)
+    byte_range = None
+    if_range = request.headers.get("if-range")
+    # A range of a file the client no longer has the right version of
+    # would be garbage, so then the whole file is sent
+    if if_range is None or if_range.strip() == etag:
+        try:
+            byte_range = parse_range(request.headers.get("range"), size)
+        except ValueError:
+            return Response(
+                status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"}
+            )
+    if byte_range is None:
+        first, last, status_code = 0, size - 1, 200
+    else:
+        (first, last), status_code = byte_range, 206
+        headers["Content-Range"] = f"bytes {first}-{last}/{size}"
+    headers["Content-Length"] = str(last - first + 1)
+    return StreamingResponse(
+        read_file(path, first, last - first + 1),
+        status_code=status_code,
+        media_type=media_type,
+        headers=headers,
+    )
@@ -0,0 +1,190 @@
+"""
+Rate limiting of the endpoints that hash passwords
+
+Logging in (POST /token) and signing up (POST /users/) each cost a
+bcrypt hash, so a client retrying in a loop, or guessing passwords, can
+keep the CPU busy cheaply. Each is limited with token buckets: one per
+client IP and, for logins, one per username, so that guessing one
+user's password from many addresses is limited too. A bucket holds up
+to N tokens and refills at N per period; a request takes a token, and
+is rejected with 429 Too Many Requests when there is none. The check
+is a dependency of the endpoint, so it runs before any password work.
+
+The limits are set per route in config.RATE_LIMITS. Buckets are kept
+by a backend: by default in the memory of each process, in O(1) space
+per key, forgetting the least recently used keys beyond
+config.RATE_LIMIT_MAX_KEYS. With several worker processes each keeps
+its own buckets, so the effective limit is multiplied by the number of
+workers; config.RATE_LIMIT_BACKEND can name a RateLimitBackend shared
+between them instead (e.g. one on Redis).
+
+Behind a reverse proxy every request comes from the proxy's address,
+so the client IP is taken from X-Forwarded-For when the request comes
+from one of config.TRUSTED_PROXIES. The header is not trusted from
+other addresses, since any client can send it.
+"""
+
+import abc
+import importlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+from fastapi import HTTPException, Request, status
+
+import config
+
+
+@dataclass(frozen=True)
+class Rate:
+    """A limit of count requests per period seconds, allowing bursts of count"""
+    count: int
+    period: float
+
+    @classmethod
+    def parse(cls, text: str):
+        """
+        Parse a rate
+
+        :param text: "count/seconds", e.g. "10/60"; empty for no limit
+        :returns: The rate, or None for no limit
+        :raises ValueError if the text is not a rate
+        """
+        if not text.strip():
+            return None
+        count, period = text.split("/")
+        return cls(int(count), float(period))
+
+
+class RateLimitBackend(abc.ABC):
+    """Keeps the token buckets; subclass to keep them elsewhere"""
+
+    @abc.abstractmethod
+    def acquire(self, key: str, rate: Rate) -> float:
+        """
+        Take a token from a bucket, if there is one
+
+        :param key: The bucket
+        :param rate: The bucket's size and refill rate
+        :returns: 0 if a token was taken, else seconds until there is one
+        """
+
+    @abc.abstractmethod
+    def reset(self):
+        """Forget all buckets"""
+
+
+class InMemoryBackend(RateLimitBackend):
+    """
+    Token buckets in this process's memory, at most max_keys of them.
+    A bucket is just (tokens, time last updated); the least recently
+    used buckets are forgotten first, which is as if they were full.
+    """
+
+    def __init__(self, max_keys: int, timer=time.monotonic):
+        """
+        :param max_keys: Most buckets kept
+        :param timer: Clock giving the time in seconds
+        """
+        self.max_keys = max_keys
+        self.timer = timer
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, key: str, rate: Rate) -> float:
+        now = self.timer()
+        refill_rate = rate.count / rate.period
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (rate.count, now))
+            tokens = min(rate.count, tokens + (now - updated) * refill_rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0.0
+            else:
+                wait = (1 - tokens) / refill_rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def reset(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+def load_backend(path: str) -> RateLimitBackend:
+    """
+    Make the configured backend
+
+    :param path: "module:ClassName" of a RateLimitBackend subclass, which
+                 is made with no arguments; empty for InMemoryBackend
+    :returns: The backend
+    """
+    if not path:
+        return InMemoryBackend(config.RATE_LIMIT_MAX_KEYS)
+    module, name = path.split(":")
+    return getattr(importlib.import_module(module), name)()
+
+
+backend = load_backend(config.RATE_LIMIT_BACKEND)
+
+# The limits by route, then by "ip" or "username"
+LIMITS = {
+    route: {kind: Rate.parse(text) for kind, text in limits.items()}
+    for route, limits in config.RATE_LIMITS.items()
+}
+
+
+def client_ip(request: Request) -> str | None:
+    """
+    Get the address of the client that sent a request, as given by the
+    trusted proxies it passed through, if any
+
+    :param request: The request
+    :returns: The address; None if unknown
+    """
+    if request.client is None:
+        return None
+    address = request.client.host
+    forwarded = request.headers.get("x-forwarded-for")
+    if address not in config.TRUSTED_PROXIES or not forwarded:
+        return address
+    # Each proxy appends the address it got the request from, so the
+    # client is the last address not of a trusted proxy
+    for hop in reversed(forwarded.split(",")):
+        address = hop.strip()
+        if address not in config.TRUSTED_PROXIES:
+            break
+    return address
+
+
+def check(route: str, request: Request, username: str | None = None):
+    """
+    Take a token from the client IP's bucket for a route and, if given,
+    the username's
+
+    :param route: Name of the route's limits in LIMITS
+    :param request: The request, for the client IP (see client_ip)
+    :param username: The username the request is for, if any
+    :raises HTTPException 429, with Retry-After, if a bucket is empty
+    """
+    limits = LIMITS.get(route, {})
+    keys = []
+    ip = client_ip(request)
+    if limits.get("ip") and ip is not None:
+        keys.append((f"{route}:ip:{ip}", limits["ip"]))
+    if limits.get("username") and username is not None:
+        keys.append((f"{route}:username:{username.lower()}", limits["username"]))
+    # Every bucket is charged, so a client cannot spread its attempts
+    wait = max([backend.acquire(key, rate) for key, rate in keys], default=0)
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many attempts; try again later",
+            headers={"Retry-After": str(max(1, round(wait)))},
+        )
@@ -0,0 +1,228 @@
+"""
+Read replicas of the default database
+
+Listings are read far more often than shares and requests are posted,
+so GET listings can read from copies of the database
+(config.READ_REPLICA_URLS, see database.ReadSession) and leave the
+database itself to the writes: heavy reads then never hold up commits.
+
+A replica may be a server replica (e.g. a Postgres streaming replica,
+kept up to date by the server), or, for an SQLite database, another
+SQLite file that ReplicaCopier copies the database to every
+config.READ_REPLICA_COPY_INTERVAL seconds with SQLite's online backup
+API. A copy is a single read transaction on the database, which in WAL
+mode does not block writers, and is skipped when nothing changed. It
+copies the whole file, though, so the interval is best kept to tens of
+seconds for a large database. With
+several worker processes, let one of them copy (or run
+"python replicas.py" on its own) and set the interval to 0 for the
+rest.
+
+Replicas are a little behind, so for config.READ_YOUR_WRITES_SECONDS
+after a client's own POST, PUT or DELETE its reads go to the database
+itself (see ReadYourWritesMiddleware): a user sees the share they just
+posted. That time is kept in a cookie, so browser clients on another
+origin must send credentials (fetch's credentials: "include", axios's
+withCredentials), which CORS allows for the origins in main.py.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import logging
+import sqlite3
+import time
+from http.cookies import SimpleCookie
+
+from sqlalchemy import make_url
+
+import config
+import database
+
+logger = logging.getLogger("plantswap.replicas")
+
+# Cookie holding the time until which a client reads from the database
+# itself, as seconds since the epoch
+PRIMARY_COOKIE = "plantswap_primary_until"
+
+# Methods that do not change anything
+SAFE_METHODS = {"GET", "HEAD", "OPTIONS"}
+
+
+def sqlite_path(url: str) -> str | None:
+    """
+    Get the file of an SQLite database URL
+
+    :param url: Database URL
+    :returns: The file path; None if the database is not an SQLite file
+    """
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+        return None
+    return url.database
+
+
+class ReplicaCopier:
+    """
+    Copies the default database, if it is SQLite, to the SQLite read
+    replicas whenever it changed
+    """
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+        # Connection reading the database; kept open so that
+        # PRAGMA data_version tells whether others changed it since
+        self._source: sqlite3.Connection | None = None
+        self._copied_version = None
+
+    @property
+    def replica_paths(self) -> list[str]:
+        """Files of the SQLite replicas to copy to"""
+        if sqlite_path(database.URL_DATABASE) is None:
+            return []
+        return [
+            path for path in map(sqlite_path, config.READ_REPLICA_URLS) if path is not None
+        ]
+
+    def copy(self) -> bool:
+        """
+        Copy the database to the replicas if it changed since the last copy
+
+        :returns: Whether it was copied
+        """
+        if self._source is None:
+            self._source = sqlite3.connect(
+                sqlite_path(database.URL_DATABASE), check_same_thread=False
+            )
+        version = self._source.execute("PRAGMA data_version").fetchone()[0]
+        if version == self._copied_version:
+            return False
+        for path in self.replica_paths:
+            with contextlib.closing(sqlite3.connect(path)) as replica:
+                replica.execute(
+                    f"PRAGMA busy_timeout={config.SQLITE_PRAGMAS['busy_timeout'] or 0}"
+                )
+                # One step, so the copy is of a single transaction
+                self._source.backup(replica)
+        self._copied_version = version
+        return True
+
+    async def start(self):
+        """
+        Make the first copy, so that the replicas exist before they are
+        read, and start the copying task; from the app lifespan
+        """
+        if not self.replica_paths:
+            return
+        await asyncio.to_thread(self.copy)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the copying task; from the app lifespan"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        if self._source is not None:
+            self._source.close()
+            self._source = None
+            self._copied_version = None
+
+    async def _run(self):
+        """Copy until cancelled"""
+        while True:
+            await asyncio.sleep(config.READ_REPLICA_COPY_INTERVAL)
+            try:
+                await asyncio.to_thread(self.copy)
+            except Exception:
+                # e.g. a replica was busy for too long; try again later
+                logger.exception("Copying the database to the replicas failed")
+
+
+copier = ReplicaCopier()
+
+
+def primary_until(headers: list) -> float:
+    """
+    Get the time until which a client reads from the database itself
+
+    :param headers: The request's ASGI headers
+    :returns: Seconds since the epoch; 0 if the client has no such cookie
+    """
+    for name, value in headers:
+        if name == b"cookie":
+            cookie = SimpleCookie()
+            with contextlib.suppress(Exception):
+                cookie.load(value.decode("latin-1"))
+            if PRIMARY_COOKIE in cookie:
+                with contextlib.suppress(ValueError):
+                    return float(cookie[PRIMARY_COOKIE].value)
+    return 0
+
+
+class ReadYourWritesMiddleware:
+    """
+    ASGI middleware sending the reads of a client that just made a
+    change to the database itself rather than a replica. The time is
+    kept in a cookie, so it holds whichever worker process answers.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        if scope["method"] in SAFE_METHODS:
+            if primary_until(scope["headers"]) > time.time():
+                with_primary = database.read_from_primary.set(True)
+                try:
+                    await self.app(scope, receive, send)
+                finally:
+                    database.read_from_primary.reset(with_primary)
+                return
+            await self.app(scope, receive, send)
+            return
+
+        async def send_with_cookie(message):
+            if message["type"] == "http.response.start" and message["status"] < 400:
+                seconds = config.READ_YOUR_WRITES_SECONDS
+                cookie = (
+                    f"{PRIMARY_COOKIE}={time.time() + seconds:.3f}; "
+                    f"Max-Age={int(seconds) + 1}; Path=/; HttpOnly; SameSite=Lax"
+                )
+                message = {
+                    **message,
+                    "headers": [
+                        *message.get("headers", []),
+                        (b"set-cookie", cookie.encode("latin-1")),
+                    ],
+                }
+            await send(message)
+
+        await self.app(scope, receive, send_with_cookie)
+
+
+def main():
+    """Copy the database to its SQLite replicas, once or continually"""
+    parser = argparse.ArgumentParser(
+        description="Copy the database to its SQLite read replicas"
+    )
+    parser.add_argument(
+        "--interval", type=float, help="Keep copying, this many seconds apart"
+    )
+    args = parser.parse_args()
+    if not copier.replica_paths:
+        parser.error("Set PLANTSWAP_READ_REPLICA_URLS to SQLite replicas of an SQLite database")
+    while True:
+        if copier.copy():
+            print(f"Copied the database to {', '.join(copier.replica_paths)}")
+        if args.interval is None:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    main()
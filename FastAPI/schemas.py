@@ -2,8 +2,51 @@
 Schemas for databases for user login and plant shares
 """
 
-from typing import Union
-from pydantic import BaseModel
+import datetime
+from typing import Annotated, Literal, Union
+from pydantic import BaseModel, Field, field_validator, model_validator
+
+
+def parse_date(value):
+    """
+    Parse a posted date
+
+    Only ISO dates (YYYY-MM-DD) are accepted: a date like 10/8/2023 is
+    8 October in some locales and 10 August in others, so it is rejected
+    rather than guessed.
+
+    :param value: Date as a date or YYYY-MM-DD
+    :returns: The date
+    :raises ValueError if the date is not an ISO date
+    """
+    if isinstance(value, datetime.date):
+        return value
+    try:
+        return datetime.date.fromisoformat(value.strip())
+    except (ValueError, AttributeError):
+        raise ValueError("date must be an ISO date, YYYY-MM-DD") from None
+
+
+def empty_to_none(value):
+    """Read an empty value (e.g. an empty CSV field) as missing"""
+    return None if value == "" else value
+
+
+Latitude = Annotated[float, Field(ge=-90, le=90)]
+Longitude = Annotated[float, Field(ge=-180, le=180)]
+
+
+def check_location(model):
+    """
+    Check a model has both a latitude and a longitude, or neither
+
+    :param model: Model with latitude and longitude
+    :returns: The model
+    :raises ValueError if it has only one of them
+    """
+    if (model.latitude is None) != (model.longitude is None):
+        raise ValueError("latitude and longitude must be given together")
+    return model
 
 
 # From fastapi tutorial
@@ -43,15 +86,20 @@ class UserBase(BaseModel):
 class UserCreate(UserBase):
     password: str
 
-class User(UserBase):
+class UserPublic(UserBase):
+    """A user as the API returns them: without their password hash"""
     id: int
     is_active: bool
-    hashed_password: str
+    latitude: float | None = None
+    longitude: float | None = None
     # item: list[Item] = []
 
     class Config:
         orm_mode = True
 
+class User(UserPublic):
+    hashed_password: str
+
 
 # class User(BaseModel):
 #     """
@@ -78,7 +126,16 @@ class ShareBase(BaseModel):
     amount: float
     description: str
     is_available_now: bool
-    date: str
+    date: datetime.date
+    # Where the plant is; by default the location of the user (see crud.py)
+    latitude: Latitude | None = None
+    longitude: Longitude | None = None
+
+    _parse_date = field_validator("date", mode="before")(parse_date)
+    _empty_location = field_validator("latitude", "longitude", mode="before")(
+        empty_to_none
+    )
+    _check_location = model_validator(mode="after")(check_location)
 
 
 class ShareModel(ShareBase):
@@ -92,6 +149,34 @@ class ShareModel(ShareBase):
         from_attributes = True
 
 
+class ShareDump(ShareModel):
+    """
+    A share as exported and imported (see dump.py): with the SHA-256 of
+    its photo, if it has one, so that a restored share keeps its photo
+    """
+
+    # Photos are stored by their hash (see photos.HASH_PATTERN)
+    photo_hash: Annotated[str, Field(pattern=r"^[0-9a-f]{64}$")] | None = None
+
+    _empty_photo_hash = field_validator("photo_hash", mode="before")(empty_to_none)
+
+
+class ShareListing(ShareModel):
+    """
+    A share in the listings, with the URL of its photo's thumbnail
+    (None if it has no photo); the photo is not sent
+    """
+
+    thumbnail_url: str | None = None
+
+
+class PhotoUploaded(BaseModel):
+    """Where the photo of a share is served (see photos.py)"""
+
+    photo_url: str
+    thumbnail_url: str
+
+
 class RequestBase(BaseModel):
     """Pydantic model for plant request"""
 
@@ -99,7 +184,16 @@ class RequestBase(BaseModel):
     requested_by: str
     amount: float
     notes: str
-    date: str
+    date: datetime.date
+    # Where the requester is; by default the location of the user
+    latitude: Latitude | None = None
+    longitude: Longitude | None = None
+
+    _parse_date = field_validator("date", mode="before")(parse_date)
+    _empty_location = field_validator("latitude", "longitude", mode="before")(
+        empty_to_none
+    )
+    _check_location = model_validator(mode="after")(check_location)
 
 
 class RequestModel(RequestBase):
@@ -111,3 +205,108 @@ class RequestModel(RequestBase):
 
     class Config:
         from_attributes = True
+
+
+class SparseShareListing(BaseModel):
+    """
+    A share in the listings when only some fields are asked for
+    (?fields=...): its id and those fields, the others left out
+    """
+
+    id: int
+    plant_name: str | None = None
+    shared_by: str | None = None
+    amount: float | None = None
+    description: str | None = None
+    is_available_now: bool | None = None
+    date: datetime.date | None = None
+    latitude: Latitude | None = None
+    longitude: Longitude | None = None
+    thumbnail_url: str | None = None
+
+
+class SparseRequestListing(BaseModel):
+    """
+    A request in the listings when only some fields are asked for
+    (?fields=...): its id and those fields, the others left out
+    """
+
+    id: int
+    plant_name: str | None = None
+    requested_by: str | None = None
+    amount: float | None = None
+    notes: str | None = None
+    date: datetime.date | None = None
+    latitude: Latitude | None = None
+    longitude: Longitude | None = None
+
+
+class MatchModel(BaseModel):
+    """
+    A share that is available now, paired with a request for the same plant
+    """
+
+    id: int
+    score: float
+    share: ShareModel
+    request: RequestModel
+
+    class Config:
+        from_attributes = True
+
+
+class SearchResult(BaseModel):
+    """
+    A share or request found by search, with its relevance score
+    (higher is better)
+    """
+
+    kind: Literal["share", "request"]
+    score: float
+    share: ShareModel | None = None
+    request: RequestModel | None = None
+
+
+class PlantStats(BaseModel):
+    """Supply and demand of a plant: its shares and requests, and their amounts"""
+
+    plant_name: str
+    shares_count: int
+    shares_amount: float
+    requests_count: int
+    requests_amount: float
+
+
+class UserStats(BaseModel):
+    """A user's numbers of shares and requests"""
+
+    username: str
+    shares_count: int
+    requests_count: int
+
+
+class IdList(BaseModel):
+    """Ids of shares or requests, for bulk deletes"""
+
+    ids: list[int]
+
+
+class BulkCreated(BaseModel):
+    """Result of a bulk create: the new ids, in the order posted"""
+
+    ids: list[int]
+
+
+class BulkDeleted(BaseModel):
+    """Result of a bulk delete: the ids that were found and deleted"""
+
+    deleted: list[int]
+
+
+class Location(BaseModel):
+    """A user's location, used for their new shares and requests"""
+
+    latitude: Latitude | None
+    longitude: Longitude | None
+
+    _check_location = model_validator(mode="after")(check_location)
@@ -0,0 +1,191 @@
+"""
+Full-text, typo-tolerant search of plant shares and requests
+
+Shares (plant name and description) and requests (plant name and notes)
+are indexed in an SQLite FTS5 table using the trigram tokenizer, which
+indexes every three-letter piece of the text. A query is split into
+trigrams too, and rows are ranked by how many of them (weighted by
+rarity, with BM25) they contain. So partial words match, and a typo
+like "monstera delicosa" still shares most of its trigrams with
+"Monstera deliciosa".
+
+The index is kept in sync with the shares and requests tables by
+triggers, so every way of adding or deleting rows keeps it up to date.
+Shares are stored at rowid 2 * id and requests at 2 * id + 1.
+
+On databases without FTS5 trigram support (e.g. Postgres, or SQLite
+before 3.34) search falls back to substring matching.
+"""
+
+import sqlite3
+
+from sqlalchemy import Connection, or_, text
+from sqlalchemy.orm import Session
+
+import models
+
+INDEX_TABLE = "search_index"
+
+# Relative weights of the plant name and the description/notes in ranking
+PLANT_NAME_WEIGHT = 2.0
+BODY_WEIGHT = 1.0
+
+# The indexed tables, with the column indexed as the body of each and
+# the offset added to 2 * id to get the rowid in the index
+INDEXED = {
+    "shares": ("description", 0),
+    "requests": ("notes", 1),
+}
+
+
+def fts_supported(bind) -> bool:
+    """
+    Whether the database supports the FTS5 trigram tokenizer
+
+    :param bind: Connection or engine
+    :returns: True if it does
+    """
+    return bind.dialect.name == "sqlite" and sqlite3.sqlite_version_info >= (3, 34)
+
+
+def create_index(conn: Connection):
+    """
+    Create the search index and the triggers that keep it in sync, if
+    they do not exist yet. New rows are indexed from then on; existing
+    rows are indexed by rebuild_index.
+
+    :param conn: Connection, in a transaction
+    """
+    if not fts_supported(conn):
+        return
+    conn.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {INDEX_TABLE} "
+        "USING fts5(plant_name, body, tokenize='trigram')"
+    )
+    for table, (body, offset) in INDEXED.items():
+        new_row = f"2 * new.id + {offset}, new.plant_name, new.{body}"
+        old_row = f"'delete', 2 * old.id + {offset}, old.plant_name, old.{body}"
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_search_insert "
+            f"AFTER INSERT ON {table} BEGIN "
+            f"INSERT INTO {INDEX_TABLE}(rowid, plant_name, body) VALUES ({new_row}); "
+            "END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_search_delete "
+            f"AFTER DELETE ON {table} BEGIN "
+            f"DELETE FROM {INDEX_TABLE} WHERE rowid = 2 * old.id + {offset}; "
+            "END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_search_update "
+            f"AFTER UPDATE OF plant_name, {body} ON {table} BEGIN "
+            f"DELETE FROM {INDEX_TABLE} WHERE rowid = 2 * old.id + {offset}; "
+            f"INSERT INTO {INDEX_TABLE}(rowid, plant_name, body) VALUES ({new_row}); "
+            "END"
+        )
+
+
+def rebuild_index(conn: Connection):
+    """
+    Re-index all shares and requests
+
+    :param conn: Connection, in a transaction
+    """
+    if not fts_supported(conn):
+        return
+    conn.exec_driver_sql(f"DELETE FROM {INDEX_TABLE}")
+    for table, (body, offset) in INDEXED.items():
+        conn.exec_driver_sql(
+            f"INSERT INTO {INDEX_TABLE}(rowid, plant_name, body) "
+            f"SELECT 2 * id + {offset}, plant_name, {body} FROM {table}"
+        )
+
+
+def trigrams(q: str) -> list[str]:
+    """
+    Split a query into the distinct trigrams of its words
+
+    :param q: The search query
+    :returns: The trigrams, in order of first appearance
+    """
+    grams = {}
+    for word in models.normalize_plant_name(q).split():
+        for i in range(len(word) - 2):
+            grams[word[i:i + 3]] = None
+    return list(grams)
+
+
+def search(db: Session, q: str, kind: str | None = None, skip: int = 0, limit: int = 20):
+    """
+    Search shares and requests, best matches first
+
+    :param db: database
+    :param q: The search query
+    :param kind: "share" or "request" to search only one of them
+    :param skip: Number of results to skip (for pagination)
+    :param limit: Maximum number of results to return
+    :returns: List of (kind, score, row) tuples
+    """
+    if not fts_supported(db.get_bind()):
+        return _search_substrings(db, q, kind, skip, limit)
+    grams = trigrams(q)
+    if not grams:
+        return []
+    match = " OR ".join(f'"{gram}"' for gram in grams)
+    parity = {"share": " AND rowid % 2 = 0", "request": " AND rowid % 2 = 1"}
+    rows = db.execute(
+        text(
+            f"SELECT rowid, bm25({INDEX_TABLE}, :name_weight, :body_weight) AS rank "
+            f"FROM {INDEX_TABLE} WHERE {INDEX_TABLE} MATCH :match"
+            f"{parity.get(kind, '')} ORDER BY rank LIMIT :limit OFFSET :skip"
+        ),
+        {
+            "name_weight": PLANT_NAME_WEIGHT,
+            "body_weight": BODY_WEIGHT,
+            "match": match,
+            "limit": limit,
+            "skip": skip,
+        },
+    ).all()
+
+    share_ids = [rowid // 2 for rowid, _ in rows if rowid % 2 == 0]
+    request_ids = [rowid // 2 for rowid, _ in rows if rowid % 2 == 1]
+    shares = {
+        share.id: share
+        for share in db.query(models.Shares).filter(models.Shares.id.in_(share_ids))
+    }
+    requests = {
+        request.id: request
+        for request in db.query(models.Requests).filter(models.Requests.id.in_(request_ids))
+    }
+    results = []
+    for rowid, rank in rows:
+        # bm25 is lower for better matches; report higher as better
+        if rowid % 2 == 0 and rowid // 2 in shares:
+            results.append(("share", -rank, shares[rowid // 2]))
+        elif rowid % 2 == 1 and rowid // 2 in requests:
+            results.append(("request", -rank, requests[rowid // 2]))
+    return results
+
+
+def _search_substrings(db: Session, q: str, kind, skip: int, limit: int):
+    """Fallback search: rows containing any word of the query, newest first"""
+    words = q.split()
+    if not words:
+        return []
+    results = []
+    for name, model, body in (
+        ("share", models.Shares, models.Shares.description),
+        ("request", models.Requests, models.Requests.notes),
+    ):
+        if kind not in (None, name):
+            continue
+        conditions = [
+            column.icontains(word, autoescape=True)
+            for word in words
+            for column in (model.plant_name, body)
+        ]
+        query = db.query(model).filter(or_(*conditions)).order_by(model.id.desc())
+        results += [(name, 0.0, row) for row in query.limit(skip + limit)]
+    return results[skip:skip + limit]
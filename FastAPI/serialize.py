@@ -0,0 +1,62 @@
+"""
+Fast JSON serialization of query results
+
+Listings are made of plain column values (strings, numbers, booleans
+and dates), which need no validation on the way out, so they are
+serialized straight from the result rows rather than through pydantic
+models one row at a time. orjson is used when it is installed (the
+"fast" extra); otherwise the standard library json, which gives the
+same output, more slowly.
+"""
+
+import json
+from datetime import date
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def to_json_default(value):
+    """Convert values json cannot serialize: dates as YYYY-MM-DD"""
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """
+    Serialize a value as compact JSON
+
+    :param value: Lists, dicts, strings, numbers, booleans, None and dates
+    :returns: The UTF-8 encoded JSON
+    """
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(
+        value, default=to_json_default, separators=(",", ":"), ensure_ascii=False
+    ).encode()
+
+
+def rows_to_dicts(rows) -> list[dict]:
+    """
+    Convert result rows to dicts keyed by their column labels
+
+    :param rows: Rows of a select() of columns
+    :returns: A dict per row, with the keys in the order selected
+    """
+    if not rows:
+        return []
+    keys = rows[0]._fields
+    return [dict(zip(keys, row)) for row in rows]
+
+
+def dump_rows(rows) -> bytes:
+    """
+    Serialize result rows as a JSON array of objects
+
+    :param rows: Rows of a select() of columns
+    :returns: The UTF-8 encoded JSON
+    """
+    return dumps(rows_to_dicts(rows))
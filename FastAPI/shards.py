@@ -0,0 +1,280 @@
+"""
+Per-community databases
+
+Each garden club (community) can have its own database, so that clubs
+do not share one SQLite file and its one write lock, and write
+throughput grows with the number of communities. With
+config.SHARD_URL_TEMPLATE set, a request is for a community if it has
+(in this order):
+
+- a path prefix: /c/<community>/shares/ is /shares/ of that community,
+- an X-Community header, or
+- a "community" claim in its bearer token (see main.login_for_access_token).
+
+CommunityMiddleware resolves the community, checks that it is listed in
+the communities table of the default database, and makes it current
+(database.current_community) for the request, so that every session
+made while answering it uses the community's database (see
+database.ShardSession). Shares, requests, users and everything derived
+from them live in that database. Requests with no community use the
+default database (config.DATABASE_URL), as before.
+
+Communities are listed, created and migrated with the command line:
+
+    python shards.py list
+    python shards.py create <community>...
+    python shards.py migrate [<community>...]
+
+The app migrates only the default database at startup; after a deploy
+with new migrations, run "python shards.py migrate".
+"""
+
+import argparse
+import os
+import re
+
+from jose import JWTError, jwt
+from sqlalchemy import insert, make_url, select
+from sqlalchemy.orm import Session
+from starlette.responses import JSONResponse
+
+import cache
+import config
+import database
+import models
+
+# Community ids; they are used in database URLs and file names
+COMMUNITY_PATTERN = re.compile(r"[a-z0-9][a-z0-9_-]{0,62}")
+
+# Path prefix of the routes of a community: /c/<community>/...
+PATH_PREFIX = "/c/"
+COMMUNITY_HEADER = b"x-community"
+TOKEN_CLAIM = "community"
+
+# Whether each community is registered, so that most requests do not
+# query the registry. Unknown ids are cached only briefly, so a new
+# community is usable at once by the other worker processes.
+REGISTRY_CACHE_SIZE = 10000
+REGISTERED_TTL = 300
+UNKNOWN_TTL = 10
+registered_cache = cache.TTLCache(maxsize=REGISTRY_CACHE_SIZE, ttl=REGISTERED_TTL)
+unknown_cache = cache.TTLCache(maxsize=REGISTRY_CACHE_SIZE, ttl=UNKNOWN_TTL)
+
+
+def split_path(path: str) -> tuple[str | None, str]:
+    """
+    Take the community prefix off a request path
+
+    :param path: The request path, e.g. /c/riverside/shares/
+    :returns: (community, rest of the path), e.g. ("riverside", "/shares/");
+              (None, path) if the path has no prefix
+    """
+    if not path.startswith(PATH_PREFIX):
+        return None, path
+    community, slash, rest = path[len(PATH_PREFIX):].partition("/")
+    return community, slash + rest if slash else "/"
+
+
+def token_community(authorization: str | None) -> str | None:
+    """
+    Get the community claim of a bearer token. The token is not verified
+    here; get_current_user verifies it, and that its claim is the
+    community of the request.
+
+    :param authorization: The Authorization header
+    :returns: The community, or None if there is no token or claim
+    """
+    scheme, _, token = (authorization or "").partition(" ")
+    if scheme.lower() != "bearer" or not token:
+        return None
+    try:
+        claim = jwt.get_unverified_claims(token).get(TOKEN_CLAIM)
+    except JWTError:
+        return None
+    return claim if isinstance(claim, str) else None
+
+
+def resolve(scope) -> tuple[str | None, str]:
+    """
+    Find the community of a request
+
+    :param scope: The ASGI scope of the request
+    :returns: (community or None, path without the community prefix)
+    """
+    community, path = split_path(scope["path"])
+    if community is not None:
+        return community, path
+    headers = dict(scope["headers"])
+    if COMMUNITY_HEADER in headers:
+        return headers[COMMUNITY_HEADER].decode("latin-1"), path
+    authorization = headers.get(b"authorization")
+    return token_community(authorization and authorization.decode("latin-1")), path
+
+
+async def is_registered(community: str) -> bool:
+    """
+    Whether a community is listed in the default database
+
+    :param community: The community id
+    :returns: True if it is
+    """
+    if registered_cache.get(community):
+        return True
+    if unknown_cache.get(community):
+        return False
+    with database.use_community(None):
+        async with database.AsyncSessionLocal() as db:
+            found = await db.get(models.Community, community) is not None
+    (registered_cache if found else unknown_cache).set(community, True)
+    return found
+
+
+def community_ids(db: Session) -> list[str]:
+    """
+    Get the ids of all the communities
+
+    :param db: Session on the default database
+    :returns: The ids, sorted
+    """
+    query = select(models.Community.id).order_by(models.Community.id)
+    return list(db.scalars(query).all())
+
+
+async def list_communities() -> list[str]:
+    """
+    Get the ids of all the communities, for background tasks that work
+    through every community's database
+
+    :returns: The ids, sorted; none if communities are not configured
+    """
+    if not config.SHARD_URL_TEMPLATE:
+        return []
+    with database.use_community(None):
+        async with database.AsyncSessionLocal() as db:
+            return await db.run_sync(community_ids)
+
+
+class CommunityMiddleware:
+    """
+    ASGI middleware making the community of each request current; see
+    the module docstring. Paths with a community prefix are answered by
+    the same routes as paths without one.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        community, path = resolve(scope)
+        if community is not None:
+            if not COMMUNITY_PATTERN.fullmatch(community):
+                response = JSONResponse({"detail": "Invalid community"}, status_code=400)
+                await response(scope, receive, send)
+                return
+            if not await is_registered(community):
+                response = JSONResponse({"detail": "Unknown community"}, status_code=404)
+                await response(scope, receive, send)
+                return
+            if path != scope["path"]:
+                # Changed in place, as middleware further out (e.g.
+                # metrics) reads what the router adds to this scope
+                prefix = scope["path"][: len(scope["path"]) - len(path)]
+                scope["root_path"] = scope.get("root_path", "") + prefix
+                scope["path"] = path
+                scope["raw_path"] = path.encode()
+        with database.use_community(community):
+            await self.app(scope, receive, send)
+
+
+def check_community(community: str) -> str:
+    """
+    Check a community id given on the command line
+
+    :raises argparse.ArgumentTypeError if it is not a valid id
+    """
+    if not COMMUNITY_PATTERN.fullmatch(community):
+        raise argparse.ArgumentTypeError(f"Invalid community id: {community!r}")
+    return community
+
+
+def create(community: str):
+    """
+    Create a community: its database, with the latest schema, and its
+    row in the communities table of the default database
+
+    :param community: The community id
+    :raises ValueError if the community already exists
+    """
+    # migrations imports stats, which goes through every community with
+    # this module
+    import migrations
+
+    migrations.upgrade(database.engine)
+    with database.SessionLocal() as db:
+        if db.get(models.Community, community) is not None:
+            raise ValueError(f"Community {community} already exists")
+    url = make_url(database.shard_engines.url(community))
+    if url.get_backend_name() == "sqlite" and url.database not in (None, "", ":memory:"):
+        os.makedirs(os.path.dirname(os.path.abspath(url.database)), exist_ok=True)
+    migrations.upgrade(database.shard_engines.get(community)[0])
+    with database.engine.begin() as conn:
+        conn.execute(insert(models.Community), {"id": community})
+
+
+def migrate(communities: list[str] | None = None) -> dict:
+    """
+    Bring the default database and the communities' databases up to the
+    latest schema version
+
+    :param communities: Ids of the communities to migrate; None for all
+    :returns: The version each database was at, by community (None for
+              the default database)
+    """
+    import migrations
+
+    versions = {None: migrations.upgrade(database.engine)}
+    if communities is None:
+        with database.SessionLocal() as db:
+            communities = community_ids(db)
+    for community in communities:
+        versions[community] = migrations.upgrade(database.shard_engines.get(community)[0])
+    return versions
+
+
+def main():
+    """Run the command line; see the module docstring"""
+    parser = argparse.ArgumentParser(description="Manage the communities' databases")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="List the communities")
+    create_parser = commands.add_parser("create", help="Create communities")
+    create_parser.add_argument("communities", nargs="+", type=check_community)
+    migrate_parser = commands.add_parser(
+        "migrate", help="Migrate the default database and the communities' (default all)"
+    )
+    migrate_parser.add_argument("communities", nargs="*", type=check_community)
+    args = parser.parse_args()
+    if not config.SHARD_URL_TEMPLATE:
+        parser.error("Set PLANTSWAP_SHARD_URL_TEMPLATE to use communities")
+
+    if args.command == "list":
+        with database.SessionLocal() as db:
+            for community in community_ids(db):
+                print(community)
+    elif args.command == "create":
+        for community in args.communities:
+            try:
+                create(community)
+            except ValueError as exc:
+                parser.exit(1, f"{exc}\n")
+            print(f"Created community {community} at {database.shard_engines.url(community)}")
+    else:
+        versions = migrate(args.communities or None)
+        for community, version in versions.items():
+            print(f"{community or '(default)'}: upgraded from version {version}")
+
+
+if __name__ == "__main__":
+    main()
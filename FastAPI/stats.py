@@ -0,0 +1,347 @@
+"""
+Supply and demand statistics of plants and users
+
+The dashboard shows, for each plant, the number and total amount of its
+shares and requests, and for each user, their numbers of shares and
+requests. Rather than a GROUP BY over the whole shares and requests
+tables on every page view, these totals are kept in summary tables
+(models.PlantStats and models.UserStats). Every create and delete
+adjusts them in the same transaction (see crud.create_rows,
+crud.delete_rows and dump.import_rows), with one upsert per plant or
+user changed, however many rows changed. The top-N queries then read
+only the summary tables, by index.
+
+Rows changed some other way (by hand, or by the benchmark's seeding)
+are not counted, and float amounts added and subtracted may drift, so
+a background task (started from the app lifespan when
+config.STATS_RECONCILE_INTERVAL is set) recomputes the totals every so
+often and corrects the summary rows that differ.
+"""
+
+import asyncio
+import contextlib
+import logging
+
+from sqlalchemy import bindparam, delete, false, func, insert, select, text, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+import config
+import database
+import models
+import shards
+from database import AsyncSessionLocal
+
+logger = logging.getLogger("plantswap.stats")
+
+# The counted tables: the summary columns of their rows' number and
+# total amount, and the column of their rows' username
+COUNTED = {
+    models.Shares.__tablename__: ("shares_count", "shares_amount", "shared_by"),
+    models.Requests.__tablename__: ("requests_count", "requests_amount", "requested_by"),
+}
+
+# Orders of the plants listing: the column sorted by (descending), and
+# the condition for being listed
+PLANT_ORDERS = {
+    "supply": (
+        models.PlantStats.shares_amount,
+        models.PlantStats.shares_count > 0,
+    ),
+    "demand": (
+        models.PlantStats.requests_amount,
+        models.PlantStats.requests_count > 0,
+    ),
+    "shortage": (
+        models.PlantStats.requests_amount - models.PlantStats.shares_amount,
+        models.PlantStats.requests_amount > models.PlantStats.shares_amount,
+    ),
+}
+USER_ORDERS = {
+    "shares": models.UserStats.shares_count,
+    "requests": models.UserStats.requests_count,
+}
+
+# Differences in recomputed amounts smaller than this are rounding
+AMOUNT_TOLERANCE = 1e-6
+
+
+def counted_columns(model) -> list:
+    """
+    Get the columns of shares or requests that the statistics count
+
+    :param model: models.Shares or models.Requests
+    :returns: The plant_key, plant_name, amount and username columns
+    """
+    user_column = COUNTED[model.__tablename__][2]
+    return [model.plant_key, model.plant_name, model.amount, getattr(model, user_column)]
+
+
+def upsert(bind, model):
+    """
+    Make an INSERT that can take ON CONFLICT clauses
+
+    :param bind: Connection, engine or session, for its database type
+    :param model: The model to insert into
+    :returns: The insert statement
+    """
+    if bind.dialect.name == "postgresql":
+        return postgresql.insert(model)
+    return sqlite.insert(model)
+
+
+async def record_rows(db: AsyncSession, name: str, rows: list, sign: int):
+    """
+    Add created rows to the statistics, or take deleted ones away, as
+    part of the transaction making the change. The caller commits.
+
+    :param db: database
+    :param name: "shares" or "requests"
+    :param rows: The rows, as mappings with the counted_columns
+    :param sign: 1 for created rows, -1 for deleted ones
+    """
+    count_column, amount_column, user_column = COUNTED[name]
+    plants = {}
+    users = {}
+    for row in rows:
+        plant = plants.setdefault(
+            row["plant_key"],
+            {"plant_key": row["plant_key"], "plant_name": row["plant_name"],
+             count_column: 0, amount_column: 0.0},
+        )
+        plant[count_column] += sign
+        plant[amount_column] += sign * (row["amount"] or 0)
+        if row[user_column] is not None:
+            users[row[user_column]] = users.get(row[user_column], 0) + sign
+    bind = db.get_bind()
+    if plants:
+        plant_insert = upsert(bind, models.PlantStats)
+        await db.execute(
+            plant_insert.on_conflict_do_update(
+                index_elements=[models.PlantStats.plant_key],
+                set_={
+                    column: getattr(models.PlantStats, column)
+                    + plant_insert.excluded[column]
+                    for column in (count_column, amount_column)
+                },
+            ),
+            list(plants.values()),
+        )
+    if users:
+        user_insert = upsert(bind, models.UserStats)
+        await db.execute(
+            user_insert.on_conflict_do_update(
+                index_elements=[models.UserStats.username],
+                set_={
+                    count_column: getattr(models.UserStats, count_column)
+                    + user_insert.excluded[count_column]
+                },
+            ),
+            [
+                {"username": username, count_column: count}
+                for username, count in users.items()
+            ],
+        )
+
+
+async def top_plants(db: AsyncSession, order: str, limit: int):
+    """
+    Get the plants with the most supply, demand or shortage
+
+    :param db: database
+    :param order: "supply" (total amount shared), "demand" (total amount
+                  requested) or "shortage" (requested less shared)
+    :param limit: Most plants to return
+    :returns: Rows of the plants' statistics, first the greatest
+    """
+    sort_key, listed = PLANT_ORDERS[order]
+    table = models.PlantStats
+    query = (
+        select(
+            table.plant_name,
+            table.shares_count,
+            table.shares_amount,
+            table.requests_count,
+            table.requests_amount,
+        )
+        .filter(listed)
+        .order_by(sort_key.desc(), table.plant_key)
+        .limit(limit)
+    )
+    return (await db.execute(query)).all()
+
+
+async def top_users(db: AsyncSession, order: str, limit: int):
+    """
+    Get the users with the most shares or requests
+
+    :param db: database
+    :param order: "shares" or "requests"
+    :param limit: Most users to return
+    :returns: Rows of the users' statistics, first the greatest
+    """
+    sort_key = USER_ORDERS[order]
+    table = models.UserStats
+    query = (
+        select(table.username, table.shares_count, table.requests_count)
+        .filter(sort_key > 0)
+        .order_by(sort_key.desc(), table.username)
+        .limit(limit)
+    )
+    return (await db.execute(query)).all()
+
+
+def lock_summary_tables(db: Session):
+    """
+    Keep other transactions from changing the statistics until this one
+    ends, so that the totals it recomputes and the rows it corrects agree
+    """
+    if db.get_bind().dialect.name == "postgresql":
+        db.execute(text("LOCK TABLE plant_stats, user_stats IN EXCLUSIVE MODE"))
+    else:
+        # Any write, even of no rows, takes SQLite's write lock
+        db.execute(
+            update(models.PlantStats.__table__).where(false()).values(shares_count=0)
+        )
+
+
+def compute_totals(db: Session) -> tuple[dict, dict]:
+    """
+    Recompute the statistics from the shares and requests tables
+
+    :param db: database
+    :returns: Summary rows (as dicts) of the plants, by plant_key, and of
+              the users, by username
+    """
+    plants = {}
+    users = {}
+    for model in (models.Shares, models.Requests):
+        count_column, amount_column, user_column = COUNTED[model.__tablename__]
+        query = select(
+            model.plant_key,
+            func.min(model.plant_name),
+            func.count(),
+            func.coalesce(func.sum(model.amount), 0),
+        ).group_by(model.plant_key)
+        for plant_key, plant_name, count, amount in db.execute(query):
+            plant = plants.setdefault(
+                plant_key,
+                {"plant_key": plant_key, "plant_name": plant_name,
+                 "shares_count": 0, "shares_amount": 0.0,
+                 "requests_count": 0, "requests_amount": 0.0},
+            )
+            plant[count_column] = count
+            plant[amount_column] = amount
+        username = getattr(model, user_column)
+        query = (
+            select(username, func.count())
+            .filter(username.is_not(None))
+            .group_by(username)
+        )
+        for name, count in db.execute(query):
+            user = users.setdefault(
+                name, {"username": name, "shares_count": 0, "requests_count": 0}
+            )
+            user[count_column] = count
+    return plants, users
+
+
+def correct_rows(db: Session, model, key: str, totals: dict) -> int:
+    """
+    Make a summary table hold the recomputed totals, rewriting only the
+    rows that differ, and dropping the rows of plants or users that no
+    longer have any shares or requests
+
+    :param db: database
+    :param model: models.PlantStats or models.UserStats
+    :param key: Name of its primary key column
+    :param totals: The recomputed rows, by key
+    :returns: The number of rows corrected
+    """
+    table = model.__table__
+    counts = [name for name in table.columns.keys() if name.endswith("_count")]
+    amounts = [name for name in table.columns.keys() if name.endswith("_amount")]
+    stored = {row[key]: row for row in db.execute(select(table)).mappings()}
+    zeros = dict.fromkeys(counts + amounts, 0)
+
+    def differs(name):
+        old, new = stored.get(name, zeros), totals.get(name, zeros)
+        return any(old[column] != new[column] for column in counts) or any(
+            abs(old[column] - new[column]) > AMOUNT_TOLERANCE for column in amounts
+        )
+
+    wrong = [name for name in stored.keys() | totals.keys() if differs(name)]
+    # Rows of plants and users with nothing left are dropped too
+    stale = [name for name in stored if name not in totals]
+    if wrong or stale:
+        db.execute(
+            delete(table).where(table.c[key] == bindparam("wrong_key")),
+            [{"wrong_key": name} for name in set(wrong + stale)],
+        )
+        replacements = [totals[name] for name in wrong if name in totals]
+        if replacements:
+            db.execute(insert(table), replacements)
+    return len(wrong)
+
+
+def reconcile(db: Session) -> int:
+    """
+    Recompute the statistics from the shares and requests, and correct
+    the summary rows that differ. The caller commits.
+
+    :param db: database
+    :returns: The number of summary rows corrected
+    """
+    lock_summary_tables(db)
+    plants, users = compute_totals(db)
+    return correct_rows(db, models.PlantStats, "plant_key", plants) + correct_rows(
+        db, models.UserStats, "username", users
+    )
+
+
+class Reconciler:
+    """Runs reconcile every config.STATS_RECONCILE_INTERVAL seconds"""
+
+    def __init__(self):
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        """Start the task; from the app lifespan"""
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the task; from the app lifespan"""
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+
+    async def _run(self):
+        """Reconcile every community's statistics until cancelled"""
+        while True:
+            # Wait first, so that starting a worker does not recompute
+            await asyncio.sleep(config.STATS_RECONCILE_INTERVAL)
+            try:
+                communities = [None, *await shards.list_communities()]
+            except Exception:
+                logger.exception("Listing the communities failed")
+                communities = [None]
+            for community in communities:
+                with database.use_community(community):
+                    try:
+                        async with AsyncSessionLocal() as db:
+                            corrected = await db.run_sync(reconcile)
+                            await db.commit()
+                        if corrected:
+                            logger.info(
+                                "Corrected %d plant and user statistics of %s",
+                                corrected, community or "the default database",
+                            )
+                    except Exception:
+                        # e.g. the database was busy; try again later
+                        logger.exception("Reconciling statistics failed")
+
+
+reconciler = Reconciler()
@@ -0,0 +1,127 @@
+"""
+Fixtures for the tests of the plant swap backend
+
+The app keeps its database (plants.db) in the working directory, so the
+tests run in a temporary directory, made before any module of the app
+is imported, and removed at the end. The app's settings (config.py) are
+read at import too, so they are set here first; the communities'
+databases, a read replica and the photos go in the temporary
+directory too.
+
+Run with
+$ poetry run pytest
+"""
+
+import itertools
+import os
+import shutil
+import tempfile
+
+import pytest
+
+DATA_DIR = tempfile.mkdtemp(prefix="plantswap-tests-")
+os.chdir(DATA_DIR)
+
+os.environ["PLANTSWAP_SHARD_URL_TEMPLATE"] = (
+    f"sqlite:///{DATA_DIR}/communities/{{community}}.db"
+)
+os.environ["PLANTSWAP_PHOTO_DIR"] = f"{DATA_DIR}/photos"
+# Orphaned photos are removed by test_photos.py, not in the background
+os.environ["PLANTSWAP_PHOTO_ORPHAN_AGE"] = "0"
+os.environ["PLANTSWAP_READ_REPLICA_URLS"] = f"sqlite:///{DATA_DIR}/replica.db"
+# The tests copy the database to the replica when they need to
+os.environ["PLANTSWAP_READ_REPLICA_COPY_INTERVAL"] = "0"
+# Cheap password hashes, for speed
+os.environ["PLANTSWAP_BCRYPT_ROUNDS"] = "4"
+# The tests sign up many users; test_ratelimit.py sets its own limits
+for name in ("TOKEN_IP", "TOKEN_USERNAME", "CREATE_USER_IP"):
+    os.environ[f"PLANTSWAP_RATE_LIMIT_{name}"] = ""
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+import main  # noqa: E402
+import replicas  # noqa: E402
+
+# The tests share one database, so each names its rows uniquely
+_names = itertools.count()
+
+
+def pytest_sessionfinish(session, exitstatus):
+    """Remove the temporary databases and photos"""
+    shutil.rmtree(DATA_DIR, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def app_client():
+    """The app, started up (its database created), for the whole session"""
+    with TestClient(main.app) as client:
+        replicas.copier.copy()
+        yield client
+
+
+@pytest.fixture
+def client(app_client):
+    """
+    A client of the app, without cookies left from other tests; its own
+    writes are read back from the database itself (see replicas.py)
+    """
+    app_client.cookies.clear()
+    return app_client
+
+
+@pytest.fixture
+def unique():
+    """Make names no other test uses, e.g. unique("fern") is "fern-7" """
+    return lambda name: f"{name}-{next(_names)}"
+
+
+@pytest.fixture
+def sign_up(client, unique):
+    """
+    Register a new user and log in, e.g. sign_up("ann"); returns the
+    unique username and the headers to send its token with
+    """
+
+    def _sign_up(name: str = "user"):
+        username = unique(name)
+        form = {"username": username, "password": "hunter2"}
+        assert client.post("/users/", data=form).status_code == 200
+        token = client.post("/token", data=form).json()["access_token"]
+        return username, {"Authorization": f"Bearer {token}"}
+
+    return _sign_up
+
+
+@pytest.fixture
+def make_share():
+    """Make a share to post, e.g. make_share("ann", amount=2)"""
+    return _share
+
+
+@pytest.fixture
+def make_request():
+    """Make a request to post, e.g. make_request("bob", notes="")"""
+    return _request
+
+
+def _share(shared_by: str, plant_name: str = "Fern", **values) -> dict:
+    return {
+        "plant_name": plant_name,
+        "shared_by": shared_by,
+        "amount": 1,
+        "description": "Cuttings",
+        "is_available_now": True,
+        "date": "2024-05-01",
+        **values,
+    }
+
+
+def _request(requested_by: str, plant_name: str = "Fern", **values) -> dict:
+    return {
+        "plant_name": plant_name,
+        "requested_by": requested_by,
+        "amount": 1,
+        "notes": "Any size",
+        "date": "2024-05-01",
+        **values,
+    }
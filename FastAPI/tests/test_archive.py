@@ -0,0 +1,70 @@
+"""Tests of the archiving of stale shares and requests (see archive.py)"""
+
+from datetime import date
+
+import pytest
+
+import archive
+import config
+import models
+from database import SessionLocal
+
+
+@pytest.fixture
+def archiving(monkeypatch):
+    """
+    Archive what is over 30 days old, a row per batch. The tests date
+    their rows in 1990, long before any other test's rows, and archive
+    as of February 1990.
+    """
+    monkeypatch.setattr(config, "ARCHIVE_AFTER_DAYS", 30)
+    monkeypatch.setattr(config, "ARCHIVE_BATCH_SIZE", 1)
+
+    def expire_all(client):
+        return client.portal.call(archive.expire_all, date(1990, 2, 15))
+
+    return expire_all
+
+
+def matched_share_ids(client, plant):
+    matches = client.get("/matches/", params={"plant_name": plant}).json()
+    return [match["share"]["id"] for match in matches]
+
+
+def test_stale_rows_are_archived(archiving, client, unique, make_share, make_request):
+    user = unique("abe")
+    plant = unique("Begonia")
+    old = client.post("/shares/", json=make_share(user, plant, date="1990-01-01")).json()
+    new = client.post("/shares/", json=make_share(user, plant, date="1990-02-01")).json()
+    request = client.post(
+        "/requests/", json=make_request(user, plant, date="1990-01-01")
+    ).json()
+    assert sorted(matched_share_ids(client, plant)) == [old["id"], new["id"]]
+
+    counts = archiving(client)
+    assert counts["shares"] >= 1 and counts["requests"] >= 1
+
+    listed = client.get("/shares/", params={"shared_by": user}).json()
+    assert [share["id"] for share in listed] == [new["id"]]
+    assert client.get("/requests/", params={"requested_by": user}).json() == []
+    assert matched_share_ids(client, plant) == []
+    with SessionLocal() as db:
+        archived = db.get(models.ArchivedShares, old["id"])
+        assert archived.plant_name == plant
+        assert db.get(models.ArchivedRequests, request["id"]).requested_by == user
+
+
+def test_stale_shares_marked_unavailable(
+    archiving, monkeypatch, client, unique, make_share, make_request
+):
+    monkeypatch.setattr(config, "SHARE_EXPIRY", "unavailable")
+    user = unique("bea")
+    plant = unique("Calathea")
+    share = client.post("/shares/", json=make_share(user, plant, date="1990-01-01")).json()
+    client.post("/requests/", json=make_request(user, plant, date="1990-02-10"))
+    assert matched_share_ids(client, plant) == [share["id"]]
+
+    archiving(client)
+    listed = client.get("/shares/", params={"shared_by": user}).json()
+    assert [(s["id"], s["is_available_now"]) for s in listed] == [(share["id"], False)]
+    assert matched_share_ids(client, plant) == []
@@ -0,0 +1,94 @@
+"""Tests of registration and login"""
+
+from passlib.context import CryptContext
+
+import crud
+import main
+
+
+def register(client, username, password="hunter2"):
+    return client.post("/users/", data={"username": username, "password": password})
+
+
+def log_in(client, username, password="hunter2"):
+    return client.post("/token", data={"username": username, "password": password})
+
+
+def test_sign_up_and_log_in(client, unique):
+    username = unique("kim")
+    response = register(client, username)
+    assert response.status_code == 200
+    assert response.json()["username"] == username
+    assert register(client, username).status_code == 400
+
+    response = log_in(client, username)
+    assert response.status_code == 200
+    assert response.json()["token_type"] == "bearer"
+
+
+def test_bad_logins_are_refused(client, unique):
+    username = unique("lee")
+    register(client, username)
+    assert log_in(client, username, "wrong").status_code == 401
+    assert log_in(client, unique("nobody")).status_code == 401
+
+
+def test_old_hashes_are_replaced_at_login(client, unique):
+    username = unique("max")
+    register(client, username)
+    old_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=5)
+    with main.SessionLocal() as db:
+        user = crud.get_user(db, username)
+        crud.update_password_hash(db, user, old_context.hash("hunter2"))
+
+    assert log_in(client, username).status_code == 200
+    with main.SessionLocal() as db:
+        hashed_password = crud.get_user(db, username).hashed_password
+    assert not crud.get_pwd_context().needs_update(hashed_password)
+    assert crud.get_pwd_context().verify("hunter2", hashed_password)
+
+
+def test_current_user(client, sign_up):
+    username, headers = sign_up("ned")
+    response = client.get("/users/me/", headers=headers)
+    assert response.status_code == 200
+    assert response.json()["username"] == username
+    assert client.get("/users/me/").status_code == 401
+    bad_token = {"Authorization": "Bearer not.a.token"}
+    assert client.get("/users/me/", headers=bad_token).status_code == 401
+
+
+def test_deactivated_users_are_refused(client, sign_up):
+    username, headers = sign_up("ola")
+    # Cache the user
+    assert client.get("/users/me/", headers=headers).status_code == 200
+    assert crud.user_cache.get(crud.user_cache_key(username)) is not None
+
+    assert client.delete("/users/me/", headers=headers).status_code == 200
+    assert crud.user_cache.get(crud.user_cache_key(username)) is None
+    assert client.get("/users/me/", headers=headers).status_code == 400
+
+
+def test_read_user_by_id(client, unique):
+    username = unique("pia")
+    user_id = register(client, username).json()["id"]
+    response = client.get(f"/users/{user_id}")
+    assert response.status_code == 200
+    assert response.json()["username"] == username
+    assert client.get("/users/0").status_code == 404
+
+
+def test_password_hashes_are_not_returned(client, sign_up):
+    username, headers = sign_up("quy")
+    me = client.get("/users/me/", headers=headers).json()
+    location = {"latitude": 60.4, "longitude": 5.3}
+    users = [
+        me,
+        register(client, username + "-2").json(),
+        client.put("/users/me/location", json=location, headers=headers).json(),
+        client.get(f"/users/{me['id']}").json(),
+        *client.get("/users/").json(),
+    ]
+    for user in users:
+        assert "username" in user
+        assert "hashed_password" not in user
@@ -0,0 +1,30 @@
+"""Tests of the benchmark's bookkeeping (see benchmark.py)"""
+
+import asyncio
+
+import httpx
+
+import benchmark
+
+
+def test_summarize():
+    latencies = [i / 1000 for i in range(1, 101)]
+    summary = benchmark.summarize(latencies, errors=2, elapsed=2.0)
+    assert summary == {
+        "count": 100,
+        "errors": 2,
+        "throughput_rps": 50.0,
+        "p50_ms": 51.0,
+        "p95_ms": 95.0,
+        "p99_ms": 99.0,
+        "mean_ms": 50.5,
+    }
+    assert benchmark.summarize([], errors=0, elapsed=0)["p50_ms"] is None
+
+
+def test_run_concurrently_counts_errors():
+    async def make_request(number):
+        return httpx.Response(500 if number % 4 == 0 else 200)
+
+    summary = asyncio.run(benchmark.run_concurrently(make_request, count=20, concurrency=3))
+    assert (summary["count"], summary["errors"]) == (20, 5)
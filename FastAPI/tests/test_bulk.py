@@ -0,0 +1,114 @@
+"""Tests of the bulk create and delete endpoints"""
+
+import json
+
+import config
+
+
+def ndjson(rows):
+    """Rows as NDJSON: one JSON object per line"""
+    return "\n".join(json.dumps(row) for row in rows) + "\n"
+
+
+def test_bulk_create_ndjson_keeps_order(client, unique, make_share):
+    user = unique("eve")
+    shares = [make_share(user, plant_name=f"Plant {i}") for i in range(5)]
+    response = client.post(
+        "/shares/bulk",
+        content=ndjson(shares),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    ids = response.json()["ids"]
+    assert len(ids) == 5
+
+    listed = client.get("/shares/", params={"shared_by": user}).json()
+    assert {share["id"]: share["plant_name"] for share in listed} == {
+        id: share["plant_name"] for id, share in zip(ids, shares)
+    }
+
+
+def test_bulk_create_json_array(client, unique, make_request):
+    user = unique("fay")
+    response = client.post(
+        "/requests/bulk", json=[make_request(user), make_request(user)]
+    )
+    assert response.status_code == 200
+    assert len(response.json()["ids"]) == 2
+
+
+def test_bulk_create_rejects_all_if_one_is_invalid(client, unique, make_share):
+    user = unique("gus")
+    shares = [make_share(user), make_share(user, amount="lots")]
+    response = client.post(
+        "/shares/bulk",
+        content=ndjson(shares),
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 422
+    # The error names the line of the invalid share
+    assert response.json()["detail"][0]["loc"][:2] == ["body", 1]
+    assert client.get("/shares/", params={"shared_by": user}).json() == []
+
+
+def test_bulk_create_too_many(client, unique, make_share, monkeypatch):
+    monkeypatch.setattr(config, "BULK_MAX_ROWS", 2)
+    user = unique("hal")
+    response = client.post("/shares/bulk", json=[make_share(user)] * 3)
+    assert response.status_code == 413
+
+
+def test_bulk_create_too_many_is_refused_before_validating(client, monkeypatch):
+    monkeypatch.setattr(config, "BULK_MAX_ROWS", 2)
+    # Too many rows is the error, though none of them is valid
+    response = client.post("/shares/bulk", json=[{}] * 3)
+    assert response.status_code == 413
+    response = client.post(
+        "/requests/bulk",
+        content="{}\n" * 3,
+        headers={"Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 413
+
+
+def test_bulk_create_too_large(client, unique, make_share, monkeypatch):
+    user = unique("ike")
+    body = json.dumps([make_share(user)] * 3).encode()
+    monkeypatch.setattr(config, "BULK_MAX_BYTES", len(body) - 1)
+    response = client.post(
+        "/shares/bulk", content=body, headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 413
+
+    # A chunked body, without a Content-Length, is measured as it comes
+    response = client.post(
+        "/shares/bulk",
+        content=iter([body[:10], body[10:]]),
+        headers={"Content-Type": "application/json"},
+    )
+    assert response.status_code == 413
+    assert client.get("/shares/", params={"shared_by": user}).json() == []
+
+    monkeypatch.setattr(config, "BULK_MAX_BYTES", len(body))
+    response = client.post(
+        "/shares/bulk", content=body, headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 200
+
+
+def test_bulk_create_not_an_array(client):
+    response = client.post(
+        "/shares/bulk", content="not json", headers={"Content-Type": "application/json"}
+    )
+    assert response.status_code == 422
+    assert client.post("/shares/bulk", json={"rows": []}).status_code == 422
+
+
+def test_bulk_delete(client, unique, make_share):
+    user = unique("ivy")
+    ids = client.post("/shares/bulk", json=[make_share(user)] * 3).json()["ids"]
+    response = client.post("/shares/bulk-delete", json={"ids": [ids[0], ids[2], -1]})
+    assert response.status_code == 200
+    assert sorted(response.json()["deleted"]) == [ids[0], ids[2]]
+    listed = client.get("/shares/", params={"shared_by": user}).json()
+    assert [share["id"] for share in listed] == [ids[1]]
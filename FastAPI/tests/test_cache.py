@@ -0,0 +1,34 @@
+"""Tests of the in-process caches (see cache.py)"""
+
+from cache import TTLCache
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_entries_expire():
+    timer = FakeTimer()
+    users = TTLCache(maxsize=10, ttl=30, timer=timer)
+    users.set("ann", 1)
+    timer.now = 29
+    assert users.get("ann") == 1
+    timer.now = 30
+    assert users.get("ann") is None
+    assert len(users) == 0
+
+
+def test_least_recently_used_go_first():
+    users = TTLCache(maxsize=2, ttl=30, timer=FakeTimer())
+    users.set("ann", 1)
+    users.set("bob", 2)
+    users.get("ann")
+    users.set("cat", 3)
+    assert users.get("bob", "gone") == "gone"
+    assert (users.get("ann"), users.get("cat")) == (1, 3)
+    assert users.pop("ann") == 1
+    assert users.pop("ann") is None
@@ -0,0 +1,91 @@
+"""Tests of compressed responses (see compression.py) and sparse fieldsets"""
+
+import gzip
+
+import compression
+
+
+def post_shares(client, make_share, user, count):
+    for _ in range(count):
+        client.post("/shares/", json=make_share(user, description="Cuttings " * 10))
+
+
+def test_choose_encoding(monkeypatch):
+    monkeypatch.setattr(compression, "brotli", None)
+    assert compression.choose_encoding("gzip, deflate") == "gzip"
+    assert compression.choose_encoding("br, gzip;q=0") is None
+    assert compression.choose_encoding("identity") is None
+    assert compression.choose_encoding(None) is None
+
+
+def test_listings_are_compressed(client, unique, make_share):
+    user = unique("oz")
+    post_shares(client, make_share, user, 20)
+    params = {"shared_by": user}
+
+    plain = client.get("/shares/", params=params, headers={"Accept-Encoding": "identity"})
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+
+    # Streamed, to read the body before httpx decompresses it
+    request = client.build_request(
+        "GET", "/shares/", params=params, headers={"Accept-Encoding": "gzip"}
+    )
+    response = client.send(request, stream=True)
+    body = b"".join(response.iter_raw())
+    response.close()
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert gzip.decompress(body) == plain.content
+    assert len(body) < len(plain.content)
+    assert response.headers["ETag"] != plain.headers["ETag"]
+
+    # Revalidating the compressed listing
+    cached = client.get(
+        "/shares/",
+        params=params,
+        headers={"Accept-Encoding": "gzip", "If-None-Match": response.headers["ETag"]},
+    )
+    assert cached.status_code == 304
+
+
+def test_small_responses_are_not_compressed(client, unique):
+    response = client.get(
+        "/shares/", params={"shared_by": unique("pat")}, headers={"Accept-Encoding": "gzip"}
+    )
+    assert response.json() == []
+    assert "Content-Encoding" not in response.headers
+
+
+def test_other_responses_are_compressed(client, unique, make_share):
+    user = unique("quin")
+    post_shares(client, make_share, user, 20)
+    response = client.get("/search", params={"q": "cuttings", "kind": "share"})
+    assert len(response.json()) == 20
+    assert response.headers["Content-Encoding"] == "gzip"
+
+
+def test_sparse_fieldsets(client, unique, make_share):
+    user = unique("rae")
+    post_shares(client, make_share, user, 2)
+    response = client.get(
+        "/shares/", params={"shared_by": user, "fields": "plant_name,date", "limit": 1}
+    )
+    assert [set(share) for share in response.json()] == [{"id", "plant_name", "date"}]
+    # The cursor still works
+    cursor = response.headers["X-Next-Cursor"]
+    rest = client.get(
+        "/shares/", params={"shared_by": user, "fields": "plant_name", "cursor": cursor}
+    )
+    assert len(rest.json()) == 1
+
+    bad = client.get("/shares/", params={"fields": "plant_name,password"})
+    assert bad.status_code == 400
+
+
+def test_listing_schemas_allow_sparse_fieldsets(client):
+    schema = client.get("/openapi.json").json()
+    listing = schema["paths"]["/shares/"]["get"]["responses"]["200"]["content"]
+    refs = str(listing["application/json"]["schema"])
+    assert "#/components/schemas/SparseShareListing" in refs
+    assert "#/components/schemas/ShareListing" in refs
@@ -0,0 +1,36 @@
+"""Tests of the database engine profile (see database.py)"""
+
+from sqlalchemy import text
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+import config
+import database
+
+
+def test_to_async_url():
+    assert database.to_async_url("sqlite:///./plants.db") == "sqlite+aiosqlite:///./plants.db"
+    assert (
+        database.to_async_url("postgresql://ann:pw@db/plants")
+        == "postgresql+asyncpg://ann:pw@db/plants"
+    )
+
+
+def test_engine_options():
+    options = database.engine_options("sqlite:///./plants.db", is_async=True)
+    assert options["poolclass"] is AsyncAdaptedQueuePool
+    assert options["pool_size"] == config.DB_POOL_SIZE
+
+    # An in-memory database keeps the default, single connection pool
+    assert "pool_size" not in database.engine_options("sqlite://")
+
+    assert database.engine_options("postgresql://db/plants")["pool_pre_ping"]
+
+
+def test_sqlite_pragmas_are_set():
+    with database.engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        # NORMAL
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == int(
+            config.SQLITE_PRAGMAS["busy_timeout"]
+        )
@@ -0,0 +1,153 @@
+"""Tests of table export and import (see dump.py)"""
+
+import csv
+import io
+import json
+import sqlite3
+
+import httpx
+import pytest
+
+import config
+import dump
+import main
+import models
+from database import SessionLocal
+
+
+@pytest.fixture
+def dumper(sign_up, monkeypatch):
+    """The token headers of a user allowed to dump tables"""
+    username, headers = sign_up("dumper")
+    monkeypatch.setattr(config, "DUMP_USERNAMES", {username})
+    return headers
+
+
+def export(client, headers, table, fmt="ndjson"):
+    response = client.get(f"/export/{table}", params={"format": fmt}, headers=headers)
+    assert response.status_code == 200
+    return response.text
+
+
+def import_(client, headers, table, body, content_type="application/x-ndjson"):
+    return client.post(
+        f"/import/{table}",
+        content=body,
+        headers={**headers, "Content-Type": content_type},
+    )
+
+
+def test_round_trip(dumper, client, unique, make_share):
+    user = unique("uma")
+    for i in range(3):
+        client.post("/shares/", json=make_share(user, amount=i + 1))
+    before = client.get("/shares/", params={"shared_by": user}).json()
+
+    lines = [
+        line
+        for line in export(client, dumper, "shares").splitlines()
+        if json.loads(line)["shared_by"] == user
+    ]
+    assert len(lines) == 3
+    for share in before:
+        client.delete(f"/shares/{share['id']}")
+
+    response = import_(client, dumper, "shares", "\n".join(lines) + "\n")
+    assert response.json() == {"imported": 3}
+    assert client.get("/shares/", params={"shared_by": user}).json() == before
+
+    # The ids are taken now
+    assert import_(client, dumper, "shares", lines[0]).status_code == 409
+
+
+def test_csv_round_trip(dumper, client, unique, make_request):
+    user = unique("val")
+    request = client.post("/requests/", json=make_request(user, notes="Big, please")).json()
+    rows = [
+        row
+        for row in csv.DictReader(
+            io.StringIO(export(client, dumper, "requests", "csv"))
+        )
+        if row["requested_by"] == user
+    ]
+    assert rows[0]["notes"] == "Big, please"
+
+    client.delete(f"/requests/{request['id']}")
+    body = io.StringIO()
+    writer = csv.DictWriter(body, fieldnames=list(rows[0]))
+    writer.writeheader()
+    writer.writerows(rows)
+    response = import_(client, dumper, "requests", body.getvalue(), "text/csv")
+    assert response.json() == {"imported": 1}
+    assert client.get("/requests/", params={"requested_by": user}).json() == [request]
+
+
+def test_invalid_rows_import_nothing(dumper, client, unique, make_share):
+    user = unique("wes")
+    rows = [make_share(user), make_share(user, amount="lots")]
+    body = "".join(json.dumps(row) + "\n" for row in rows)
+    assert import_(client, dumper, "shares", body).status_code == 400
+    assert client.get("/shares/", params={"shared_by": user}).json() == []
+
+
+def test_users_are_exported_without_passwords(dumper, client, sign_up):
+    username, _ = sign_up("xia")
+    users = [json.loads(line) for line in export(client, dumper, "users").splitlines()]
+    user = next(user for user in users if user["username"] == username)
+    assert "hashed_password" not in user
+    assert import_(client, dumper, "users", json.dumps(user)).status_code == 422
+
+
+def test_only_dump_users_may_dump(dumper, client, sign_up):
+    assert client.get("/export/shares").status_code == 401
+    _, headers = sign_up("nosy")
+    assert client.get("/export/shares", headers=headers).status_code == 403
+    assert import_(client, headers, "shares", "").status_code == 403
+
+
+def test_imports_are_logged(dumper, client, unique, make_request):
+    user = unique("yul")
+    body = json.dumps({**make_request(user), "id": 10**9}) + "\n"
+    assert import_(client, dumper, "requests", body).json() == {"imported": 1}
+    with SessionLocal() as db:
+        event = db.query(models.Event).filter_by(row_id=10**9).one()
+    assert (event.table_name, event.op) == ("requests", "create")
+
+
+def test_import_does_not_lock_the_database_while_uploading(
+    dumper, client, unique, make_share, monkeypatch
+):
+    monkeypatch.setattr(dump, "BATCH_SIZE", 1)
+    user = unique("zed")
+    lines = [
+        json.dumps({**make_share(user), "id": 10**9 + i}) + "\n" for i in range(3)
+    ]
+    writable = []
+
+    async def upload():
+        yield "".join(lines[:2]).encode()
+        # Halfway through the upload, another writer can still write
+        conn = sqlite3.connect("plants.db", timeout=0)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.rollback()
+            writable.append(True)
+        except sqlite3.OperationalError:
+            writable.append(False)
+        finally:
+            conn.close()
+        yield lines[2].encode()
+
+    async def post():
+        # Unlike the test client, this transport sends the body as it comes
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as http:
+            return await http.post(
+                "/import/shares",
+                content=upload(),
+                headers={**dumper, "Content-Type": "application/x-ndjson"},
+            )
+
+    response = client.portal.call(post)
+    assert response.json() == {"imported": 3}
+    assert writable == [True]
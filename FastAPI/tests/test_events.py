@@ -0,0 +1,149 @@
+"""Tests of the change feed (see events.py)"""
+
+import asyncio
+import json
+
+import events
+
+
+class Disconnecting:
+    """Stands in for a client's request; disconnects after the replay"""
+
+    async def is_disconnected(self):
+        return True
+
+
+def replay(client, last_event_id, tables=None):
+    """The events streamed to a client resuming after last_event_id"""
+
+    async def collect():
+        chunks = [
+            chunk
+            async for chunk in events.stream(Disconnecting(), last_event_id, tables)
+        ]
+        return [parse(chunk) for chunk in chunks if not chunk.startswith(":")]
+
+    # The database's async engine belongs to the app's event loop
+    return client.portal.call(collect)
+
+
+def parse(chunk):
+    fields = dict(line.split(": ", 1) for line in chunk.strip().split("\n"))
+    return fields["event"], json.loads(fields["data"])
+
+
+def newest_event_id(client):
+    return client.portal.call(events.get_event_id_range)[1]
+
+
+def test_resume_after_last_event_id(client, unique, make_share, make_request):
+    user = unique("ivy")
+    last_seen = newest_event_id(client)
+    share = client.post("/shares/", json=make_share(user)).json()
+    request = client.post("/requests/", json=make_request(user)).json()
+    client.delete(f"/shares/{share['id']}")
+
+    replayed = replay(client, last_seen)
+    assert [(name, data["id"]) for name, data in replayed] == [
+        ("shares.create", share["id"]),
+        ("requests.create", request["id"]),
+        ("shares.delete", share["id"]),
+    ]
+    assert replayed[0][1]["data"]["shared_by"] == user
+
+    assert [name for name, _ in replay(client, last_seen, {"requests"})] == [
+        "requests.create"
+    ]
+    # Up to date: nothing to replay
+    assert replay(client, newest_event_id(client)) == []
+
+
+def test_unknown_last_event_id_resets(client):
+    assert replay(client, newest_event_id(client) + 100) == [("reset", {})]
+
+
+def test_changes_are_broadcast(client, unique, make_share):
+    broadcaster = events.broadcasters.get()
+    subscription = client.portal.call(broadcaster.subscribe)
+    try:
+        share = client.post("/shares/", json=make_share(unique("jo"))).json()
+
+        async def received():
+            # Changes made by earlier tests may still be on their way
+            while True:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=5)
+                if event.table_name == "shares" and event.row_id == share["id"]:
+                    return event
+
+        assert client.portal.call(received).op == "create"
+    finally:
+        client.portal.call(broadcaster.unsubscribe, subscription)
+
+
+def test_broadcaster_runs_only_with_clients(client):
+    broadcaster = events.broadcasters.get()
+
+    async def wait_until_stopped():
+        while broadcaster.running:
+            await asyncio.sleep(0.01)
+
+    client.portal.call(wait_until_stopped)
+    first = client.portal.call(broadcaster.subscribe)
+    second = client.portal.call(broadcaster.subscribe)
+    assert broadcaster.running
+    client.portal.call(broadcaster.unsubscribe, first)
+    assert broadcaster.running
+    client.portal.call(broadcaster.unsubscribe, second)
+    client.portal.call(asyncio.wait_for, wait_until_stopped(), 5)
+
+
+def test_broadcaster_carries_on_after_errors(
+    client, unique, make_share, monkeypatch, caplog
+):
+    monkeypatch.setattr(events, "RETRY_DELAY", 0.01)
+    read_events = events.read_events
+    failures = []
+
+    async def failing_once(after_id):
+        if not failures:
+            failures.append(after_id)
+            raise OSError("disk I/O error")
+        return await read_events(after_id)
+
+    broadcaster = events.broadcasters.get()
+    subscription = client.portal.call(broadcaster.subscribe)
+    try:
+        monkeypatch.setattr(events, "read_events", failing_once)
+        share = client.post("/shares/", json=make_share(unique("kai"))).json()
+
+        async def received():
+            while True:
+                event = await asyncio.wait_for(subscription.queue.get(), timeout=5)
+                if event.table_name == "shares" and event.row_id == share["id"]:
+                    return event
+
+        assert client.portal.call(received).op == "create"
+        assert failures
+        assert "Reading the change log of the default database failed" in caplog.text
+        assert broadcaster.running
+    finally:
+        client.portal.call(broadcaster.unsubscribe, subscription)
+
+
+def test_ended_broadcaster_is_restarted(client):
+    broadcaster = events.broadcasters.get()
+    first = client.portal.call(broadcaster.subscribe)
+    try:
+        # The task ends without stop() or the last client leaving
+        client.portal.call(broadcaster._task.cancel)
+
+        async def wait_until_ended():
+            while broadcaster.running:
+                await asyncio.sleep(0.01)
+
+        client.portal.call(asyncio.wait_for, wait_until_ended(), 5)
+        second = client.portal.call(broadcaster.subscribe)
+        assert broadcaster.running
+        client.portal.call(broadcaster.unsubscribe, second)
+    finally:
+        client.portal.call(broadcaster.unsubscribe, first)
@@ -0,0 +1,71 @@
+"""Tests of proximity filtering (see geo.py)"""
+
+import pytest
+
+import geo
+
+OSLO = (59.91, 10.75)
+BERGEN = (60.39, 5.32)
+# On either side of the 180th meridian, some 50 km apart
+TAVEUNI = (-16.8, 179.9)
+EAST_OF_TAVEUNI = (-16.8, -179.6)
+
+
+def located(lat_lon):
+    return {"latitude": lat_lon[0], "longitude": lat_lon[1]}
+
+
+def near(lat_lon):
+    return f"{lat_lon[0]},{lat_lon[1]}"
+
+
+def test_distance_km():
+    assert geo.distance_km(*OSLO, *BERGEN) == pytest.approx(305, abs=2)
+    assert geo.distance_km(*OSLO, *OSLO) == 0
+
+
+def test_bounding_boxes_split_at_the_antimeridian():
+    boxes = geo.bounding_boxes(*TAVEUNI, 100)
+    assert len(boxes) == 2
+    assert boxes[0][3] == 180 and boxes[1][2] == -180
+    # Near a pole, every longitude
+    assert geo.bounding_boxes(89.5, 0, 100)[0][2:] == (-180, 180)
+
+
+def test_near_filter(client, unique, make_share):
+    user = unique("cy")
+    ids = {}
+    for name, place in [("oslo", OSLO), ("bergen", BERGEN), ("taveuni", TAVEUNI)]:
+        share = make_share(user, **located(place))
+        ids[name] = client.post("/shares/", json=share).json()["id"]
+    client.post("/shares/", json=make_share(user))
+
+    def listed(place, radius_km):
+        params = {"shared_by": user, "near": near(place), "radius_km": radius_km}
+        response = client.get("/shares/", params=params)
+        assert response.status_code == 200
+        return sorted(share["id"] for share in response.json())
+
+    assert listed(OSLO, 50) == [ids["oslo"]]
+    assert listed(OSLO, 400) == sorted([ids["oslo"], ids["bergen"]])
+    # Across the 180th meridian
+    assert listed(EAST_OF_TAVEUNI, 100) == [ids["taveuni"]]
+
+    bad = client.get("/shares/", params={"near": "north", "radius_km": 5})
+    assert bad.status_code == 400
+
+
+def test_location_is_all_or_nothing(client, unique, make_share):
+    share = make_share(unique("di"), latitude=OSLO[0])
+    assert client.post("/shares/", json=share).status_code == 422
+
+
+def test_new_rows_take_the_users_location(client, sign_up, make_share, make_request):
+    username, headers = sign_up("ed")
+    response = client.put("/users/me/location", json=located(BERGEN), headers=headers)
+    assert response.status_code == 200
+
+    share = client.post("/shares/", json=make_share(username)).json()
+    assert (share["latitude"], share["longitude"]) == BERGEN
+    request = client.post("/requests/", json=make_request(username, **located(OSLO))).json()
+    assert (request["latitude"], request["longitude"]) == OSLO
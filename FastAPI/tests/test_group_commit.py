@@ -0,0 +1,92 @@
+"""Tests of the group commit of new shares and requests (see group_commit.py)"""
+
+import asyncio
+
+import pytest
+
+import config
+import group_commit
+import replicas
+import schemas
+
+
+@pytest.fixture
+def writer(client, monkeypatch):
+    """A running writer, used by the endpoints"""
+    monkeypatch.setattr(config, "WRITE_BATCH_DELAY", 0.05)
+    new_writer = group_commit.GroupCommitWriter()
+    client.portal.call(_start, new_writer)
+    monkeypatch.setattr(group_commit, "writer", new_writer)
+    yield new_writer
+    client.portal.call(new_writer.stop)
+    assert not new_writer.running
+
+
+async def _start(writer):
+    writer.start()
+
+
+@pytest.fixture
+def batches(monkeypatch):
+    """The sizes of the batches of shares written"""
+    sizes = []
+    create_shares = group_commit.CREATORS["shares"]
+
+    async def counting(db, rows):
+        if any(row.plant_name == "Bad" for row in rows):
+            raise ValueError("bad plant")
+        sizes.append(len(rows))
+        return await create_shares(db, rows)
+
+    monkeypatch.setitem(group_commit.CREATORS, "shares", counting)
+    return sizes
+
+
+def share(make_share, user, **values):
+    return schemas.ShareBase(**make_share(user, **values))
+
+
+def test_rows_are_written_in_batches(
+    writer, batches, client, unique, make_share, make_request
+):
+    user = unique("ian")
+
+    async def create_all():
+        return await asyncio.gather(
+            *(writer.create_share(share(make_share, user, amount=i)) for i in range(1, 21)),
+            writer.create_request(schemas.RequestBase(**make_request(user))),
+        )
+
+    *shares, request = client.portal.call(create_all)
+    assert batches == [20]
+    assert [share.amount for share in shares] == list(range(1, 21))
+    # Written without a request, so read back from a fresh replica
+    replicas.copier.copy()
+    listed = client.get("/shares/", params={"shared_by": user, "limit": 100}).json()
+    assert sorted(share["id"] for share in listed) == sorted(s.id for s in shares)
+    requests = client.get("/requests/", params={"requested_by": user}).json()
+    assert [row["id"] for row in requests] == [request.id]
+
+
+def test_a_failing_row_fails_alone(writer, batches, client, unique, make_share):
+    user = unique("jan")
+
+    async def create_all():
+        return await asyncio.gather(
+            *(
+                writer.create_share(share(make_share, user, plant_name=plant))
+                for plant in ("Good", "Bad", "Good")
+            ),
+            return_exceptions=True,
+        )
+
+    good, bad, also_good = client.portal.call(create_all)
+    assert isinstance(bad, ValueError)
+    assert good.plant_name == also_good.plant_name == "Good"
+    assert batches == [1, 1]
+
+
+def test_endpoints_use_the_writer(writer, batches, client, unique, make_share):
+    response = client.post("/shares/", json=make_share(unique("kai")))
+    assert response.status_code == 200
+    assert batches == [1]
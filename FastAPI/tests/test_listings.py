@@ -0,0 +1,123 @@
+"""Tests of the share and request listings: filters and cursors"""
+
+import main
+
+
+def post_shares(client, make_share, shared_by, count, **values):
+    """Post shares one by one; returns their ids"""
+    ids = []
+    for i in range(count):
+        response = client.post(
+            "/shares/", json=make_share(shared_by, amount=i + 1, **values)
+        )
+        assert response.status_code == 200
+        ids.append(response.json()["id"])
+    return ids
+
+
+def test_cursor_pages_through_all_shares(client, unique, make_share):
+    user = unique("ann")
+    ids = post_shares(client, make_share, user, 5)
+
+    seen = []
+    params = {"shared_by": user, "limit": 2}
+    while True:
+        response = client.get("/shares/", params=params)
+        assert response.status_code == 200
+        assert len(response.json()) <= 2
+        seen.extend(share["id"] for share in response.json())
+        cursor = response.headers.get(main.NEXT_CURSOR_HEADER)
+        if cursor is None:
+            break
+        params["cursor"] = cursor
+    assert seen == ids
+
+
+def test_default_pages_reach_the_newest_share(client, unique, make_share):
+    # As the dashboard gets a listing: default page size, following the cursor
+    user = unique("abe")
+    shares = [make_share(user, amount=i + 1) for i in range(main.DEFAULT_PAGE_SIZE + 1)]
+    ids = client.post("/shares/bulk", json=shares).json()["ids"]
+
+    pages = []
+    params = {"shared_by": user}
+    while True:
+        response = client.get("/shares/", params=params)
+        pages.append([share["id"] for share in response.json()])
+        if main.NEXT_CURSOR_HEADER not in response.headers:
+            break
+        params["cursor"] = response.headers[main.NEXT_CURSOR_HEADER]
+    assert len(pages) > 1
+    assert len(pages[0]) == main.DEFAULT_PAGE_SIZE
+    assert [id for page in pages for id in page] == ids
+
+
+def test_bad_cursor_is_rejected(client):
+    assert client.get("/shares/", params={"cursor": "not a cursor"}).status_code == 400
+
+
+def test_filters(client, unique, make_share):
+    user = unique("amy")
+    plant = unique("Monstera")
+    post_shares(client, make_share, user, 1, plant_name=plant, date="2024-01-10")
+    post_shares(client, make_share, user, 1, is_available_now=False, date="2024-02-10")
+
+    def listed(**params):
+        shares = client.get("/shares/", params={"shared_by": user, **params}).json()
+        return [(share["plant_name"], share["date"]) for share in shares]
+
+    assert listed(plant_name=plant.lower()) == [(plant, "2024-01-10")]
+    assert listed(is_available_now=False) == [("Fern", "2024-02-10")]
+    assert listed(date_from="2024-02-01") == [("Fern", "2024-02-10")]
+    assert listed(date_to="2024-01-31") == [(plant, "2024-01-10")]
+
+
+def test_posted_dates_are_stored_as_dates(client, unique, make_share):
+    user = unique("ada")
+    post_shares(client, make_share, user, 1, date=" 2023-10-08 ")
+    shares = client.get("/shares/", params={"shared_by": user}).json()
+    assert [share["date"] for share in shares] == ["2023-10-08"]
+
+    # Dates that are not ISO dates are rejected, as they may be ambiguous
+    for date in ("someday", "10/8/2023", "8/10/2023", 20231008):
+        response = client.post("/shares/", json=make_share(user, date=date))
+        assert response.status_code == 422
+
+
+def test_requests_listing(client, unique, make_request):
+    user = unique("dan")
+    for _ in range(3):
+        assert client.post("/requests/", json=make_request(user)).status_code == 200
+    response = client.get("/requests/", params={"requested_by": user, "limit": 2})
+    assert len(response.json()) == 2
+    assert main.NEXT_CURSOR_HEADER in response.headers
+    rest = client.get(
+        "/requests/",
+        params={"requested_by": user, "cursor": response.headers[main.NEXT_CURSOR_HEADER]},
+    )
+    assert len(rest.json()) == 1
+
+
+def test_etags(client, unique, make_share):
+    user = unique("eve")
+    post_shares(client, make_share, user, 1)
+    params = {"shared_by": user}
+    response = client.get("/shares/", params=params)
+    etag = response.headers["ETag"]
+    assert response.headers["Cache-Control"] == "no-cache"
+
+    # Unchanged listing: nothing to send
+    response = client.get("/shares/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    # A different query has its own tag
+    other = client.get("/shares/", params={**params, "limit": 5})
+    assert other.headers["ETag"] != etag
+
+    # Any new share changes the listing's tag and content
+    post_shares(client, make_share, user, 1)
+    response = client.get("/shares/", params=params, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()) == 2
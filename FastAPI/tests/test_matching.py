@@ -0,0 +1,95 @@
+"""Tests of the matching of shares with requests (see matching.py)"""
+
+import datetime
+
+import config
+import main
+import matching
+
+
+def post(client, path, row):
+    response = client.post(path, json=row)
+    assert response.status_code == 200
+    return response.json()["id"]
+
+
+def matches(client, **params):
+    """The (share id, request id) of the matches listed, best first"""
+    response = client.get("/matches/", params=params)
+    assert response.status_code == 200
+    return [(match["share"]["id"], match["request"]["id"]) for match in response.json()]
+
+
+def test_shares_match_requests_for_the_same_plant(
+    client, unique, make_share, make_request
+):
+    plant = unique("Inside-out Flower")
+    request_id = post(client, "/requests/", make_request(unique("bo"), plant.lower()))
+    share_id = post(client, "/shares/", make_share(unique("al"), plant.replace("-", " ")))
+    post(client, "/shares/", make_share(unique("al"), plant, is_available_now=False))
+    post(client, "/shares/", make_share(unique("al"), unique("Other plant")))
+
+    assert matches(client, plant_name=plant) == [(share_id, request_id)]
+
+
+def test_better_amount_fit_ranks_first(client, unique, make_share, make_request):
+    plant = unique("Aloe")
+    request_id = post(client, "/requests/", make_request(unique("bo"), plant, amount=4))
+    small = post(client, "/shares/", make_share(unique("al"), plant, amount=1))
+    large = post(client, "/shares/", make_share(unique("al"), plant, amount=4))
+
+    assert matches(client, plant_name=plant) == [(large, request_id), (small, request_id)]
+
+
+def test_deleted_rows_are_unmatched(client, unique, make_share, make_request):
+    plant = unique("Pothos")
+    request_id = post(client, "/requests/", make_request(unique("bo"), plant))
+    kept = post(client, "/shares/", make_share(unique("al"), plant))
+    deleted = post(client, "/shares/", make_share(unique("al"), plant))
+
+    assert client.delete(f"/shares/{deleted}").status_code == 200
+    assert matches(client, plant_name=plant) == [(kept, request_id)]
+    assert client.delete(f"/requests/{request_id}").status_code == 200
+    assert matches(client, plant_name=plant) == []
+
+
+def test_matches_are_paged(client, unique, make_share, make_request):
+    plant = unique("Jade")
+    owner = unique("bo")
+    post(client, "/requests/", make_request(owner, plant))
+    for _ in range(3):
+        post(client, "/shares/", make_share(unique("al"), plant))
+
+    first = client.get("/matches/", params={"requested_by": owner, "limit": 2})
+    assert len(first.json()) == 2
+    cursor = first.headers[main.NEXT_CURSOR_HEADER]
+    rest = client.get(
+        "/matches/", params={"requested_by": owner, "limit": 2, "cursor": cursor}
+    )
+    assert len(rest.json()) == 1
+    ids = [match["id"] for match in first.json() + rest.json()]
+    assert len(set(ids)) == 3
+
+
+def test_score_is_bounded():
+    today = datetime.date(2024, 5, 31).toordinal()
+    posted = matching.posted_day(datetime.date(2024, 5, 1), datetime.date(2024, 5, 31))
+    # A whole request covered 30 days ago ranks with half of one covered today
+    assert matching.score(1.0, posted, today) == matching.score(0.5, today, today)
+    assert 0 < matching.score(0.0, 1, today) < matching.score(1.0, today, today) == 2
+
+
+def test_only_the_best_matches_are_kept(
+    client, unique, make_share, make_request, monkeypatch
+):
+    monkeypatch.setattr(config, "MATCHES_PER_REQUEST", 2)
+    plant = unique("Ivy")
+    request_id = post(client, "/requests/", make_request(unique("bo"), plant, amount=4))
+    weak = post(client, "/shares/", make_share(unique("al"), plant, amount=1))
+    strong = post(client, "/shares/", make_share(unique("al"), plant, amount=4))
+    medium = post(client, "/shares/", make_share(unique("al"), plant, amount=2))
+    assert matches(client, plant_name=plant) == [(strong, request_id), (medium, request_id)]
+
+    # The request is rematched with the best share left
+    client.delete(f"/shares/{strong}")
+    assert matches(client, plant_name=plant) == [(medium, request_id), (weak, request_id)]
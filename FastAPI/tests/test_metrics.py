@@ -0,0 +1,39 @@
+"""Tests of the request and SQL metrics (see metrics.py)"""
+
+import logging
+
+import config
+
+
+def scrape(client) -> dict:
+    """The metrics, as {"name{labels}": value}"""
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    return {
+        line.rsplit(" ", 1)[0]: float(line.rsplit(" ", 1)[1])
+        for line in response.text.splitlines()
+        if not line.startswith("#")
+    }
+
+
+def test_requests_are_counted_by_route(client):
+    key = 'plantswap_http_requests_total{method="DELETE",route="/shares/{shares_id}",status="404"}'
+    before = scrape(client).get(key, 0)
+    for share_id in (-1, -2):
+        assert client.delete(f"/shares/{share_id}").status_code == 404
+    after = scrape(client)
+    # One series for both ids
+    assert after[key] == before + 2
+
+    statements = after[
+        'plantswap_http_request_sql_statements_count{method="DELETE",route="/shares/{shares_id}"}'
+    ]
+    assert statements >= 2
+    assert after["plantswap_sql_statements_total"] > 0
+
+
+def test_slow_queries_are_logged(client, monkeypatch, caplog):
+    monkeypatch.setattr(config, "SLOW_QUERY_SECONDS", 1e-9)
+    with caplog.at_level(logging.WARNING, logger="plantswap.slow_query"):
+        client.get("/shares/", params={"shared_by": "nobody", "limit": 1})
+    assert any("FROM shares" in record.getMessage() for record in caplog.records)
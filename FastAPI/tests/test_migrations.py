@@ -0,0 +1,114 @@
+"""Tests of migrations.py: upgrading databases from before versioning"""
+
+import datetime
+import sqlite3
+
+import pytest
+from sqlalchemy import create_engine, inspect, select
+from sqlalchemy.orm import Session
+
+import migrations
+import models
+
+# The schema of plants.db before migrations (version 0)
+V0_SCHEMA = """
+CREATE TABLE users (
+    id INTEGER NOT NULL, username VARCHAR, hashed_password VARCHAR,
+    is_active BOOLEAN, PRIMARY KEY (id)
+);
+CREATE UNIQUE INDEX ix_users_username ON users (username);
+CREATE TABLE shares (
+    id INTEGER NOT NULL, plant_name VARCHAR, shared_by VARCHAR, amount FLOAT,
+    description VARCHAR, is_available_now BOOLEAN, date VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE requests (
+    id INTEGER NOT NULL, plant_name VARCHAR, requested_by VARCHAR, amount FLOAT,
+    notes VARCHAR, date VARCHAR, PRIMARY KEY (id)
+);
+CREATE TABLE items (
+    id INTEGER NOT NULL, title VARCHAR, description VARCHAR, owner_id INTEGER,
+    PRIMARY KEY (id), FOREIGN KEY(owner_id) REFERENCES users (id)
+);
+"""
+
+
+@pytest.fixture
+def v0_engine(tmp_path):
+    """Engine on a version 0 database, with a few users, shares and requests"""
+    path = tmp_path / "v0.db"
+    with sqlite3.connect(path) as conn:
+        conn.executescript(V0_SCHEMA)
+        conn.executemany(
+            "INSERT INTO users VALUES (?, ?, ?, ?)",
+            [(1, "ann", "hash", 1), (2, "bob", "hash", 1)],
+        )
+        conn.executemany(
+            "INSERT INTO shares VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                # Dates as sent by the React client, and as ISO dates
+                (1, "Spider Plant", "ann", 2.0, "Babies", 1, "10/8/2023"),
+                (2, "Fern", "ann", 1.0, "Cuttings", 1, "2023-10-09"),
+                (3, "Fern", "bob", 1.0, "Gone", 0, "not a date"),
+                (4, "Fern", "bob", 1.0, "Local", 1, "25/10/2023"),
+            ],
+        )
+        conn.executemany(
+            "INSERT INTO requests VALUES (?, ?, ?, ?, ?, ?)",
+            [(1, "spider  plant", "bob", 1.0, "Any", "10/10/2023")],
+        )
+    engine = create_engine(f"sqlite:///{path}")
+    yield engine
+    engine.dispose()
+
+
+def test_upgrade_from_v0(v0_engine, caplog):
+    assert migrations.upgrade(v0_engine) == 0
+    with v0_engine.connect() as conn:
+        assert migrations.get_version(conn) == migrations.LATEST_VERSION
+        share_indexes = {index["name"] for index in inspect(conn).get_indexes("shares")}
+        assert "ix_shares_shared_by_date" in share_indexes
+
+    with Session(v0_engine) as db:
+        shares = {share.id: share for share in db.scalars(select(models.Shares))}
+        assert shares[1].date == datetime.date(2023, 10, 8)
+        assert shares[2].date == datetime.date(2023, 10, 9)
+        assert shares[3].date is None
+        assert shares[3].description == "Gone"
+        assert shares[4].date is None
+        request = db.get(models.Requests, 1)
+        assert request.date == datetime.date(2023, 10, 10)
+        assert shares[1].plant_key == request.plant_key == "spider plant"
+
+        # The spider plant share and request are matched; the unavailable
+        # fern is not
+        matches = db.scalars(select(models.Matches)).all()
+        assert [(m.share_id, m.request_id) for m in matches] == [(1, 1)]
+
+        # The text of the dates that were not ISO dates is kept
+        legacy = db.scalars(select(models.LegacyDates)).all()
+        assert {(row.table_name, row.row_id): row.date_text for row in legacy} == {
+            ("shares", 1): "10/8/2023",
+            ("shares", 3): "not a date",
+            ("shares", 4): "25/10/2023",
+            ("requests", 1): "10/10/2023",
+        }
+    assert "1 shares dates were read as M/D/YYYY and 2 could not be read" in (
+        caplog.text
+    )
+
+
+def test_upgrade_is_idempotent(v0_engine):
+    migrations.upgrade(v0_engine)
+    assert migrations.upgrade(v0_engine) == migrations.LATEST_VERSION
+    with Session(v0_engine) as db:
+        assert len(db.scalars(select(models.Shares)).all()) == 4
+
+
+def test_upgrade_creates_new_database(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/new.db")
+    try:
+        assert migrations.upgrade(engine) is None
+        with engine.connect() as conn:
+            assert migrations.get_version(conn) == migrations.LATEST_VERSION
+    finally:
+        engine.dispose()
@@ -0,0 +1,142 @@
+"""Tests of share photos: uploads, and serving them in ranges (see photos.py)"""
+
+import hashlib
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import archive
+import config
+import shards
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+@pytest.fixture
+def photo():
+    """The bytes of a photo no other test uploads"""
+    return PNG_SIGNATURE + os.urandom(5000)
+
+
+@pytest.fixture
+def owner(client, sign_up, make_share):
+    """A share of a logged-in user, and the user's token headers"""
+    username, headers = sign_up("lou")
+    share_id = client.post("/shares/", json=make_share(username)).json()["id"]
+    return SimpleNamespace(username=username, share_id=share_id, headers=headers)
+
+
+def upload(client, share_id, headers, content, content_type="image/png"):
+    files = {"photo": ("fern.png", content, content_type)}
+    return client.post(f"/shares/{share_id}/photo", files=files, headers=headers)
+
+
+def test_upload_and_download(client, owner, photo):
+    response = upload(client, owner.share_id, owner.headers, photo)
+    assert response.status_code == 200
+    photo_hash = hashlib.sha256(photo).hexdigest()
+    assert response.json()["photo_url"].endswith(photo_hash)
+
+    listed = client.get("/shares/", params={"shared_by": owner.username}).json()
+    assert listed[0]["thumbnail_url"] == response.json()["thumbnail_url"]
+
+    downloaded = client.get(f"/photos/{photo_hash}")
+    assert downloaded.content == photo
+    assert downloaded.headers["Content-Type"] == "image/png"
+    assert downloaded.headers["Accept-Ranges"] == "bytes"
+    etag = downloaded.headers["ETag"]
+    cached = client.get(f"/photos/{photo_hash}", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+
+    thumbnail = client.get(f"/photos/{photo_hash}/thumbnail")
+    assert thumbnail.status_code == 200
+    assert thumbnail.headers["Content-Type"].startswith("image/")
+
+
+def test_ranges(client, owner, photo):
+    url = upload(client, owner.share_id, owner.headers, photo).json()["photo_url"]
+    size = len(photo)
+
+    def get(range_, **headers):
+        return client.get(url, headers={"Range": range_, **headers})
+
+    response = get("bytes=100-199")
+    assert response.status_code == 206
+    assert response.content == photo[100:200]
+    assert response.headers["Content-Range"] == f"bytes 100-199/{size}"
+
+    assert get("bytes=-10").content == photo[-10:]
+    assert get(f"bytes={size - 5}-").content == photo[-5:]
+
+    response = get(f"bytes={size}-")
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == f"bytes */{size}"
+
+    # If-Range with another version's tag: the whole photo
+    response = get("bytes=0-9", **{"If-Range": '"other"'})
+    assert (response.status_code, response.content) == (200, photo)
+
+
+def test_bad_uploads(client, owner, photo, monkeypatch):
+    share_id, headers = owner.share_id, owner.headers
+    assert upload(client, share_id, headers, b"not an image").status_code == 400
+    assert upload(client, -1, headers, photo).status_code == 404
+    monkeypatch.setattr(config, "PHOTO_MAX_BYTES", 1000)
+    assert upload(client, share_id, headers, photo).status_code == 413
+    assert client.get("/photos/" + "0" * 64).status_code == 404
+
+
+def test_only_the_owner_uploads(client, owner, sign_up, photo):
+    assert upload(client, owner.share_id, {}, photo).status_code == 401
+    _, other = sign_up("nia")
+    assert upload(client, owner.share_id, other, photo).status_code == 403
+
+
+def test_orphaned_photos_are_removed(client, owner, photo, monkeypatch):
+    share_id, headers = owner.share_id, owner.headers
+    replaced = upload(client, share_id, headers, photo).json()["photo_url"]
+    kept = upload(client, share_id, headers, photo + b"v2").json()["photo_url"]
+    client.get(replaced + "/thumbnail")
+
+    monkeypatch.setattr(config, "PHOTO_ORPHAN_AGE", 1e-9)
+
+    async def remove():
+        communities = [None, *await shards.list_communities()]
+        return await archive.remove_orphan_photos(communities)
+
+    assert client.portal.call(remove) >= 1
+    assert client.get(replaced).status_code == 404
+    assert client.get(kept).status_code == 200
+
+
+def test_dump_round_trip_keeps_photos(client, owner, photo, monkeypatch):
+    monkeypatch.setattr(config, "DUMP_USERNAMES", {owner.username})
+    photo_url = upload(client, owner.share_id, owner.headers, photo).json()["photo_url"]
+    before = client.get("/shares/", params={"shared_by": owner.username}).json()
+    exported = client.get("/export/shares", headers=owner.headers).text
+    [line] = [
+        line for line in exported.splitlines() if json.loads(line)["id"] == owner.share_id
+    ]
+    assert json.loads(line)["photo_hash"] == hashlib.sha256(photo).hexdigest()
+
+    client.delete(f"/shares/{owner.share_id}")
+    headers = {**owner.headers, "Content-Type": "application/x-ndjson"}
+    response = client.post("/import/shares", content=line, headers=headers)
+    assert response.json() == {"imported": 1}
+    assert client.get("/shares/", params={"shared_by": owner.username}).json() == before
+
+    # The restored share's photo is not an orphan
+    monkeypatch.setattr(config, "PHOTO_ORPHAN_AGE", 1e-9)
+
+    async def remove():
+        communities = [None, *await shards.list_communities()]
+        return await archive.remove_orphan_photos(communities)
+
+    client.portal.call(remove)
+    assert client.get(photo_url).status_code == 200
+
+    # Only hashes can be imported, as photos are stored by them
+    bad = json.dumps({**json.loads(line), "id": 10**9, "photo_hash": "../plants.db"})
+    assert client.post("/import/shares", content=bad, headers=headers).status_code == 400
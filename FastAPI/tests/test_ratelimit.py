@@ -0,0 +1,100 @@
+"""Tests of the login and sign up rate limits (see ratelimit.py)"""
+
+import pytest
+from starlette.requests import Request
+
+import config
+import ratelimit
+from ratelimit import InMemoryBackend, Rate, RateLimitBackend
+
+
+class FakeTimer:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_parse_rate():
+    assert Rate.parse("10/60") == Rate(10, 60.0)
+    assert Rate.parse("") is None
+    with pytest.raises(ValueError):
+        Rate.parse("ten a minute")
+
+
+def test_token_bucket():
+    timer = FakeTimer()
+    buckets = InMemoryBackend(max_keys=10, timer=timer)
+    rate = Rate(2, 60)
+    # A burst of two, then one every 30 seconds
+    assert buckets.acquire("ann", rate) == 0
+    assert buckets.acquire("ann", rate) == 0
+    assert buckets.acquire("ann", rate) == pytest.approx(30)
+    assert buckets.acquire("bob", rate) == 0
+    timer.now = 30
+    assert buckets.acquire("ann", rate) == 0
+    assert buckets.acquire("ann", rate) > 0
+
+
+def test_least_recently_used_buckets_are_forgotten():
+    buckets = InMemoryBackend(max_keys=2, timer=FakeTimer())
+    rate = Rate(1, 60)
+    for key in ("ann", "bob", "cat"):
+        buckets.acquire(key, rate)
+    assert len(buckets) == 2
+    # Forgotten, so full again
+    assert buckets.acquire("ann", rate) == 0
+    assert buckets.acquire("cat", rate) > 0
+
+
+def test_backends_must_implement_acquire_and_reset():
+    class Incomplete(RateLimitBackend):
+        def reset(self):
+            pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def request_from(address, forwarded=None):
+    headers = [(b"x-forwarded-for", forwarded.encode())] if forwarded else []
+    return Request({"type": "http", "client": (address, 1234), "headers": headers})
+
+
+def test_client_ip_behind_trusted_proxies(monkeypatch):
+    monkeypatch.setattr(config, "TRUSTED_PROXIES", {"10.0.0.1", "10.0.0.2"})
+    assert ratelimit.client_ip(request_from("10.0.0.1")) == "10.0.0.1"
+    assert ratelimit.client_ip(request_from("10.0.0.1", "203.0.113.9")) == "203.0.113.9"
+    # The client can send its own X-Forwarded-For; only the proxies' hops count
+    chain = "198.51.100.1, 203.0.113.9, 10.0.0.2"
+    assert ratelimit.client_ip(request_from("10.0.0.1", chain)) == "203.0.113.9"
+    # Not from a proxy: the header is not trusted
+    assert ratelimit.client_ip(request_from("192.0.2.7", "203.0.113.9")) == "192.0.2.7"
+
+
+@pytest.fixture
+def limits(monkeypatch):
+    """Set the limits of the token route, with empty buckets to start"""
+    monkeypatch.setattr(ratelimit, "backend", InMemoryBackend(max_keys=100))
+    monkeypatch.setitem(
+        ratelimit.LIMITS, "token", {"ip": Rate(5, 60), "username": Rate(2, 60)}
+    )
+
+
+def test_logins_are_limited(limits, client, unique):
+    username = unique("zed")
+    form = {"username": username, "password": "wrong"}
+    assert [client.post("/token", data=form).status_code for _ in range(3)] == [
+        401,
+        401,
+        429,
+    ]
+    response = client.post("/token", data=form)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+
+    # Other usernames still have the IP's remaining attempts
+    other = {"username": unique("zed"), "password": "wrong"}
+    assert client.post("/token", data=other).status_code == 401
+    assert client.post("/token", data=other).status_code == 429
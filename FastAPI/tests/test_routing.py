@@ -0,0 +1,67 @@
+"""
+Tests of the routing of requests to databases: each community to its
+own (see shards.py), and reads to the read replica (see replicas.py)
+"""
+
+import pytest
+
+import replicas
+import shards
+
+
+@pytest.fixture(scope="module")
+def community():
+    """A community, with its own database"""
+    shards.create("riverside")
+    return "riverside"
+
+
+def test_community_rows_stay_in_its_database(client, unique, make_share, community):
+    user = unique("jo")
+    response = client.post(f"/c/{community}/shares/", json=make_share(user))
+    assert response.status_code == 200
+
+    by_path = client.get(f"/c/{community}/shares/", params={"shared_by": user})
+    assert [share["id"] for share in by_path.json()] == [response.json()["id"]]
+    by_header = client.get(
+        "/shares/", params={"shared_by": user}, headers={"X-Community": community}
+    )
+    assert by_header.json() == by_path.json()
+    default = client.get("/shares/", params={"shared_by": user})
+    assert default.json() == []
+
+
+def test_community_token_routes_requests(client, unique, make_share, community):
+    user = unique("kim")
+    form = {"username": user, "password": "secret"}
+    assert client.post(f"/c/{community}/users/", data=form).status_code == 200
+    # The user is only in the community's database
+    assert client.post("/token", data=form).status_code == 401
+    token = client.post(f"/c/{community}/token", data=form).json()["access_token"]
+
+    me = client.get("/users/me/", headers={"Authorization": f"Bearer {token}"})
+    assert me.status_code == 200
+    assert me.json()["username"] == user
+
+
+def test_unknown_and_invalid_communities(client):
+    assert client.get("/c/nowhere/shares/").status_code == 404
+    assert client.get("/shares/", headers={"X-Community": "Not Valid"}).status_code == 400
+
+
+def test_reads_go_to_replica_except_own_writes(client, unique, make_share):
+    user = unique("lee")
+    share_id = client.post("/shares/", json=make_share(user)).json()["id"]
+
+    # The client that posted reads it back from the database itself
+    own = client.get("/shares/", params={"shared_by": user})
+    assert [share["id"] for share in own.json()] == [share_id]
+
+    # Other clients read from the replica, which has not been copied to yet
+    client.cookies.clear()
+    other = client.get("/shares/", params={"shared_by": user})
+    assert other.json() == []
+
+    assert replicas.copier.copy()
+    copied = client.get("/shares/", params={"shared_by": user})
+    assert [share["id"] for share in copied.json()] == [share_id]
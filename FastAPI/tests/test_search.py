@@ -0,0 +1,42 @@
+"""Tests of the plant search (see search.py)"""
+
+import search
+
+
+def found(client, q, **params):
+    """The (kind, id) of the search results, best first"""
+    response = client.get("/search", params={"q": q, **params})
+    assert response.status_code == 200
+    return [(result["kind"], result[result["kind"]]["id"]) for result in response.json()]
+
+
+def test_trigrams():
+    assert search.trigrams("Aloe aloe") == ["alo", "loe"]
+    assert search.trigrams("ab") == []
+
+
+def test_typos_still_match(client, unique, make_share, make_request):
+    user = unique("sue")
+    share = client.post(
+        "/shares/", json=make_share(user, "Monstera deliciosa", description="Zygocactus cutting")
+    ).json()["id"]
+    request = client.post(
+        "/requests/", json=make_request(user, "Zygocactus", notes="")
+    ).json()["id"]
+
+    assert ("share", share) in found(client, "monstera delicosa")
+    assert {("request", request), ("share", share)} <= set(found(client, "zygocactis"))
+    assert found(client, "zygocactis", kind="share")[0] == ("share", share)
+
+
+def test_index_follows_deletes(client, unique, make_share):
+    user = unique("sam")
+    share = client.post("/shares/", json=make_share(user, "Xerographica")).json()["id"]
+    assert ("share", share) in found(client, "xerografica")
+
+    assert client.delete(f"/shares/{share}").status_code == 200
+    assert ("share", share) not in found(client, "xerografica")
+
+
+def test_empty_query_is_rejected(client):
+    assert client.get("/search", params={"q": ""}).status_code == 422
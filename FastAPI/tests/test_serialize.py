@@ -0,0 +1,39 @@
+"""Tests of the direct serialization of listings (see serialize.py)"""
+
+from typing import List
+
+import pytest
+from pydantic import TypeAdapter
+from sqlalchemy import select
+
+import crud
+import schemas
+import serialize
+from database import SessionLocal
+
+
+@pytest.fixture(params=["orjson", "json"])
+def encoder(request, monkeypatch):
+    """Run a test with orjson, if installed, and with the standard library"""
+    if request.param == "json":
+        monkeypatch.setattr(serialize, "orjson", None)
+    elif serialize.orjson is None:
+        pytest.skip("orjson is not installed")
+
+
+def test_same_output_as_pydantic(encoder, client, unique, make_share):
+    user = unique("yan")
+    client.post("/shares/", json=make_share(user, description='Ünïcode "quoted"'))
+    client.post("/shares/", json=make_share(user, is_available_now=False))
+    with SessionLocal() as db:
+        query = select(*crud.SHARE_COLUMNS).filter_by(shared_by=user)
+        rows = db.execute(query).all()
+        shares = db.scalars(select(crud.models.Shares).filter_by(shared_by=user)).all()
+
+    adapter = TypeAdapter(List[schemas.ShareListing])
+    expected = adapter.dump_json(adapter.validate_python(shares))
+    assert serialize.dump_rows(rows) == expected
+
+
+def test_empty(encoder):
+    assert serialize.dump_rows([]) == b"[]"
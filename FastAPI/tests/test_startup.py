@@ -0,0 +1,36 @@
+"""Tests of what importing and starting the app does"""
+
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_python(code, cwd, **env):
+    """
+    Run Python code in a new process, with the app importable and its
+    default settings rather than the tests'
+    """
+    env = {
+        **{k: v for k, v in os.environ.items() if not k.startswith("PLANTSWAP_")},
+        "PYTHONPATH": APP_DIR,
+        **env,
+    }
+    subprocess.run([sys.executable, "-c", code], cwd=cwd, env=env, check=True)
+
+
+def test_import_does_no_database_work(tmp_path):
+    run_python("import main, sys; assert 'passlib' not in sys.modules", tmp_path)
+    assert not (tmp_path / "plants.db").exists()
+
+
+def test_startup_creates_the_database(tmp_path):
+    code = (
+        "from fastapi.testclient import TestClient\n"
+        "import main\n"
+        "with TestClient(main.app) as client:\n"
+        "    assert client.get('/shares/').json() == []\n"
+    )
+    run_python(code, tmp_path)
+    assert (tmp_path / "plants.db").exists()
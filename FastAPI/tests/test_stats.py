@@ -0,0 +1,63 @@
+"""Tests of the plant and user statistics (see stats.py)"""
+
+import models
+import stats
+from database import SessionLocal
+
+
+def plant_stats(client, plant, order="supply"):
+    response = client.get("/stats/plants", params={"order": order, "limit": 1000})
+    assert response.status_code == 200
+    return next((row for row in response.json() if row["plant_name"] == plant), None)
+
+
+def user_stats(client, username, order="shares"):
+    response = client.get("/stats/users", params={"order": order, "limit": 1000})
+    return next((row for row in response.json() if row["username"] == username), None)
+
+
+def test_counts_follow_changes(client, unique, make_share, make_request):
+    user = unique("fred")
+    plant = unique("Hoya")
+    ids = [
+        client.post("/shares/", json=make_share(user, plant, amount=amount)).json()["id"]
+        for amount in (2, 3)
+    ]
+    client.post("/requests/bulk", json=[make_request(user, plant.lower(), amount=7)] * 2)
+
+    assert plant_stats(client, plant) == {
+        "plant_name": plant,
+        "shares_count": 2,
+        "shares_amount": 5,
+        "requests_count": 2,
+        "requests_amount": 14,
+    }
+    assert plant_stats(client, plant, "shortage")["requests_amount"] == 14
+    assert user_stats(client, user) == {
+        "username": user,
+        "shares_count": 2,
+        "requests_count": 2,
+    }
+
+    client.delete(f"/shares/{ids[0]}")
+    assert plant_stats(client, plant)["shares_amount"] == 3
+    assert user_stats(client, user, "requests")["shares_count"] == 1
+
+
+def test_top_plants_first(client, unique, make_share):
+    plant = unique("Pilea")
+    client.post("/shares/", json=make_share(unique("gil"), plant, amount=1e9))
+    top = client.get("/stats/plants", params={"order": "supply", "limit": 1}).json()
+    assert [row["plant_name"] for row in top] == [plant]
+
+
+def test_reconcile_corrects_drift(client, unique, make_share):
+    user = unique("hana")
+    client.post("/shares/", json=make_share(user))
+    with SessionLocal() as db:
+        db.get(models.UserStats, user).shares_count = 5
+        db.commit()
+        assert stats.reconcile(db) >= 1
+        db.commit()
+        assert stats.reconcile(db) == 0
+    assert user_stats(client, user)["shares_count"] == 1
@@ -2,6 +2,9 @@ import axios from 'axios'
 
 const api = axios.create({
     baseURL: 'http://localhost:8000',
+    // Send the backend's cookies, so that after posting a share or request
+    // the listings are read from the database itself rather than a replica
+    withCredentials: true,
 })
 
 export default api;
@@ -8,12 +8,16 @@ import Login from "./Login"
 import Register from "./Register"
 import FilterButton from "./FilterButton"
 
+// The query parameters of each filter of the shares table. The backend
+// has no "not shared by" filter, so "Shared by others" gets all shares
+// and drops the user's own (see OTHERS_FILTER)
 const FILTER_MAP = {
-    "All": (share, username) => true,
-    "My shares": (share, username) => (share.shared_by === username),
-    "Shared by others": (share, username) => (share.shared_by !== username),
+    "All": (username) => ({}),
+    "My shares": (username) => ({ shared_by: username }),
+    "Shared by others": (username) => ({}),
 };
 const FILTER_NAMES = Object.keys(FILTER_MAP);
+const OTHERS_FILTER = "Shared by others";
 
 
 const REQUEST_FILTER_MAP = {
@@ -25,6 +29,20 @@ const REQUEST_FILTER_MAP = {
 const REQUEST_FILTER_NAMES = Object.keys(REQUEST_FILTER_MAP);
 
 
+// Get every page of a listing, following the cursor in the X-Next-Cursor
+// response header until the last page
+const fetchAll = async (path, params) => {
+    const rows = [];
+    let cursor;
+    do {
+        const response = await api.get(path, { params: { ...params, cursor } });
+        rows.push(...response.data);
+        cursor = response.headers['x-next-cursor'];
+    } while (cursor);
+    return rows;
+};
+
+
 const Dashboard = () => {
 
     const [filter, setFilter] = useState("All");
@@ -43,12 +61,11 @@ const Dashboard = () => {
     // Set up shares, which will be the recipient of the plant form data
     const [shares, setShares] = useState([]);
 
-    // Set up shares that will be displayed on the table, which may be a
-    // subset of all shares (such as only the user's shared plants)
-    const filterFun = (share) => (FILTER_MAP[filter](share, username));
-    const shareList = shares.filter(filterFun);
-    // const shareList = filter === "All" ? shares : shares.filter(share => share.shared_by === username)
-      
+    // Set up shares that will be displayed on the table: the listing is
+    // filtered by the backend, except for dropping the user's own shares
+    const shareList = filter === OTHERS_FILTER
+        ? shares.filter(share => share.shared_by !== username)
+        : shares;
 
     // Default form data for plant shares
     const [formData, setFormData] = useState({
@@ -60,10 +77,10 @@ const Dashboard = () => {
         date: ''
     })
 
-    // Assign to shares the data from the shares endpoint
+    // Assign to shares all the pages of the shares endpoint that match
+    // the filter
     const fetchShares = async () => {
-        const response = await api.get('/shares/')
-        setShares(response.data)
+        setShares(await fetchAll('/shares/', FILTER_MAP[filter](username)))
     };
 
     // PLANT REQUESTS
@@ -80,17 +97,20 @@ const Dashboard = () => {
     })
 
     const fetchRequests = async () => {
-        const response = await api.get('/requests/')
-        setRequests(response.data)
+        setRequests(await fetchAll('/requests/', {}))
     };
 
     // Get shares and requests data from their endpoints at mount (first render)
     // to fill out the Available and Requested plants tables
     useEffect(() => {
-        fetchShares();
         fetchRequests();
     }, []);
 
+    // Get the shares again whenever the filter (or the user) changes
+    useEffect(() => {
+        fetchShares();
+    }, [filter, username]);
+
 
     // Add user inputs to plant share form
     const handleInputChange = (event) => {
@@ -98,7 +118,7 @@ const Dashboard = () => {
         // If true, value is event.target.checked
         // If false, value is event.target.value
         const value = event.target.type === 'checkbox' ? event.target.checked : event.target.value;
-        const datevalue = new Date().toLocaleDateString();
+        const datevalue = new Date().toISOString().slice(0, 10);
 
         setFormData({
             ...formData,
@@ -131,7 +151,7 @@ const Dashboard = () => {
     // Add user inputs to plant request form
     const handleRequestInputChange = (event) => {
         const value = event.target.value;
-        const datevalue = new Date().toLocaleDateString();
+        const datevalue = new Date().toISOString().slice(0, 10);
 
         setRequestFormData({
             ...requestFormData,
@@ -16,6 +16,8 @@ import PropTypes from 'prop-types'
 async function RegisterUser(credentials) {
     return fetch("http://localhost:8000/users/", {
         method: "POST",
+        // Keep the backend's cookie, so the new user is read back at once
+        credentials: "include",
         headers: {
             "Content-Type": "application/x-www-form-urlencoded"
         },